@@ -0,0 +1,209 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""blue/green DB updates: apply the changes of an update run to a staging
+copy of the Debsources tables, then make it live atomically
+
+the web app keeps reading from the live tables (in the "public" schema) for
+the whole update run: it sees neither half-applied package lists and suites
+nor lock waits, except for the brief table swap at the end. The price is that
+of a copy of the tables rewritten by update runs, done at the beginning of
+each run.
+
+Big per-package tables (see SHARED_TABLES) are not copied but shared between
+live and staging tables: rows of added packages are appended to them, and
+rows of removed packages are deleted from them (by cascade) before the switch.
+Live readers do not notice the former, as they only reach those rows through
+live packages
+
+"""
+
+import logging
+import re
+
+import sqlalchemy
+
+from sqlalchemy import sql
+from sqlalchemy.schema import CreateTable
+
+from debsources import models
+
+
+LIVE_SCHEMA = 'public'
+STAGING_SCHEMA = 'debsources_staging'
+RETIRED_SCHEMA = 'debsources_retired'
+
+# big tables, only ever appended to or deleted from by cascade when packages
+# are added or removed, shared between live and staging tables
+SHARED_TABLES = set(['files', 'checksums', 'ctags', 'sloccounts', 'metrics',
+                     'binaries', 'binary_names'])
+
+
+def _tables():
+    """staged Debsources tables, sorted by dependency"""
+    return [table for table in models.Base.metadata.sorted_tables
+            if table.name not in SHARED_TABLES]
+
+
+def _refer_shared_tables_to(session, schema):
+    """make shared tables reference the staged tables (e.g. packages) that
+    are in `schema`, so that rows of packages added to, and cascade deletes
+    from, the tables of `schema` are accepted by, and propagated to, shared
+    tables
+
+    """
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in SHARED_TABLES:
+            continue
+        for fkey in table.foreign_key_constraints:
+            if fkey.referred_table.name in SHARED_TABLES:
+                continue
+            name = '%s_%s_fkey' % (table.name, '_'.join(fkey.column_keys))
+            session.execute('ALTER TABLE %s.%s DROP CONSTRAINT IF EXISTS %s'
+                            % (LIVE_SCHEMA, table.name, name))
+            # NOT VALID: existing rows need no check, which would scan the
+            # whole (big) table, as referenced rows exist in both schemas
+            session.execute(
+                'ALTER TABLE %s.%s ADD CONSTRAINT %s '
+                'FOREIGN KEY (%s) REFERENCES %s.%s (%s)%s NOT VALID'
+                % (LIVE_SCHEMA, table.name, name,
+                   ', '.join(fkey.column_keys),
+                   schema, fkey.referred_table.name,
+                   ', '.join(elt.column.name for elt in fkey.elements),
+                   ' ON DELETE ' + fkey.ondelete if fkey.ondelete else ''))
+
+
+def _schema_exists(session, schema):
+    return session.execute(
+        sql.text('SELECT 1 FROM pg_namespace WHERE nspname = :schema'),
+        {'schema': schema}).first() is not None
+
+
+def _copy_table(session, table):
+    """copy `table`, structure and content, from the live schema to the
+    staging one, which must be the first one in the search path
+
+    """
+    logging.info('copy table %s to staging...' % table.name)
+    # unqualified names in the DDL (e.g. foreign keys) resolve to staging
+    # tables; enum types are shared with live tables
+    session.execute(CreateTable(table))
+    columns = ', '.join('"%s"' % column.name for column in table.columns)
+    session.execute('INSERT INTO %s.%s (%s) SELECT %s FROM %s.%s'
+                    % (STAGING_SCHEMA, table.name, columns,
+                       columns, LIVE_SCHEMA, table.name))
+
+    # indexes, including those not declared by models (e.g. trigram ones),
+    # but not those backing constraints, which CreateTable takes care of
+    indexes = session.execute(sql.text(
+        'SELECT indexname, indexdef FROM pg_indexes '
+        'WHERE schemaname = :schema AND tablename = :table '
+        'AND indexname NOT IN '
+        '  (SELECT conname FROM pg_constraint c '
+        '   JOIN pg_namespace n ON n.oid = c.connamespace '
+        '   WHERE n.nspname = :schema)'),
+        {'schema': LIVE_SCHEMA, 'table': table.name})
+    for (_name, indexdef) in indexes:
+        session.execute(re.sub(r' ON (%s\.)?%s ' % (LIVE_SCHEMA, table.name),
+                               ' ON %s.%s ' % (STAGING_SCHEMA, table.name),
+                               indexdef, count=1))
+
+    # new serial sequences must not hand out ids of copied rows
+    pkey = list(table.primary_key.columns)
+    if len(pkey) == 1 and isinstance(pkey[0].type, sqlalchemy.Integer):
+        session.execute(
+            "SELECT setval(pg_get_serial_sequence('%s.%s', '%s'), "
+            "COALESCE(MAX(%s), 0) + 1, false) FROM %s.%s"
+            % (STAGING_SCHEMA, table.name, pkey[0].name,
+               pkey[0].name, STAGING_SCHEMA, table.name))
+    session.execute('ANALYZE %s.%s' % (STAGING_SCHEMA, table.name))
+
+
+def prepare(session, reuse=False):
+    """create the staging schema, as a copy of the live one (shared tables
+    excluded), unless `reuse` is set and it exists already (e.g. left behind
+    by an interrupted update run that will be resumed)
+
+    changes are committed
+
+    """
+    if reuse and _schema_exists(session, STAGING_SCHEMA):
+        logging.info('reuse existing staging schema %s' % STAGING_SCHEMA)
+        return
+    logging.info('create staging schema %s...' % STAGING_SCHEMA)
+    session.execute('DROP SCHEMA IF EXISTS %s CASCADE' % STAGING_SCHEMA)
+    session.execute('CREATE SCHEMA %s' % STAGING_SCHEMA)
+    session.execute('SET LOCAL search_path TO %s, %s'
+                    % (STAGING_SCHEMA, LIVE_SCHEMA))
+    for table in _tables():
+        _copy_table(session, table)
+    _refer_shared_tables_to(session, STAGING_SCHEMA)
+    session.commit()
+
+
+def discard(session):
+    """drop the staging schema, if any (e.g. left behind by an interrupted
+    update run), so that live tables can be updated directly
+
+    changes are committed
+
+    """
+    if not _schema_exists(session, STAGING_SCHEMA):
+        return
+    logging.info('discard staging schema %s...' % STAGING_SCHEMA)
+    session.execute('DROP SCHEMA %s CASCADE' % STAGING_SCHEMA)
+    _refer_shared_tables_to(session, LIVE_SCHEMA)
+    session.commit()
+
+
+def staging_engine(db_uri, **kwargs):
+    """return a DB engine for `db_uri` whose connections act on the staging
+    schema, falling back to the live one for shared objects (e.g. types)
+
+    """
+    return sqlalchemy.create_engine(
+        db_uri,
+        connect_args={'options': '-c search_path=%s,%s'
+                      % (STAGING_SCHEMA, LIVE_SCHEMA)},
+        **kwargs)
+
+
+def switch(session):
+    """make the staging tables live, atomically, and drop the previously live
+    ones
+
+    changes are committed
+
+    """
+    logging.info('switch staging schema %s to live...' % STAGING_SCHEMA)
+    session.execute('DROP SCHEMA IF EXISTS %s CASCADE' % RETIRED_SCHEMA)
+    session.execute('CREATE SCHEMA %s' % RETIRED_SCHEMA)
+    # moving tables moves their indexes, constraints and serial sequences
+    # too; foreign keys of shared tables follow the staged tables they refer
+    # to, which become the live ones
+    for table in reversed(_tables()):
+        session.execute('ALTER TABLE %s.%s SET SCHEMA %s'
+                        % (LIVE_SCHEMA, table.name, RETIRED_SCHEMA))
+    for table in _tables():
+        session.execute('ALTER TABLE %s.%s SET SCHEMA %s'
+                        % (STAGING_SCHEMA, table.name, LIVE_SCHEMA))
+    session.execute('DROP SCHEMA %s' % STAGING_SCHEMA)
+    session.commit()
+
+    logging.info('drop retired tables...')
+    session.execute('DROP SCHEMA %s CASCADE' % RETIRED_SCHEMA)
+    session.commit()
@@ -62,6 +62,9 @@ CTAGS_LANGUAGES = (
 
 METRIC_TYPES = ("size",)
 
+# states of extraction jobs, see models.ExtractionJob
+JOB_STATES = ("pending", "done", "failed")
+
 
 # debian package areas
 AREAS = ["main", "contrib", "non-free"]
@@ -0,0 +1,194 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""continuous, incremental update mode
+
+the daemon watches mirror Sources indexes and, as soon as they change,
+updates Debsources with added and removed packages (extract, suites and gc
+stages), relying on mirror deltas to act only on changed packages. Slower
+stages that refresh derived data (stats, cache, charts) are run lazily, once
+updates have calmed down for a while.
+
+Mirror changes are detected using inotify, if the optional pyinotify module is
+available, or by polling otherwise.
+
+"""
+
+import logging
+import os
+import time
+
+from debsources import updater
+from debsources.debmirror import SourceMirror
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+# stages run as soon as the mirror changes; all others are refresh stages
+UPDATE_STAGES = set([updater.STAGE_EXTRACT, updater.STAGE_SUITES,
+                     updater.STAGE_GC])
+
+# how often (in seconds) mirror indexes are checked for changes, when not
+# using inotify
+POLL_INTERVAL = 60
+
+# how long (in seconds) mirror indexes should stay unchanged before acting on
+# their changes, so that mirror pushes are done with
+SETTLE_TIME = 120
+
+# how long (in seconds) after the last update refresh stages are run...
+REFRESH_DEBOUNCE = 900
+# ... unless updates keep coming: then refresh at most this late after the
+# first update that still needs a refresh
+REFRESH_MAX_DELAY = 3600
+
+# how long (in seconds) to wait before retrying failed update runs
+RETRY_DELAY = 600
+
+# how long (in seconds) to wait for mirror changes when nothing is due
+IDLE_TIMEOUT = 3600
+
+# file whose existence disables update runs, relative to root_dir (same as
+# debsources-main)
+DISABLER = 'UPDATE-DISABLED'
+
+INOTIFY_MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_DELETE | pyinotify.IN_CREATE) \
+    if pyinotify else None
+
+
+class MirrorWatcher(object):
+    """watch the Sources indexes of a local source mirror for changes"""
+
+    def __init__(self, mirror_dir, poll_interval=POLL_INTERVAL):
+        self.mirror = SourceMirror(mirror_dir)
+        self.poll_interval = poll_interval
+        self.signature = self.mirror.indexes_signature()
+        self._notifier = None
+        if pyinotify is not None:
+            watches = pyinotify.WatchManager()
+            watches.add_watch(os.path.join(mirror_dir, 'dists'),
+                              INOTIFY_MASK, rec=True, auto_add=True)
+            self._notifier = pyinotify.Notifier(watches, lambda _event: None)
+            logging.info('watch mirror for changes using inotify')
+        else:
+            logging.info('watch mirror for changes by polling every %ds '
+                         '(install pyinotify to use inotify instead)'
+                         % poll_interval)
+
+    def _sleep(self, timeout):
+        """sleep up to `timeout` seconds, waking up early on mirror changes
+        if inotify is available
+
+        """
+        if self._notifier is None:
+            time.sleep(timeout)
+        elif self._notifier.check_events(int(timeout * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+    def wait(self, timeout):
+        """wait up to `timeout` seconds for mirror indexes to change
+
+        return True if they did (since the last call), False otherwise
+
+        """
+        deadline = time.time() + timeout
+        while True:
+            signature = self.mirror.indexes_signature()
+            if signature != self.signature:
+                self.signature = signature
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._sleep(min(remaining, self.poll_interval))
+
+
+def _run_update(conf, Session, stages):
+    """do an update run of the given stages, using a new session from the
+    `Session` factory; return True on success, False on failure
+
+    """
+    if not stages:
+        return True
+    disabler = os.path.join(conf['root_dir'], DISABLER)
+    if os.path.exists(disabler):
+        logging.warn('updates disabled by %s: skipping update run' % disabler)
+        return False
+    logging.info('run stages: %s' % map(updater.pp_stage, sorted(stages)))
+    session = Session(autocommit=not conf['single_transaction'])
+    try:
+        updater.update(conf, session, stages=stages)
+        if conf['single_transaction']:
+            session.commit()
+    except:
+        logging.exception('update run failed')
+        if conf['single_transaction']:
+            session.rollback()
+        return False
+    finally:
+        session.close()
+    return True
+
+
+def run(conf, Session, watcher=None):
+    """run the update daemon, using sessions from the `Session` factory; never
+    return
+
+    only stages listed in conf['stages'] are run. An update run is done at
+    startup, to catch up with mirror changes happened in the meantime
+
+    """
+    if watcher is None:
+        watcher = MirrorWatcher(conf['mirror_dir'])
+    update_stages = conf['stages'] & UPDATE_STAGES
+    refresh_stages = conf['stages'] - UPDATE_STAGES
+    logging.info('start update daemon')
+
+    update_due = time.time()  # when the next update run is due, if any
+    refresh_due = None        # when the next refresh run is due, if any
+    unrefreshed_since = None  # when the first update not refreshed yet ran
+    while True:
+        if update_due is not None and time.time() >= update_due:
+            while watcher.wait(SETTLE_TIME):
+                logging.info('mirror is still changing, waiting...')
+            if _run_update(conf, Session, update_stages):
+                update_due = None
+                now = time.time()
+                if unrefreshed_since is None:
+                    unrefreshed_since = now
+                refresh_due = min(now + REFRESH_DEBOUNCE,
+                                  unrefreshed_since + REFRESH_MAX_DELAY)
+            else:
+                update_due = time.time() + RETRY_DELAY
+        if refresh_due is not None and time.time() >= refresh_due:
+            if _run_update(conf, Session, refresh_stages):
+                refresh_due = None
+                unrefreshed_since = None
+            else:
+                refresh_due = time.time() + RETRY_DELAY
+
+        now = time.time()
+        deadlines = [now + IDLE_TIMEOUT] + \
+            [due for due in [update_due, refresh_due] if due is not None]
+        if watcher.wait(max(0, min(deadlines) - now)):
+            logging.info('mirror changed')
+            update_due = time.time()
@@ -18,10 +18,139 @@
 
 import logging
 
+from sqlalchemy import event, sql
+
 from debsources import fs_storage
 from debsources.models import File, Package, PackageName, SuiteInfo, Suite
 from debsources.models import VCS_TYPES
 
+# session.info key of the <package, version> -> package id map, see
+# preload_package_ids()
+PACKAGE_IDS_KEY = 'debsources.package_ids'
+
+# session.info key of the undo log of the package id map, see
+# _set_package_id()
+PACKAGE_IDS_UNDO_KEY = 'debsources.package_ids.undo'
+
+# maximum number of rows inserted by a single multi-row INSERT statement, see
+# _add_files(). Note: PostgreSQL allows at most 65535 parameters per statement
+FILE_INSERT_BATCH = 10000
+
+
+def _load_package_ids(session):
+    logging.debug('load package id map...')
+    q = session.query(PackageName.name, Package.version, Package.id) \
+               .filter(Package.name_id == PackageName.id)
+    return dict(((name, version), package_id)
+                for (name, version, package_id) in q)
+
+
+def _in_transaction(transaction, ancestor):
+    """check whether `transaction` is `ancestor` or is nested in it"""
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+def _undo_package_ids(session, previous_transaction):
+    """revert the changes made to the package id map within a rolled back
+    transaction (or savepoint)
+
+    """
+    package_ids = session.info[PACKAGE_IDS_KEY]
+    undo_log = session.info[PACKAGE_IDS_UNDO_KEY]
+    kept = []
+    for (transaction, key, old_id) in reversed(undo_log):
+        if not _in_transaction(transaction, previous_transaction):
+            kept.append((transaction, key, old_id))
+        elif old_id is None:
+            package_ids.pop(key, None)
+        else:
+            package_ids[key] = old_id
+    undo_log[:] = reversed(kept)
+
+
+def _forget_package_ids_undo(session):
+    # also fired when savepoints are released: only outermost transactions
+    # are there to stay
+    if session.transaction is None or session.transaction.parent is None:
+        del session.info[PACKAGE_IDS_UNDO_KEY][:]
+
+
+def _set_package_id(session, package_ids, key, package_id):
+    """set (or unset, if `package_id` is None) the id of package `key` in the
+    package id map, logging the change so that it can be reverted if the
+    ongoing transaction is rolled back
+
+    """
+    if session.transaction is not None:
+        session.info[PACKAGE_IDS_UNDO_KEY].append(
+            (session.transaction, key, package_ids.get(key)))
+    if package_id is None:
+        package_ids.pop(key, None)
+    else:
+        package_ids[key] = package_id
+
+
+def preload_package_ids(session):
+    """load in memory a map from <package, version> pairs to package ids, that
+    will be used by the lookup functions of this module instead of querying
+    the DB, for the lifetime of `session`
+
+    the map is kept up to date by add_package() and rm_package(), whose
+    changes are reverted if the transaction (or savepoint) they happened in
+    is rolled back. Calling this function again reloads the map, e.g. after
+    packages have been added by other sessions. It is meant for bulk users
+    (e.g. the updater) that do all package additions/removals via this module
+
+    """
+    if PACKAGE_IDS_KEY not in session.info:
+        event.listen(session, 'after_soft_rollback', _undo_package_ids)
+        event.listen(session, 'after_commit', _forget_package_ids_undo)
+    session.info[PACKAGE_IDS_KEY] = _load_package_ids(session)
+    session.info[PACKAGE_IDS_UNDO_KEY] = []
+
+
+def _package_ids(session):
+    """return the package id map of `session`, or None if not preloaded"""
+    if PACKAGE_IDS_KEY not in session.info:
+        return None
+    return session.info[PACKAGE_IDS_KEY]
+
+
+def _add_files(session, package_id, relpaths):
+    """insert into the File table the given paths of package `package_id`
+
+    files are inserted using multi-row INSERT ... RETURNING statements, each
+    one inserting up to FILE_INSERT_BATCH files, so that DB round trips are
+    per batch rather than per file
+
+    return the package file table, see add_package()
+
+    """
+    file_table = {}
+    files = File.__table__
+
+    def insert(batch):
+        q = files.insert() \
+                 .values([{'package_id': package_id, 'path': relpath}
+                          for relpath in batch]) \
+                 .returning(files.c.id, files.c.path)
+        for (file_id, relpath) in session.execute(q):
+            file_table[relpath] = file_id
+
+    batch = []
+    for relpath in relpaths:
+        batch.append(relpath)
+        if len(batch) >= FILE_INSERT_BATCH:
+            insert(batch)
+            batch = []
+    if batch:
+        insert(batch)
+    return file_table
+
 
 def add_package(session, pkg, pkgdir, sticky=False):
     """Add `pkg` (a `debmirror.SourcePackage`) to the DB.
@@ -61,31 +190,72 @@ def add_package(session, pkg, pkgdir, sticky=False):
         package_name.versions.append(db_package)
         session.add(db_package)
         session.flush()  # to get a version.id, needed by File below
+        package_ids = _package_ids(session)
+        if package_ids is not None:
+            _set_package_id(session, package_ids,
+                            (pkg['package'], pkg['version']), db_package.id)
 
         # add individual source files to the File table
-        file_table = {}
-        for (relpath, _abspath) in fs_storage.walk_pkg_files(pkgdir):
-            file_ = File(db_package, relpath)
-            session.add(file_)
-            session.flush()
-            file_table[relpath] = file_.id
-
-        return file_table
+        relpaths = (relpath for (relpath, _abspath)
+                    in fs_storage.walk_pkg_files(pkgdir))
+        return _add_files(session, db_package.id, relpaths)
 
 
 def rm_package(session, pkg, db_package):
     """Remove a package (= debmirror.SourcePackage) from the Debsources db
     """
     logging.debug('remove from db %s...' % pkg)
+    package_ids = _package_ids(session)
+    if package_ids is not None:
+        _set_package_id(session, package_ids,
+                        (pkg['package'], pkg['version']), None)
     session.delete(db_package)
     if not db_package.name.versions:
         # just removed last version, get rid of package too
         session.delete(db_package.name)
 
 
+def rm_packages(session, pkgs):
+    """Remove packages from the Debsources db, in bulk
+
+    `pkgs` is a list of <debmirror.SourcePackage, package id> pairs. Unlike
+    rm_package(), the ORM is bypassed: rows referencing removed packages are
+    removed by the DB (ON DELETE CASCADE)
+
+    """
+    if not pkgs:
+        return
+    logging.debug('remove from db %d packages...' % len(pkgs))
+    session.flush()
+    package_ids = _package_ids(session)
+    if package_ids is not None:
+        for (pkg, _id) in pkgs:
+            _set_package_id(session, package_ids,
+                            (pkg['package'], pkg['version']), None)
+
+    packages = Package.__table__
+    names = PackageName.__table__
+    ids = [package_id for (_pkg, package_id) in pkgs]
+    name_ids = [row[0] for row in session.execute(
+        sql.select([packages.c.name_id]).distinct()
+        .where(packages.c.id.in_(ids)))]
+    session.execute(packages.delete().where(packages.c.id.in_(ids)))
+    # get rid of package names whose last version has just been removed
+    session.execute(names.delete()
+                    .where(names.c.id.in_(name_ids))
+                    .where(~sql.exists().where(packages.c.name_id ==
+                                               names.c.id)))
+
+
 def lookup_package(session, package, version):
     """Lookup a package in the Debsources db, using <package, version> as key
     """
+    package_ids = _package_ids(session)
+    if package_ids is not None:
+        package_id = package_ids.get((package, version))
+        if package_id is None:
+            return None
+        return session.query(Package).get(package_id)
     return session.query(Package) \
                   .join(PackageName) \
                   .filter(Package.version == version) \
@@ -93,6 +263,17 @@ def lookup_package(session, package, version):
                   .first()
 
 
+def lookup_package_id(session, package, version):
+    """Lookup the id of a package in the Debsources db, using <package,
+    version> as key. Return None if the package does not exist
+    """
+    package_ids = _package_ids(session)
+    if package_ids is not None:
+        return package_ids.get((package, version))
+    db_package = lookup_package(session, package, version)
+    return db_package.id if db_package else None
+
+
 def lookup_db_suite(session, suite, sticky=False):
     return session.query(SuiteInfo) \
                   .filter_by(name=suite, sticky=sticky) \
@@ -123,6 +304,19 @@ def pkg_prefixes(session):
     return sorted([row[0] for row in session.execute(q)])
 
 
+def rm_files(session, file_ids):
+    """Remove files from the Debsources db, in bulk, given their ids
+
+    the ORM is bypassed: rows referencing removed files are removed by the DB
+    (ON DELETE CASCADE)
+
+    """
+    if not file_ids:
+        return
+    session.execute(File.__table__.delete()
+                    .where(File.__table__.c.id.in_(file_ids)))
+
+
 def rm_file(session, package, relpath, file_table=None):
     if file_table:
         file_id = file_table[relpath]
@@ -15,12 +15,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import cPickle as pickle
 import logging
 import os
 
 from debian import deb822
 from debian.debian_support import version_compare
 
+from debsources import hashutil
+
 
 class SourcePackage(deb822.Sources):
     """Debian source package, as it appears in a source mirror
@@ -35,11 +38,20 @@ class SourcePackage(deb822.Sources):
         information available in the Debsources db.  That, however, should be
         enough for the purposes of Debsources' needs.
 
+        """
+        return cls.from_db_fields(db_package.name.name, db_package.version,
+                                  db_package.area)
+
+    @classmethod
+    def from_db_fields(cls, package, version, area):
+        """same as from_db_model(), but starting from individual DB fields,
+        to spare the retrieval of models.Package instances
+
         """
         meta = {}
-        meta['package'] = db_package.name.name
-        meta['version'] = db_package.version
-        meta['section'] = db_package.area
+        meta['package'] = package
+        meta['version'] = version
+        meta['section'] = area
         return cls(meta)
 
     # override deb822's __eq__, as in source package land we can rely on
@@ -74,6 +86,16 @@ class SourcePackage(deb822.Sources):
     __repr__ = __str__
     __unicode__ = __str__
 
+    def source_size(self):
+        """return the size in bytes of the files making up the package, as
+        listed in its Files field (.dsc, tarballs, patches, ...)
+
+        return 0 if the Files field is not available, e.g. for packages built
+        from DB fields
+
+        """
+        return sum(int(f['size']) for f in self.get('files', []))
+
     def archive_area(self):
         """return package are in the debian achive
 
@@ -162,13 +184,24 @@ class SourceMirror(object):
     """Handle for a local Debian source mirror
     """
 
-    def __init__(self, path):
+    def __init__(self, path, cache_dir=None):
         """create a handle to a local source mirror rooted at path
+
+        if `cache_dir` is given, parsed Sources indexes are cached there across
+        runs, and mirror snapshots can be saved there to compute deltas, see
+        delta()
+
         """
         self.mirror_root = path
         self._suites = None    # dict: suite name -> [<package, version>]
         self._packages = None  # set(<package, version>)
         self._dists_dir = os.path.join(path, 'dists')
+        self._cache_dir = None
+        if cache_dir is not None:
+            self._cache_dir = os.path.join(cache_dir, 'mirror')
+        # dict: Sources path -> [<package, version, paragraph>], see
+        # __parse_index
+        self._indexes = {}
 
     @property
     def suites(self):
@@ -178,7 +211,7 @@ class SourceMirror(object):
         used the ls() method
         """
         if self._suites is None:
-            for pkg in self.ls():
+            for pkg in self.__ls(build=False):
                 pass  # hack: rely on ls' side-effects to populate suites
         assert self._suites is not None
         return self._suites
@@ -191,7 +224,7 @@ class SourceMirror(object):
         used the ls() method
         """
         if self._packages is None:
-            for pkg in self.ls():
+            for pkg in self.__ls(build=False):
                 pass  # hack: rely on ls' side-effects to populate _packages
         assert self._packages is not None
         return self._packages
@@ -210,6 +243,17 @@ class SourceMirror(object):
                 suite = steps[-4]  # wheezy, jessie, sid, ...
                 yield suite, f
 
+    def indexes_signature(self):
+        """return a signature of the Sources indexes of the mirror, as a set
+        of <path, size, mtime> triples, that changes whenever they do
+
+        """
+        signature = set()
+        for _suite, path in self.__find_Sources_gz():
+            stat = os.stat(path)
+            signature.add((path, stat.st_size, stat.st_mtime))
+        return signature
+
     def pkg_prefixes(self):
         """Return the list of relevant package prefixes
 
@@ -228,6 +272,111 @@ class SourceMirror(object):
                     prefixes.add(os.path.relpath(entry, pool_subdir))
         return sorted(list(prefixes))
 
+    def __cache_file(self, name):
+        return os.path.join(self._cache_dir, name)
+
+    def __load_cache(self, name):
+        """load a cache entry, return None if it does not exist or if it is
+        unreadable
+
+        """
+        path = self.__cache_file(name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception, e:
+            logging.warn('ignoring corrupted mirror cache %s: %s' % (path, e))
+            return None
+
+    def __save_cache(self, name, data):
+        """atomically (over)write a cache entry"""
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        path = self.__cache_file(name)
+        with open(path + '.new', 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.new', path)
+
+    def __parse_index(self, src_index):
+        """parse Sources index `src_index` and return the list of its packages,
+        as <package, version, paragraph> triples. `paragraph` is either a
+        SourcePackage instance or its textual representation, to be parsed
+        on demand
+
+        if a cache dir is available, reuse the outcome of previous parsing for
+        as long as the index does not change. Changes are detected looking at
+        index size and mtime first, and then, only if those differ, at its
+        SHA1 checksum
+
+        """
+        if src_index in self._indexes:
+            return self._indexes[src_index]
+
+        cache_name = None
+        if self._cache_dir is not None:
+            relpath = os.path.relpath(src_index, self.mirror_root)
+            cache_name = relpath.replace('/', '_') + '.pickle'
+            stat = os.stat(src_index)
+            signature = (stat.st_size, stat.st_mtime)
+            cached = self.__load_cache(cache_name)
+            if cached is not None:
+                if cached['signature'] != signature \
+                   and cached['sha1'] == hashutil.sha1sum(src_index):
+                    # touched, but unchanged
+                    cached['signature'] = signature
+                    self.__save_cache(cache_name, cached)
+                if cached['signature'] == signature:
+                    self._indexes[src_index] = cached['packages']
+                    return cached['packages']
+
+        logging.debug('parse Sources index %s...' % src_index)
+        with open(src_index) as i:
+            packages = [(pkg['package'], pkg['version'], pkg)
+                        for pkg in SourcePackage.iter_paragraphs(i)]
+        if cache_name is not None:
+            self.__save_cache(cache_name, {
+                'signature': signature,
+                'sha1': hashutil.sha1sum(src_index),
+                'packages': [(name, version, pkg.dump())
+                             for (name, version, pkg) in packages],
+            })
+        self._indexes[src_index] = packages
+        return packages
+
+    def __ls(self, suite=None, build=True):
+        """list mirror packages, see ls()
+
+        if `build` is False yield <package, version> pairs instead of
+        SourcePackage instances, which are expensive to build
+
+        """
+        self._suites = {}
+        self._packages = set()
+
+        for cursuite, src_index in self.__find_Sources_gz():
+            if suite is not None and cursuite != suite:
+                continue
+            for (name, version, paragraph) in self.__parse_index(src_index):
+                pkg_id = (name, version)
+
+                if cursuite not in self._suites:
+                    self._suites[cursuite] = []
+                self._suites[cursuite].append(pkg_id)
+
+                if pkg_id not in self._packages:
+                    self._packages.add(pkg_id)
+                    if not build:
+                        yield pkg_id
+                        continue
+                    if isinstance(paragraph, SourcePackage):
+                        pkg = paragraph
+                    else:
+                        pkg = SourcePackage(paragraph)
+                    pkg['x-debsources-mirror-root'] = self.mirror_root
+                    yield pkg
+
     def ls(self, suite=None):
         """List SourcePackages instances of packages available in the mirror.
         If `suite` is given, ignore all other suites.
@@ -237,24 +386,47 @@ class SourceMirror(object):
         considered at all!)
 
         """
-        self._suites = {}
-        self._packages = set()
+        return self.__ls(suite)
 
-        for cursuite, src_index in self.__find_Sources_gz():
-            if suite is not None and cursuite != suite:
-                continue
-            with open(src_index) as i:
-                for pkg in SourcePackage.iter_paragraphs(i):
-                    pkg_id = (pkg['package'], pkg['version'])
-
-                    if cursuite not in self._suites:
-                        self._suites[cursuite] = []
-                    self._suites[cursuite].append(pkg_id)
-
-                    if pkg_id not in self._packages:
-                        self._packages.add(pkg_id)
-                        pkg['x-debsources-mirror-root'] = self.mirror_root
-                        yield pkg
+    def save_snapshot(self, packages, pending=[], tag=None):
+        """save a snapshot of the mirror content, to be compared with future
+        mirror content by delta()
+
+        `packages` is the set of <package, version> pairs to be considered
+        known at next delta(). `pending` packages are those that are gone from
+        the mirror, but whose removal has been postponed: they will be reported
+        as removed (again) at next delta(). `tag` is an arbitrary (picklable)
+        value identifying the state the snapshot refers to, see delta()
+
+        """
+        assert self._cache_dir is not None
+        self.__save_cache('snapshot.pickle', {
+            'packages': set(packages),
+            'pending': set(pending),
+            'tag': tag,
+        })
+
+    def delta(self, tag=None):
+        """compare mirror content with the last snapshot saved by
+        save_snapshot()
+
+        return a pair <added, removed> of sets of <package, version> pairs, or
+        None if no snapshot is available, or if it has been saved with a tag
+        different from `tag`
+
+        """
+        if self._cache_dir is None:
+            return None
+        snapshot = self.__load_cache('snapshot.pickle')
+        if snapshot is None:
+            return None
+        if snapshot['tag'] != tag:
+            logging.info('mirror snapshot is stale (%s != %s), ignoring it'
+                         % (snapshot['tag'], tag))
+            return None
+        added = self.packages - snapshot['packages']
+        removed = (snapshot['packages'] | snapshot['pending']) - self.packages
+        return (added, removed)
 
     def ls_suites(self, aliases=False):
         """list suites available in the archive
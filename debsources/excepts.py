@@ -45,3 +45,9 @@ class Http404ErrorSuggestions(Http404Error):
 
 class Http403Error(Exception):
     pass
+
+
+class ResourceLimitExceeded(Exception):
+    """A package broke a resource limit (e.g. wall time, size) while being
+    worked upon, see debsources.watchdog"""
+    pass
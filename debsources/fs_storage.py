@@ -20,12 +20,21 @@ import os
 import shutil
 import subprocess
 
+from contextlib import contextmanager
+
 from consts import DPKG_EXTRACT_UMASK
 from subprocess_workaround import subprocess_setup
 
+from debsources import watchdog
+from debsources.excepts import ResourceLimitExceeded
+
 
 def extract_package(pkg, destdir):
     """extract a package to the FS storage
+
+    the extraction is subject to the resource limits of the current package,
+    see debsources.watchdog; if they are exceeded, the partially extracted
+    package is removed
     """
     def preexec_fn():
         subprocess_setup()
@@ -42,11 +51,36 @@ def extract_package(pkg, destdir):
     logfile = destdir + '.log'
     donefile = destdir + '.done'
     with open(logfile, 'w') as log:
-        subprocess.check_call(cmd, stdout=log, stderr=subprocess.STDOUT,
-                              preexec_fn=preexec_fn)
+        try:
+            watchdog.check_call(cmd, watch_dir=destdir, stdout=log,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=preexec_fn)
+        except ResourceLimitExceeded:
+            if os.path.isdir(destdir):
+                shutil.rmtree(str(destdir))
+            raise
     open(donefile, 'w').close()
 
 
+@contextmanager
+def atomic_file(path):
+    """yield a temporary file name, where to write the content of `path`
+
+    the temporary file is moved to `path` if the context completes, and
+    removed otherwise, so that writers interrupted midway (e.g. by the
+    watchdog) do not leave partial results behind, that would be taken as
+    complete ones later on
+    """
+    tmp = path + '.new'
+    try:
+        yield tmp
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    os.rename(tmp, path)
+
+
 def remove_package(pkg, destdir):
     """dispose of a package from the Debsources file system storage
     """
@@ -0,0 +1,108 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""on-disk journal of update runs, used to resume interrupted runs
+
+"""
+
+import cPickle as pickle
+import codecs
+import logging
+import os
+import shutil
+
+
+class UpdateJournal(object):
+    """journal of an ongoing update run, stored under a given directory
+
+    the journal records update stages completed by the run, together with the
+    update status at the end of the last completed one, and packages whose
+    addition has already been committed. When a run is interrupted, its
+    journal stays on disk and the next run picks up from there; upon run
+    completion the journal is removed (see finish())
+
+    Note: the journal is only accurate if the DB changes corresponding to
+    journaled events have been committed before recording them
+
+    """
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        self._state_file = os.path.join(journal_dir, 'state.pickle')
+        self._packages_file = os.path.join(journal_dir, 'packages')
+        self.stages = set()    # completed stages
+        self.status = None     # update status at the end of the last stage
+        self.packages = set()  # committed <package, version> pairs
+        self.resumed = self._load()
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+
+    def _load(self):
+        """load journal left over by an interrupted run, if any
+
+        return True if a journal has been found, False otherwise
+
+        """
+        if not os.path.exists(self.journal_dir):
+            return False
+        if os.path.exists(self._state_file):
+            with open(self._state_file, 'rb') as f:
+                state = pickle.load(f)
+            self.stages = state['stages']
+            self.status = state['status']
+        if os.path.exists(self._packages_file):
+            with open(self._packages_file, 'r+b') as f:
+                complete = 0  # size of the journal up to its last full line
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # truncated last line, written by a crash
+                    complete += len(line)
+                    fields = line.decode('utf-8').rstrip('\n').split('\t')
+                    self.packages.add(tuple(fields))
+                # drop the truncated line, so that later appends start afresh
+                f.truncate(complete)
+        return True
+
+    def stage_done(self, stage, status):
+        """record the completion of update `stage`, and the update `status`
+        at its end
+
+        """
+        logging.debug('journal: stage %s done' % stage)
+        self.stages.add(stage)
+        self.status = status
+        with open(self._state_file + '.new', 'wb') as f:
+            pickle.dump({'stages': self.stages, 'status': status}, f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(self._state_file + '.new', self._state_file)
+
+    def packages_committed(self, pkg_ids):
+        """record that `pkg_ids`, a list of <package, version> pairs, have
+        been committed to the DB
+
+        """
+        logging.debug('journal: %d packages committed' % len(pkg_ids))
+        self.packages.update(pkg_ids)
+        with codecs.open(self._packages_file, 'a', encoding='utf-8') as f:
+            for (package, version) in pkg_ids:
+                f.write('%s\t%s\n' % (package, version))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        """forget about the journal, as the run is complete"""
+        shutil.rmtree(self.journal_dir)
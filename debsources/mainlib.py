@@ -40,6 +40,19 @@ DEFAULT_CONFIG.update({
         'expire_days': '0',
         'force_triggers': [],
         'single_transaction': 'true',
+        'jobs':        '1',
+        'gc_batch_size': '1000',
+        'hook_batch_size': '0',
+        'journal':     'false',
+        'commit_packages': '0',
+        'commit_interval': '0',
+        'work_queue':  'false',
+        'blue_green':  'false',
+        'extract_order': '',
+        'priority_suites': 'sid testing',
+        'package_timeout': '0',
+        'package_max_size': '0',
+        'package_max_files': '0',
         },
     'webapp': {},
 })
@@ -71,11 +84,18 @@ PROBABLE_CONF_FILES = [
 def parse_exclude(fname):
     """parse file exclusion specifications from file `fname`
 
+    return an index of exclusion specifications, mapping package names to
+    lists of glob patterns of files to be excluded. Patterns are byte strings,
+    as the file paths they will be matched against
+
     """
-    exclude_specs = []
+    exclude_index = {}
     with open(fname) as f:
-        exclude_specs = list(deb822.Deb822.iter_paragraphs(f))
-    return exclude_specs
+        for spec in deb822.Deb822.iter_paragraphs(f):
+            exclude_index.setdefault(spec['package'], []) \
+                         .extend(pat.encode('utf-8')
+                                 for pat in spec['files'].split())
+    return exclude_index
 
 
 def guess_conffile():
@@ -98,20 +118,25 @@ def parse_conf_infra(items):
     """ returns correct typing for the [infra] section """
     typed = {}
     for (key, value) in items:
-        if key == 'expire_days':
+        if key in ['expire_days', 'jobs', 'gc_batch_size', 'package_timeout',
+                   'package_max_size', 'package_max_files',
+                   'commit_packages', 'commit_interval', 'hook_batch_size']:
             value = int(value)
         elif key == 'dry_run':
             assert value in ['true', 'false']
             value = (value == 'true')
-        elif key == 'hooks':
+        elif key in ['hooks', 'priority_suites']:
             value = value.split()
+        elif key == 'extract_order':
+            value = updater.parse_extract_order(value)
         elif key == 'log_level':
             value = LOG_LEVELS[value]
         elif key == 'backends':
             value = set(value.split())
         elif key == 'stages':
             value = updater.parse_stages(value)
-        elif key == 'single_transaction':
+        elif key in ['single_transaction', 'journal', 'work_queue',
+                     'blue_green']:
             assert value in ['true', 'false']
             value = (value == 'true')
         typed[key] = value
@@ -152,7 +177,7 @@ def load_conf(conffile, section="infra"):
         typed_conf.update(parse_conf_infra(conf.items('infra')))
 
         exclude_file = os.path.join(typed_conf['local_dir'], 'exclude.conf')
-        typed_conf['exclude'] = []
+        typed_conf['exclude'] = {}
         if os.path.exists(exclude_file):
             typed_conf['exclude'] = parse_exclude(exclude_file)
 
@@ -188,10 +213,46 @@ def add_arguments(cmdline):
     cmdline.add_argument('--dry-run', '-d', dest='dry',
                          action='store_true',
                          help='enable dry run mode')
+    cmdline.add_argument('--jobs', '-j', dest='jobs', type=int,
+                         metavar='N',
+                         help='extract packages and run file system hooks '
+                         'using N parallel worker processes; database '
+                         'changes are still applied by a single process '
+                         '(default: 1)')
     cmdline.add_argument('--single-transaction', dest='single_transaction',
                          choices=['yes', 'no'],
                          help='use a single big DB transaction, instead of '
                          'smaller per-package transactions (default: yes)')
+    cmdline.add_argument('--commit-packages', dest='commit_packages',
+                         type=int, metavar='N',
+                         help='in single transaction mode, commit DB changes '
+                         'every N added or removed packages, to bound memory '
+                         'usage and lock duration (default: 0, never)')
+    cmdline.add_argument('--commit-interval', dest='commit_interval',
+                         type=int, metavar='SECONDS',
+                         help='in single transaction mode, commit DB changes '
+                         'between packages at least every SECONDS seconds '
+                         '(default: 0, never)')
+    cmdline.add_argument('--journal', dest='journal',
+                         choices=['yes', 'no'],
+                         help='journal update progress on disk, so that '
+                         'interrupted update runs are resumed by the next '
+                         'one; in single transaction mode, this commits DB '
+                         'changes at the end of each stage and every few '
+                         'added packages (default: no)')
+    cmdline.add_argument('--work-queue', dest='work_queue',
+                         choices=['yes', 'no'],
+                         help='extract new packages via a DB work queue, '
+                         'shared with any number of update workers (see '
+                         '--worker), possibly running on other hosts that '
+                         'share the storage; implies per-package '
+                         'transactions (default: no)')
+    cmdline.add_argument('--blue-green', dest='blue_green',
+                         choices=['yes', 'no'],
+                         help='apply DB changes to a staging copy of the DB '
+                         'tables, made live atomically at the end of the '
+                         'update run, so that DB readers (e.g. the web app) '
+                         'never see half-applied changes (default: no)')
     cmdline.add_argument('--stage', '-s',
                          metavar='STAGE',
                          action='append',
@@ -244,6 +305,18 @@ def override_conf(conf, cmdline):
             conf['force_triggers'].append((event, hook))
     if cmdline.single_transaction:
         conf['single_transaction'] = (cmdline.single_transaction == 'yes')
+    if cmdline.commit_packages is not None:
+        conf['commit_packages'] = cmdline.commit_packages
+    if cmdline.commit_interval is not None:
+        conf['commit_interval'] = cmdline.commit_interval
+    if cmdline.journal:
+        conf['journal'] = (cmdline.journal == 'yes')
+    if cmdline.work_queue:
+        conf['work_queue'] = (cmdline.work_queue == 'yes')
+    if cmdline.blue_green:
+        conf['blue_green'] = (cmdline.blue_green == 'yes')
+    if cmdline.jobs:
+        conf['jobs'] = cmdline.jobs
 
 
 def conf_warnings(conf):
@@ -260,6 +333,24 @@ def conf_warnings(conf):
                      map(updater.pp_stage, conf['stages']))
     if conf['force_triggers']:
         logging.warn('forcing triggers: %s' % conf['force_triggers'])
+    if conf['work_queue']:
+        logging.warn('note: extracting packages via the work queue')
+    if conf['blue_green']:
+        logging.warn('note: blue/green update, DB changes are applied to '
+                     'staging tables')
+    if conf['hook_batch_size'] > 1 and not conf['single_transaction']:
+        logging.warn('note: hook batching enabled, packages will be added '
+                     'to the DB in transactions of up to %d packages'
+                     % conf['hook_batch_size'])
+    if (conf['commit_packages'] or conf['commit_interval']) \
+       and conf['single_transaction']:
+        logging.warn('note: chunked commits enabled, the single transaction '
+                     'will be committed every %s packages / %s seconds'
+                     % (conf['commit_packages'] or '-',
+                        conf['commit_interval'] or '-'))
+    if conf['journal'] and conf['single_transaction']:
+        logging.warn('note: journaling enabled, the single transaction will '
+                     'be committed incrementally')
 
 
 def load_hooks(conf):
@@ -270,11 +361,13 @@ def load_hooks(conf):
     dictionary mapping per-package file extensions (to be found in the
     filesystem storage) to the owner plugin
     """
-    observers = updater.NO_OBSERVERS
+    observers = dict((event, list(actions))
+                     for (event, actions) in updater.NO_OBSERVERS.items())
     file_exts = {}
 
     def subscribe_callback(event, action, title=""):
-        if event not in updater.KNOWN_EVENTS:
+        if event not in updater.KNOWN_EVENTS + updater.FS_EVENTS + \
+                updater.BATCH_EVENTS:
             raise ValueError('unknown event type "%s"' % event)
         observers[event].append((title, action))
 
@@ -0,0 +1,16 @@
+CREATE TYPE job_states AS ENUM ('pending', 'done', 'failed') ;
+
+CREATE TABLE extraction_jobs (
+  id SERIAL NOT NULL,
+  package VARCHAR NOT NULL,
+  version VARCHAR NOT NULL,
+  paragraph VARCHAR NOT NULL,
+  state job_states NOT NULL,
+  attempts INTEGER NOT NULL,
+  worker VARCHAR,
+  updated_at TIMESTAMP WITHOUT TIME ZONE,
+  PRIMARY KEY (id),
+  UNIQUE (package, version)
+) ;
+
+CREATE INDEX ix_extraction_jobs_state ON extraction_jobs (state) ;
@@ -0,0 +1,15 @@
+CREATE TABLE extraction_failures (
+  id SERIAL NOT NULL,
+  package VARCHAR NOT NULL,
+  version VARCHAR NOT NULL,
+  stage VARCHAR NOT NULL,
+  error VARCHAR NOT NULL,
+  attempts INTEGER NOT NULL,
+  first_failure TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+  last_failure TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+  retry_after TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+  PRIMARY KEY (id),
+  UNIQUE (package, version)
+) ;
+
+CREATE INDEX ix_extraction_failures_retry_after ON extraction_failures (retry_after) ;
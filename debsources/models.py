@@ -36,7 +36,7 @@ from debian.debian_support import version_compare
 from debsources.excepts import InvalidPackageOrVersionError, \
     FileOrFolderNotFound
 from debsources.consts import VCS_TYPES, SLOCCOUNT_LANGUAGES, \
-    CTAGS_LANGUAGES, METRIC_TYPES, AREAS, PREFIXES_DEFAULT
+    CTAGS_LANGUAGES, METRIC_TYPES, AREAS, PREFIXES_DEFAULT, JOB_STATES
 from debsources import filetype
 from debsources.debmirror import SourcePackage
 from debsources.consts import SUITES
@@ -45,7 +45,7 @@ Base = declarative_base()
 
 
 # used for migrations, see scripts under python/migrate/
-DB_SCHEMA_VERSION = 7
+DB_SCHEMA_VERSION = 9
 
 
 class PackageName(Base):
@@ -478,6 +478,67 @@ class HistorySlocCount(Base):
         self.suite = suite
         self.timestamp = timestamp
 
+
+class ExtractionJob(Base):
+    """work queue of source packages to be extracted and added to Debsources,
+    shared among update workers, see updater.process_extraction_queue()
+
+    jobs are claimed by workers with SELECT ... FOR UPDATE SKIP LOCKED, and
+    stay locked for as long as they are being run
+    """
+
+    __tablename__ = 'extraction_jobs'
+    __table_args__ = (UniqueConstraint('package', 'version'),)
+
+    id = Column(Integer, primary_key=True)
+    package = Column(String, nullable=False)
+    version = Column(String, nullable=False)
+    paragraph = Column(String, nullable=False)  # Sources entry, as deb822
+    state = Column(Enum(*JOB_STATES, name="job_states"),
+                   index=True, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    worker = Column(String)  # last worker that ran the job, as host:pid
+    updated_at = Column(DateTime(timezone=False))
+
+    def __init__(self, pkg):
+        self.package = pkg['package']
+        self.version = pkg['version']
+        self.paragraph = pkg.dump()
+        self.state = 'pending'
+        self.attempts = 0
+
+
+class ExtractionFailure(Base):
+    """ledger of source packages that failed to be added to Debsources, in
+    the update activity (e.g. "extract", or a hook like "add-package/ctags")
+    that failed last
+
+    failing packages are quarantined, i.e. not retried, until `retry_after`,
+    which is pushed further away at each failed attempt, see
+    updater.quarantine_package()
+    """
+
+    __tablename__ = 'extraction_failures'
+    __table_args__ = (UniqueConstraint('package', 'version'),)
+
+    id = Column(Integer, primary_key=True)
+    package = Column(String, nullable=False)
+    version = Column(String, nullable=False)
+    stage = Column(String, nullable=False)
+    error = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    first_failure = Column(DateTime(timezone=False), nullable=False)
+    last_failure = Column(DateTime(timezone=False), nullable=False)
+    retry_after = Column(DateTime(timezone=False), index=True,
+                         nullable=False)
+
+    def __init__(self, package, version, first_failure):
+        self.package = package
+        self.version = version
+        self.attempts = 0
+        self.first_failure = first_failure
+
+
 # it's used in Location.get_stat
 # to bypass flake8 complaints, we do not inject the global namespace
 # with globals()["LongFMT"] = namedtuple...
@@ -0,0 +1,200 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""run items through a chain of concurrent processing stages, connected by
+bounded queues
+
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+
+# how long blocked queue operations wait before checking for pipeline abort
+POLL_INTERVAL = 0.5
+
+_DONE = object()  # end of stream marker
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class QueueStats(object):
+    """depth statistics of a pipeline queue, sampled at each insertion"""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total_depth = 0
+        self.max_depth = 0
+        self.full_waits = 0  # number of insertions that blocked on full queue
+        self.full_time = 0.  # time spent waiting for free queue slots
+
+    def sample(self, depth):
+        self.samples += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    @property
+    def avg_depth(self):
+        if not self.samples:
+            return 0.
+        return float(self.total_depth) / self.samples
+
+    def __str__(self):
+        return '%s: %d items, max depth %d/%d, avg depth %.1f, ' \
+            'blocked %d times (%.1f seconds)' \
+            % (self.name, self.samples, self.max_depth, self.maxsize,
+               self.avg_depth, self.full_waits, self.full_time)
+
+
+class Pipeline(object):
+    """a chain of processing stages, each one run by its own worker threads
+
+    each stage is described by a triple <name, func, workers>: `workers`
+    threads apply `func` to the items found in the stage input queue, putting
+    results into the input queue of the next stage. All queues are bounded by
+    `maxsize`, so that fast stages block (backpressure) instead of piling up
+    work in front of slow ones. The input queue of each stage is named after
+    the stage itself; the final output queue is named `sink`.
+
+    `func` should handle its own errors: exceptions are logged, and the
+    corresponding items dropped, unless `on_error` is given. In that case
+    `on_error(name, item)` is called (from the exception handler, so that it
+    can inspect the exception being handled) and its return value is passed
+    on to the next stage in place of the failed result.
+
+    Note: stage functions run in threads. For CPU-bound work, or work that
+    needs per-process state (e.g. the CWD), have `func` delegate to a process
+    pool, e.g. with `multiprocessing.Pool.apply`.
+
+    """
+
+    def __init__(self, stages, maxsize, sink='output', on_error=None):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.on_error = on_error
+        names = [name for (name, _func, _workers) in stages] + [sink]
+        self.queues = [Queue.Queue(maxsize) for _name in names]
+        self.queue_stats = [QueueStats(name, maxsize) for name in names]
+        self._aborted = threading.Event()
+        self._threads = []
+
+    def _put(self, i, item):
+        """put `item` on the i-th queue, blocking while it is full"""
+        queue, stats = self.queues[i], self.queue_stats[i]
+        try:
+            queue.put_nowait(item)
+        except Queue.Full:
+            stats.full_waits += 1
+            blocked_since = time.time()
+            while not self._aborted.is_set():
+                try:
+                    queue.put(item, timeout=POLL_INTERVAL)
+                    break
+                except Queue.Full:
+                    pass
+            else:
+                raise PipelineAborted()
+            stats.full_time += time.time() - blocked_since
+        if item is not _DONE:
+            stats.sample(queue.qsize())
+
+    def _get(self, i):
+        """get an item from the i-th queue, blocking while it is empty"""
+        while not self._aborted.is_set():
+            try:
+                return self.queues[i].get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+        raise PipelineAborted()
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                self._put(0, item)
+            self._put(0, _DONE)
+        except PipelineAborted:
+            pass
+
+    def _work(self, i, live_workers, lock):
+        (name, func, _workers) = self.stages[i]
+        try:
+            while True:
+                item = self._get(i)
+                if item is _DONE:
+                    self._put(i, _DONE)  # let sibling workers see it too
+                    break
+                try:
+                    result = func(item)
+                except:
+                    logging.exception('pipeline stage %s failed on %s'
+                                      % (name, item))
+                    if self.on_error is None:
+                        continue
+                    result = self.on_error(name, item)
+                self._put(i + 1, result)
+            with lock:
+                live_workers[0] -= 1
+                last = (live_workers[0] == 0)
+            if last:  # last worker of this stage: propagate end of stream
+                self._put(i + 1, _DONE)
+        except PipelineAborted:
+            pass
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def run(self, items):
+        """feed `items` through the pipeline and yield the results of the last
+        stage, in completion order
+
+        `items` is consumed from a separate thread; it should hence not share
+        state (e.g. DB sessions) with the caller
+
+        """
+        self._start(self._feed, items)
+        for i, (_name, _func, workers) in enumerate(self.stages):
+            live_workers, lock = [workers], threading.Lock()
+            for _n in range(workers):
+                self._start(self._work, i, live_workers, lock)
+
+        try:
+            while True:
+                result = self._get(len(self.stages))
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            # on normal termination all threads are gone already; otherwise
+            # (e.g. exceptions raised by the consumer) make them go away.
+            # Threads busy in stage functions cannot be interrupted, but being
+            # daemonic they will not prevent exit
+            self._aborted.set()
+            for thread in self._threads:
+                thread.join(2 * POLL_INTERVAL)
+
+    def log_stats(self):
+        for stats in self.queue_stats:
+            logging.info('pipeline queue %s' % stats)
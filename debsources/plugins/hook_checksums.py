@@ -52,12 +52,12 @@ def parse_checksums(path):
             yield (sha256, path)
 
 
-def add_package(session, pkg, pkgdir, file_table):
+def add_package_fs(session, pkg, pkgdir, file_table):
+    """compute checksums of all files in `pkgdir`, if not done before"""
     global conf
-    logging.debug('add-package %s' % pkg)
+    logging.debug('add-package (fs) %s' % pkg)
 
     sumsfile = sums_path(pkgdir)
-    sumsfile_tmp = sumsfile + '.new'
 
     def emit_checksum(out, relpath, abspath):
         if os.path.islink(abspath) or not os.path.isfile(abspath):
@@ -71,48 +71,104 @@ def add_package(session, pkg, pkgdir, file_table):
 
     if 'hooks.fs' in conf['backends']:
         if not os.path.exists(sumsfile):  # compute checksums only if needed
-            with open(sumsfile_tmp, 'w') as out:
-                for (relpath, abspath) in \
-                        fs_storage.walk_pkg_files(pkgdir, file_table):
-                    emit_checksum(out, relpath, abspath)
-            os.rename(sumsfile_tmp, sumsfile)
+            with fs_storage.atomic_file(sumsfile) as sumsfile_tmp:
+                with open(sumsfile_tmp, 'w') as out:
+                    for (relpath, abspath) in \
+                            fs_storage.walk_pkg_files(pkgdir, file_table):
+                        emit_checksum(out, relpath, abspath)
+
+
+def _checksum_rows(session, package_id, sumsfile, file_table):
+    """yield Checksum insertion parameters for the checksums listed in
+    `sumsfile`, skipping files that are not in the DB
+
+    """
+    for (sha256, relpath) in parse_checksums(sumsfile):
+        params = {'package_id': package_id,
+                  'sha256': sha256}
+        if file_table:
+            try:
+                file_id = file_table[relpath]
+                params['file_id'] = file_id
+            except KeyError:
+                continue
+        else:
+            file_ = session.query(File) \
+                           .filter_by(package_id=package_id,
+                                      path=relpath) \
+                           .first()
+            if not file_:
+                continue
+            params['file_id'] = file_.id
+        yield params
+
+
+def _insert_checksums(session, rows):
+    """bulk insert Checksum `rows`, flushing every BULK_FLUSH_THRESHOLD"""
+    insert_q = sql.insert(Checksum.__table__)
+    insert_params = []
+    for params in rows:
+        insert_params.append(params)
+        if len(insert_params) >= BULK_FLUSH_THRESHOLD:
+            session.execute(insert_q, insert_params)
+            session.flush()
+            insert_params = []
+    if insert_params:  # source packages shouldn't be empty but...
+        session.execute(insert_q, insert_params)
+        session.flush()
+
+
+def add_package(session, pkg, pkgdir, file_table):
+    global conf
+    logging.debug('add-package %s' % pkg)
+
+    sumsfile = sums_path(pkgdir)
+    add_package_fs(session, pkg, pkgdir, file_table)
 
     if 'hooks.db' in conf['backends']:
-        db_package = db_storage.lookup_package(session, pkg['package'],
-                                               pkg['version'])
-        insert_q = sql.insert(Checksum.__table__)
-        insert_params = []
+        package_id = db_storage.lookup_package_id(session, pkg['package'],
+                                                  pkg['version'])
         if not session.query(Checksum) \
-                      .filter_by(package_id=db_package.id) \
+                      .filter_by(package_id=package_id) \
                       .first():
             # ASSUMPTION: if *a* checksum of this package has already
             # been added to the db in the past, then *all* of them have,
             # as additions are part of the same transaction
-            for (sha256, relpath) in parse_checksums(sumsfile):
-                params = {'package_id': db_package.id,
-                          'sha256': sha256}
-                if file_table:
-                    try:
-                        file_id = file_table[relpath]
-                        params['file_id'] = file_id
-                    except KeyError:
-                        continue
-                else:
-                    file_ = session.query(File) \
-                                   .filter_by(package_id=db_package.id,
-                                              path=relpath) \
-                                   .first()
-                    if not file_:
-                        continue
-                    params['file_id'] = file_.id
-                insert_params.append(params)
-                if len(insert_params) >= BULK_FLUSH_THRESHOLD:
-                    session.execute(insert_q, insert_params)
-                    session.flush()
-                    insert_params = []
-            if insert_params:  # source packages shouldn't be empty but...
-                session.execute(insert_q, insert_params)
-                session.flush()
+            _insert_checksums(session, _checksum_rows(session, package_id,
+                                                      sumsfile, file_table))
+
+
+def add_packages(session, batch):
+    """batched variant of add_package: look up already checksummed packages
+    with a single query, and insert checksums of all other packages together
+
+    """
+    global conf
+    logging.debug('add-package batch of %d packages' % len(batch))
+
+    for (pkg, pkgdir, file_table) in batch:
+        add_package_fs(session, pkg, pkgdir, file_table)
+
+    if 'hooks.db' in conf['backends']:
+        package_ids = [db_storage.lookup_package_id(session, pkg['package'],
+                                                    pkg['version'])
+                       for (pkg, _pkgdir, _file_table) in batch]
+        # same ASSUMPTION as add_package
+        done = set(package_id for (package_id,) in
+                   session.query(Checksum.package_id)
+                          .filter(Checksum.package_id.in_(package_ids))
+                          .distinct())
+
+        def rows():
+            for (package_id, (pkg, pkgdir, file_table)) in \
+                    zip(package_ids, batch):
+                if package_id in done:
+                    continue
+                for params in _checksum_rows(session, package_id,
+                                             sums_path(pkgdir), file_table):
+                    yield params
+
+        _insert_checksums(session, rows())
 
 
 def rm_package(session, pkg, pkgdir, file_table):
@@ -125,10 +181,10 @@ def rm_package(session, pkg, pkgdir, file_table):
             os.unlink(sumsfile)
 
     if 'hooks.db' in conf['backends']:
-        db_package = db_storage.lookup_package(session, pkg['package'],
-                                               pkg['version'])
+        package_id = db_storage.lookup_package_id(session, pkg['package'],
+                                                  pkg['version'])
         session.query(Checksum) \
-               .filter_by(package_id=db_package.id) \
+               .filter_by(package_id=package_id) \
                .delete()
 
 
@@ -136,5 +192,7 @@ def init_plugin(debsources):
     global conf
     conf = debsources['config']
     debsources['subscribe']('add-package', add_package, title=MY_NAME)
+    debsources['subscribe']('add-package.batch', add_packages, title=MY_NAME)
+    debsources['subscribe']('add-package.fs', add_package_fs, title=MY_NAME)
     debsources['subscribe']('rm-package',  rm_package,  title=MY_NAME)
     debsources['declare_ext'](MY_EXT, MY_NAME)
@@ -17,11 +17,12 @@
 
 import logging
 import os
-import subprocess
 
 from sqlalchemy import sql
 
 from debsources import db_storage
+from debsources import fs_storage
+from debsources import watchdog
 
 from debsources.models import Ctag, File
 from debsources.consts import MAX_KEY_LENGTH
@@ -104,37 +105,45 @@ def parse_ctags(path):
                          (bad_tags - BAD_TAGS_THRESHOLD))
 
 
-def add_package(session, pkg, pkgdir, file_table):
+def add_package_fs(session, pkg, pkgdir, file_table):
+    """extract ctags from the sources in `pkgdir`, if not done before"""
     global conf
-    logging.debug('add-package %s' % pkg)
+    logging.debug('add-package (fs) %s' % pkg)
 
     ctagsfile = ctags_path(pkgdir)
-    ctagsfile_tmp = ctagsfile + '.new'
 
     if 'hooks.fs' in conf['backends']:
         if not os.path.exists(ctagsfile):  # extract tags only if needed
-            cmd = ['ctags'] + CTAGS_FLAGS + ['-o', ctagsfile_tmp]
-            # ASSUMPTION: will be run under pkgdir as CWD, which is needed to
-            # get relative paths right. The assumption is enforced by the
-            # updater
-            with open(os.devnull, 'w') as null:
-                subprocess.check_call(cmd, stderr=null)
-            os.rename(ctagsfile_tmp, ctagsfile)
+            with fs_storage.atomic_file(os.path.abspath(ctagsfile)) \
+                    as ctagsfile_tmp:
+                cmd = ['ctags'] + CTAGS_FLAGS + ['-o', ctagsfile_tmp]
+                # run under pkgdir as CWD, which is needed to get relative
+                # paths right
+                with open(os.devnull, 'w') as null:
+                    watchdog.check_call(cmd, stderr=null, cwd=pkgdir)
+
+
+def add_package(session, pkg, pkgdir, file_table):
+    global conf
+    logging.debug('add-package %s' % pkg)
+
+    ctagsfile = ctags_path(pkgdir)
+    add_package_fs(session, pkg, pkgdir, file_table)
 
     if 'hooks.db' in conf['backends']:
-        db_package = db_storage.lookup_package(session, pkg['package'],
-                                               pkg['version'])
+        package_id = db_storage.lookup_package_id(session, pkg['package'],
+                                                  pkg['version'])
         # poor man's cache for last <relpath, file_id>;
         # rely on the fact that ctags file are path-sorted
         curfile = {None: None}
         insert_q = sql.insert(Ctag.__table__)
         insert_params = []
-        if not session.query(Ctag).filter_by(package_id=db_package.id).first():
+        if not session.query(Ctag).filter_by(package_id=package_id).first():
             # ASSUMPTION: if *a* ctag of this package has already been added to
             # the db in the past, then *all* of them have, as additions are
             # part of the same transaction
             for tag in parse_ctags(ctagsfile):
-                params = ({'package_id': db_package.id,
+                params = ({'package_id': package_id,
                            'tag': tag['tag'],
                            # 'file_id': 	# will be filled below
                            'line': tag['line'],
@@ -151,7 +160,7 @@ def add_package(session, pkg, pkgdir, file_table):
                         params['file_id'] = curfile[relpath]
                     except KeyError:
                         file_ = session.query(File) \
-                                       .filter_by(package_id=db_package.id,
+                                       .filter_by(package_id=package_id,
                                                   path=relpath) \
                                        .first()
                         if not file_:
@@ -178,10 +187,10 @@ def rm_package(session, pkg, pkgdir, file_table):
             os.unlink(ctagsfile)
 
     if 'hooks.db' in conf['backends']:
-        db_package = db_storage.lookup_package(session, pkg['package'],
-                                               pkg['version'])
+        package_id = db_storage.lookup_package_id(session, pkg['package'],
+                                                  pkg['version'])
         session.query(Ctag) \
-               .filter_by(package_id=db_package.id) \
+               .filter_by(package_id=package_id) \
                .delete()
 
 
@@ -189,5 +198,6 @@ def init_plugin(debsources):
     global conf
     conf = debsources['config']
     debsources['subscribe']('add-package', add_package, title=MY_NAME)
+    debsources['subscribe']('add-package.fs', add_package_fs, title=MY_NAME)
     debsources['subscribe']('rm-package',  rm_package,  title=MY_NAME)
     debsources['declare_ext'](MY_EXT, MY_NAME)
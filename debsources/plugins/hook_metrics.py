@@ -17,9 +17,10 @@
 
 import logging
 import os
-import subprocess
 
 from debsources import db_storage
+from debsources import fs_storage
+from debsources import watchdog
 
 from debsources.models import Metric
 
@@ -40,22 +41,37 @@ def parse_metrics(path):
     return metrics
 
 
-def add_package(session, pkg, pkgdir, file_table):
+def add_package_fs(session, pkg, pkgdir, file_table):
+    """measure disk usage of `pkgdir`, if not done before, and return it
+
+    return None if the metric has not been computed by this invocation
+
+    """
     global conf
-    logging.debug('add-package %s' % pkg)
+    logging.debug('add-package (fs) %s' % pkg)
 
     metric_type = 'size'
     metric_value = None
     metricsfile = metricsfile_path(pkgdir)
-    metricsfile_tmp = metricsfile + '.new'
 
     if 'hooks.fs' in conf['backends']:
         if not os.path.exists(metricsfile):  # run du only if needed
             cmd = ['du', '--summarize', pkgdir]
-            metric_value = int(subprocess.check_output(cmd).split()[0])
-            with open(metricsfile_tmp, 'w') as out:
-                out.write('%s\t%d\n' % (metric_type, metric_value))
-            os.rename(metricsfile_tmp, metricsfile)
+            metric_value = int(watchdog.check_output(cmd).split()[0])
+            with fs_storage.atomic_file(metricsfile) as metricsfile_tmp:
+                with open(metricsfile_tmp, 'w') as out:
+                    out.write('%s\t%d\n' % (metric_type, metric_value))
+
+    return metric_value
+
+
+def add_package(session, pkg, pkgdir, file_table):
+    global conf
+    logging.debug('add-package %s' % pkg)
+
+    metric_type = 'size'
+    metricsfile = metricsfile_path(pkgdir)
+    metric_value = add_package_fs(session, pkg, pkgdir, file_table)
 
     if 'hooks.db' in conf['backends']:
         if metric_value is None:
@@ -86,10 +102,10 @@ def rm_package(session, pkg, pkgdir, file_table):
             os.unlink(metricsfile)
 
     if 'hooks.db' in conf['backends']:
-        db_package = db_storage.lookup_package(session, pkg['package'],
-                                               pkg['version'])
+        package_id = db_storage.lookup_package_id(session, pkg['package'],
+                                                  pkg['version'])
         session.query(Metric) \
-               .filter_by(package_id=db_package.id) \
+               .filter_by(package_id=package_id) \
                .delete()
 
 
@@ -97,5 +113,6 @@ def init_plugin(debsources):
     global conf
     conf = debsources['config']
     debsources['subscribe']('add-package', add_package, title=MY_NAME)
+    debsources['subscribe']('add-package.fs', add_package_fs, title=MY_NAME)
     debsources['subscribe']('rm-package',  rm_package,  title=MY_NAME)
     debsources['declare_ext'](MY_EXT, MY_NAME)
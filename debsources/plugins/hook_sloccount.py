@@ -21,6 +21,8 @@ import re
 import subprocess
 
 from debsources import db_storage
+from debsources import fs_storage
+from debsources import watchdog
 
 from debsources.models import SlocCount
 
@@ -39,7 +41,7 @@ def grep(args):
     """
     rc = None
     with open(os.devnull, 'w') as null:
-        rc = subprocess.call(['grep'] + args, stdout=null, stderr=null)
+        rc = watchdog.call(['grep'] + args, stdout=null, stderr=null)
     return (rc == 0)
 
 
@@ -71,26 +73,34 @@ def parse_sloccount(path):
     return slocs
 
 
-def add_package(session, pkg, pkgdir, file_table):
+def add_package_fs(session, pkg, pkgdir, file_table):
+    """run sloccount on `pkgdir`, if not done before"""
     global conf
-    logging.debug('add-package %s' % pkg)
+    logging.debug('add-package (fs) %s' % pkg)
 
     slocfile = slocfile_path(pkgdir)
-    slocfile_tmp = slocfile + '.new'
 
     if 'hooks.fs' in conf['backends']:
         if not os.path.exists(slocfile):  # run sloccount only if needed
-            try:
-                cmd = ['sloccount'] + SLOCCOUNT_FLAGS + [pkgdir]
-                with open(slocfile_tmp, 'w') as out:
-                    subprocess.check_call(cmd, stdout=out,
-                                          stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError:
-                if not grep(['^SLOC total is zero,', slocfile_tmp]):
-                    # rationale: sloccount fails when it can't find source code
-                    raise
-            finally:
-                os.rename(slocfile_tmp, slocfile)
+            cmd = ['sloccount'] + SLOCCOUNT_FLAGS + [pkgdir]
+            with fs_storage.atomic_file(slocfile) as slocfile_tmp:
+                try:
+                    with open(slocfile_tmp, 'w') as out:
+                        watchdog.check_call(cmd, stdout=out,
+                                            stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError:
+                    if not grep(['^SLOC total is zero,', slocfile_tmp]):
+                        # rationale: sloccount fails when it can't find source
+                        # code
+                        raise
+
+
+def add_package(session, pkg, pkgdir, file_table):
+    global conf
+    logging.debug('add-package %s' % pkg)
+
+    slocfile = slocfile_path(pkgdir)
+    add_package_fs(session, pkg, pkgdir, file_table)
 
     if 'hooks.db' in conf['backends']:
         slocs = parse_sloccount(slocfile)
@@ -116,10 +126,10 @@ def rm_package(session, pkg, pkgdir, file_table):
             os.unlink(slocfile)
 
     if 'hooks.db' in conf['backends']:
-        db_package = db_storage.lookup_package(session, pkg['package'],
-                                               pkg['version'])
+        package_id = db_storage.lookup_package_id(session, pkg['package'],
+                                                  pkg['version'])
         session.query(SlocCount) \
-               .filter_by(package_id=db_package.id) \
+               .filter_by(package_id=package_id) \
                .delete()
 
 
@@ -127,5 +137,7 @@ def init_plugin(debsources):
     global conf
     conf = debsources['config']
     debsources['subscribe']('add-package', add_package, title='sloccount')
+    debsources['subscribe']('add-package.fs', add_package_fs,
+                            title='sloccount')
     debsources['subscribe']('rm-package',  rm_package,  title='sloccount')
     debsources['declare_ext'](MY_EXT, MY_NAME)
@@ -204,6 +204,94 @@ def ctags(session, suite=None, areas=None):
     return _count(q)
 
 
+def _group_by_suite(q, areas=None, suites=None):
+    """restrict an aggregate query on packages, whose first column is
+    Suite.suite, to archive `areas` and to `suites` (if given) and group it by
+    suite
+
+    """
+    q = q.join(Suite)
+    if areas:
+        q = q.filter(Package.area.in_(areas))
+    if suites is not None:
+        q = q.filter(Suite.suite.in_(suites))
+    return q.group_by(Suite.suite)
+
+
+def disk_usage_by_suite(session, areas=None, suites=None):
+    """disk space used by extracted source packages, for all suites at once
+
+    return a suite-indexed dictionary, see disk_usage(); pass `suites` to
+    only compute it for some suites
+
+    """
+    logging.debug('compute disk usage for all suites...')
+    q = session.query(Suite.suite, sql_func.sum(Metric.value)) \
+               .select_from(Metric) \
+               .filter(Metric.metric == 'size') \
+               .join(Package)
+    return dict((suite, count or 0)
+                for (suite, count) in _group_by_suite(q, areas, suites))
+
+
+def source_packages_by_suite(session, areas=None, suites=None):
+    """(versioned) source package count, for all suites at once
+
+    return a suite-indexed dictionary, see source_packages()
+
+    """
+    logging.debug('count source packages for all suites...')
+    q = session.query(Suite.suite, sql_func.count(Package.id)) \
+               .select_from(Package)
+    return dict(_group_by_suite(q, areas, suites).all())
+
+
+def source_files_by_suite(session, areas=None, suites=None):
+    """source files count, for all suites at once
+
+    return a suite-indexed dictionary, see source_files()
+
+    """
+    logging.debug('count source files for all suites...')
+    q = session.query(Suite.suite, sql_func.count(Checksum.id)) \
+               .select_from(Checksum) \
+               .join(Package)
+    return dict(_group_by_suite(q, areas, suites).all())
+
+
+def sloccount_summary_by_suite(session, areas=None, suites=None):
+    """source lines of code (SLOCs), broken down per language, for all suites
+    at once
+
+    return a suite-indexed dictionary of language-indexed dictionaries, see
+    sloccount_summary()
+
+    """
+    logging.debug('sloccount summary for all suites...')
+    q = session.query(Suite.suite, SlocCount.language,
+                      sql_func.sum(SlocCount.count)) \
+               .select_from(SlocCount) \
+               .join(Package)
+    q = _group_by_suite(q, areas, suites).group_by(SlocCount.language)
+    summaries = {}
+    for (suite, language, count) in q:
+        summaries.setdefault(suite, {})[language] = count
+    return summaries
+
+
+def ctags_by_suite(session, areas=None, suites=None):
+    """ctags count, for all suites at once
+
+    return a suite-indexed dictionary, see ctags()
+
+    """
+    logging.debug('count ctags for all suites...')
+    q = session.query(Suite.suite, sql_func.count(Ctag.id)) \
+               .select_from(Ctag) \
+               .join(Package)
+    return dict(_group_by_suite(q, areas, suites).all())
+
+
 def _hist_size_sample(session, metric, interval, projection, suite=None):
     q = "\
       SELECT DISTINCT ON (%(projection)s) timestamp, %(metric)s AS VALUE \
@@ -22,6 +22,7 @@ import sqlalchemy.orm
 import subprocess
 
 
+from debsources import models
 from debsources.subprocess_workaround import subprocess_setup
 from debsources.tests.testdata import *  # NOQA
 
@@ -154,6 +155,8 @@ def db_setup(test_subj, dbname=TEST_DB_NAME, dbdump=TEST_DB_DUMP, echo=False):
     test_subj.db = sqlalchemy.create_engine(
         'postgresql:///' + dbname, echo=echo)
     pg_restore(dbname, dbdump)
+    # add tables missing from test dumps made with older DB schema versions
+    models.Base.metadata.create_all(test_subj.db)
     Session = sqlalchemy.orm.sessionmaker()
     test_subj.session = Session(bind=test_subj.db)
 
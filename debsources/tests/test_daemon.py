@@ -0,0 +1,117 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import istest
+from nose.plugins.attrib import attr
+
+from debsources import daemon
+from debsources import updater
+from debsources.tests.updater_testing import mk_conf
+
+
+@attr('infra')
+class MirrorWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(suffix='.debsources-test')
+        self.index = os.path.join(self.tmpdir, 'dists', 'sid', 'main',
+                                  'source', 'Sources.gz')
+        os.makedirs(os.path.dirname(self.index))
+        self.touch_index('foo')
+        self.watcher = daemon.MirrorWatcher(self.tmpdir, poll_interval=0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch_index(self, content):
+        with open(self.index, 'w') as f:
+            f.write(content)
+
+    @istest
+    def ignoresUnchangedMirror(self):
+        self.assertFalse(self.watcher.wait(0.05))
+
+    @istest
+    def detectsChangedIndexes(self):
+        self.touch_index('foobar')
+        self.assertTrue(self.watcher.wait(0.05))
+        self.assertFalse(self.watcher.wait(0.05))  # reported only once
+
+    @istest
+    def detectsNewIndexes(self):
+        os.makedirs(os.path.join(self.tmpdir, 'dists', 'jessie'))
+        self.assertFalse(self.watcher.wait(0.05))
+        new_index = os.path.join(self.tmpdir, 'dists', 'jessie', 'Sources.gz')
+        open(new_index, 'w').close()
+        self.assertTrue(self.watcher.wait(0.05))
+
+
+class StopDaemon(Exception):
+    pass
+
+
+class ScriptedWatcher(object):
+    """fake mirror watcher, answering wait() as told"""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+
+    def wait(self, timeout):
+        if not self.answers:
+            raise StopDaemon()
+        return self.answers.pop(0)
+
+
+@attr('infra')
+class DaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = mk_conf('/nonexistent')
+        self.conf['stages'] = updater.UPDATE_STAGES
+        self.runs = []
+        self.orig = (daemon._run_update, daemon.REFRESH_DEBOUNCE)
+
+        def run_update(conf, Session, stages):
+            self.runs.append(stages)
+            return True
+        daemon._run_update = run_update
+
+    def tearDown(self):
+        (daemon._run_update, daemon.REFRESH_DEBOUNCE) = self.orig
+
+    @istest
+    def updatesOnMirrorChanges(self):
+        daemon.REFRESH_DEBOUNCE = 0
+        # settle, changed, settle, then stop
+        watcher = ScriptedWatcher([False, True, False])
+        self.assertRaises(StopDaemon, daemon.run, self.conf, None, watcher)
+        refresh_stages = updater.UPDATE_STAGES - daemon.UPDATE_STAGES
+        self.assertEqual([daemon.UPDATE_STAGES, refresh_stages,
+                          daemon.UPDATE_STAGES, refresh_stages], self.runs)
+
+    @istest
+    def debouncesRefreshes(self):
+        # settle, changed, settle, then stop: refresh still not due
+        watcher = ScriptedWatcher([False, True, False])
+        self.assertRaises(StopDaemon, daemon.run, self.conf, None, watcher)
+        self.assertEqual([daemon.UPDATE_STAGES, daemon.UPDATE_STAGES],
+                         self.runs)
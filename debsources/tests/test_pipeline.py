@@ -0,0 +1,78 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from nose.tools import istest
+from nose.plugins.attrib import attr
+
+from debsources.pipeline import Pipeline
+
+
+@attr('infra')
+class PipelineTests(unittest.TestCase):
+
+    @istest
+    def processesAllItems(self):
+        stages = [('double', lambda n: n * 2, 3),
+                  ('incr', lambda n: n + 1, 2)]
+        pipeline = Pipeline(stages, maxsize=4)
+        results = list(pipeline.run(iter(range(100))))
+        self.assertItemsEqual([n * 2 + 1 for n in range(100)], results)
+
+    @istest
+    def dropsFailedItems(self):
+        def invert(n):
+            return 1 / n
+        pipeline = Pipeline([('invert', invert, 2)], maxsize=2)
+        results = list(pipeline.run([0, 1, 2, 4]))
+        self.assertItemsEqual([1, 0, 0], results)
+
+    @istest
+    def passesOnFailures(self):
+        def invert(n):
+            return 1 / n
+
+        def failed(name, n):
+            return (name, n)
+        pipeline = Pipeline([('invert', invert, 2), ('id', lambda n: n, 1)],
+                            maxsize=2, on_error=failed)
+        results = list(pipeline.run([0, 1, 2]))
+        self.assertItemsEqual([('invert', 0), 1, 0], results)
+
+    @istest
+    def boundsQueues(self):
+        def slow(n):
+            time.sleep(0.01)
+            return n
+        pipeline = Pipeline([('fast', lambda n: n, 2), ('slow', slow, 1)],
+                            maxsize=3)
+        list(pipeline.run(range(30)))
+        for stats in pipeline.queue_stats:
+            self.assertTrue(stats.max_depth <= 3)
+        slow_input = pipeline.queue_stats[1]
+        self.assertEqual(30, slow_input.samples)
+        self.assertTrue(slow_input.full_waits > 0)  # backpressure kicked in
+
+    @istest
+    def stopsOnConsumerAbort(self):
+        pipeline = Pipeline([('id', lambda n: n, 2)], maxsize=2)
+        results = pipeline.run(range(1000))
+        self.assertEqual(0, next(results))
+        results.close()
+        self.assertTrue(pipeline._aborted.is_set())
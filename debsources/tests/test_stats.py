@@ -39,12 +39,19 @@ class Stats(unittest.TestCase, DbTestFixture):
     def setUp(self):
         self.maxDiff = None
 
-    def assertSuiteCountsEqual(self, expected, query_method):
+    def assertSuiteCountsEqual(self, expected, query_method,
+                               grouped_query_method=None):
         for suite, expected_count in expected.iteritems():
             actual_count = query_method(self.session, suite=suite)
             self.assertEqual(expected_count, actual_count,
                              '%d != %d for suite %s' %
                              (expected_count, actual_count, suite))
+        if grouped_query_method:
+            actual = grouped_query_method(self.session)
+            for suite, expected_count in expected.iteritems():
+                self.assertEqual(expected_count, actual[suite],
+                                 '%d != %d for suite %s (grouped)' %
+                                 (expected_count, actual[suite], suite))
 
     @istest
     def diskUsagesMatchReferenceDb(self):
@@ -56,7 +63,8 @@ class Stats(unittest.TestCase, DbTestFixture):
             'experimental': 12968,
         }
         total_size = 136572
-        self.assertSuiteCountsEqual(sizes, statistics.disk_usage)
+        self.assertSuiteCountsEqual(sizes, statistics.disk_usage,
+                                    statistics.disk_usage_by_suite)
         self.assertEqual(total_size, statistics.disk_usage(self.session))
 
     @istest
@@ -70,7 +78,8 @@ class Stats(unittest.TestCase, DbTestFixture):
         }
         total_source_packages = 33
         self.assertSuiteCountsEqual(source_packages,
-                                    statistics.source_packages)
+                                    statistics.source_packages,
+                                    statistics.source_packages_by_suite)
         self.assertEqual(total_source_packages,
                          statistics.source_packages(self.session))
 
@@ -84,7 +93,8 @@ class Stats(unittest.TestCase, DbTestFixture):
             'experimental': 1396,
         }
         total_files = 6601
-        self.assertSuiteCountsEqual(source_files, statistics.source_files)
+        self.assertSuiteCountsEqual(source_files, statistics.source_files,
+                                    statistics.source_files_by_suite)
         self.assertEqual(total_files, statistics.source_files(self.session))
 
     @istest
@@ -115,6 +125,9 @@ class Stats(unittest.TestCase, DbTestFixture):
         self.assertEqual(slocs_jessie,
                          statistics.sloccount_summary(self.session,
                                                       suite='jessie'))
+        self.assertEqual(slocs_jessie,
+                         statistics.sloccount_summary_by_suite(
+                             self.session)['jessie'])
         self.assertEqual(slocs_python,
                          statistics.sloccount_lang(self.session, 'python'))
         self.assertEqual(slocs_cpp_exp,
@@ -131,9 +144,19 @@ class Stats(unittest.TestCase, DbTestFixture):
             'experimental': 17284,
         }
         total_ctags = 84576
-        self.assertSuiteCountsEqual(ctags, statistics.ctags)
+        self.assertSuiteCountsEqual(ctags, statistics.ctags,
+                                    statistics.ctags_by_suite)
         self.assertEqual(total_ctags, statistics.ctags(self.session))
 
+    @istest
+    def groupedCountsCanBeRestrictedToSuites(self):
+        ctags = statistics.ctags_by_suite(self.session,
+                                          suites=['jessie', 'experimental'])
+        self.assertEqual({'jessie': 23444, 'experimental': 17284}, ctags)
+        slocs = statistics.sloccount_summary_by_suite(self.session,
+                                                      suites=['jessie'])
+        self.assertEqual(['jessie'], slocs.keys())
+
     @istest
     def slocPerPkgMatchReferenceDb(self):
         LARGEST = ('gnubg', '1.02.000-2', 124353)
@@ -0,0 +1,80 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import istest
+from nose.plugins.attrib import attr
+
+from debsources import timings
+
+
+@attr('infra')
+class TimingsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = timings.Timings()
+        for (i, pkg) in enumerate(['foo/1', 'bar/2', 'baz/3']):
+            self.timings.add('package', 'add', pkg, i + 1., i + .5)
+            self.timings.add('hook', 'add-package/ctags', pkg, i + .1, i)
+        self.timings.add('stage', 'extract', None, 10., 5.)
+
+    @istest
+    def summarizesByActivity(self):
+        report = self.timings.report()
+        self.assertEqual([{'name': 'add', 'count': 3, 'wall': 6.,
+                           'cpu': 4.5, 'max_wall': 3.}],
+                         report['packages']['summary'])
+        self.assertEqual(['add-package/ctags'],
+                         [h['name'] for h in report['hooks']['summary']])
+        self.assertEqual(['extract'], [s['name'] for s in report['stages']])
+
+    @istest
+    def listsSlowestFirst(self):
+        report = self.timings.report(top=2)
+        self.assertEqual(['baz/3', 'bar/2'],
+                         [p['subject'] for p in report['packages']['slowest']])
+
+    @istest
+    def measuresAndMergesRecords(self):
+        worker_timings = timings.reset()
+        with timings.measure('hook', 'add-package.fs/sloccount', 'qux/4'):
+            pass
+        self.timings.merge(worker_timings.records)
+        self.assertEqual(4, len(self.timings.report()['hooks']['slowest']))
+
+    @istest
+    def measuresOnlyWallTimeOfConcurrentActivities(self):
+        with self.timings.measure('hook', 'add-package.fs/ctags', 'qux/4',
+                                  cpu=False):
+            pass
+        self.assertIsNone(self.timings.records[-1][4])
+        report = self.timings.report()
+        self.assertIsNone(report['hooks']['summary'][0]['cpu'])
+
+    @istest
+    def savesJsonReport(self):
+        tmpdir = tempfile.mkdtemp(suffix='.debsources-test')
+        try:
+            fname = os.path.join(tmpdir, 'timings.json')
+            self.timings.save_report(fname)
+            self.assertEqual(self.timings.report(), timings.load_report(fname))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -17,24 +17,31 @@
 
 import glob
 import logging
+import multiprocessing
 import os
 import shutil
 import sqlalchemy
 import subprocess
 import tempfile
+import time
 import unittest
 
+from datetime import datetime
 from nose.tools import istest
 from nose.plugins.attrib import attr
 
+from debsources import bluegreen
 from debsources import db_storage
+from debsources import journal
 from debsources import mainlib
 from debsources import models
 from debsources import statistics
 from debsources import updater
 
+from debsources.debmirror import SourcePackage
 from debsources.tests.db_testing import DbTestFixture, DB_COMPARE_QUERIES
-from debsources.tests.updater_testing import mk_conf
+from debsources.tests.updater_testing import mk_conf, mk_session, \
+    load_hooks, failing_add_package
 from debsources.subprocess_workaround import subprocess_setup
 from debsources.tests.testdata import *  # NOQA
 
@@ -119,18 +126,16 @@ class Updater(unittest.TestCase, DbTestFixture):
 
     TEST_STAGES = updater.UPDATE_STAGES - set([updater.STAGE_CHARTS])
 
-    def do_update(self, stages=TEST_STAGES):
+    def do_update(self, stages=TEST_STAGES, commit=False):
         """do a full update run in a virtual test environment"""
         mainlib.init_logging(self.conf, console_verbosity=logging.WARNING)
-        obs, exts = mainlib.load_hooks(self.conf)
-        self.conf['observers'], self.conf['file_exts'] = obs, exts
+        load_hooks(self.conf)
         updater.update(self.conf, self.session, stages)
+        if commit:  # mirror snapshots are saved only upon commit
+            self.session.commit()
 
-    @istest
-    def producesReferenceDb(self):
-        db_mv_tables_to_schema(self.session, 'ref')
-        self.do_update()
-
+    def assertReferenceStorage(self):
+        """check that both FS and DB storage match reference test data"""
         # sources/ dir comparison. Ignored patterns:
         # - plugin result caches -> because most of them are in os.walk()
         #   order, which is not stable
@@ -144,6 +149,110 @@ class Updater(unittest.TestCase, DbTestFixture):
 
         assert_db_schema_equal(self, 'ref', 'public')
 
+    @istest
+    def producesReferenceDb(self):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.do_update()
+        self.assertReferenceStorage()
+
+    @istest
+    def producesReferenceDbInParallel(self):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.conf['jobs'] = 4
+        self.do_update()
+        self.assertReferenceStorage()
+
+    def assertProducesReferenceDbWithWorkQueue(self, coordinator_works=True):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.session.commit()  # make reference data visible to workers
+        self.conf['work_queue'] = True
+        self.conf['single_transaction'] = False
+        load_hooks(self.conf)
+
+        def run_worker():
+            db = sqlalchemy.create_engine('postgresql:///' + self.dbname)
+            session = mk_session(db, autocommit=True)
+            updater.process_extraction_queue(self.conf, session,
+                                             idle_timeout=10)
+
+        poll_interval = updater.QUEUE_POLL_INTERVAL
+        run_extraction_job = updater._run_extraction_job
+        updater.QUEUE_POLL_INTERVAL = 0.1
+        workers = [multiprocessing.Process(target=run_worker)
+                   for _i in range(3)]
+        try:
+            for worker in workers:
+                worker.start()
+            if not coordinator_works:  # only wait for (forked) workers
+                updater._run_extraction_job = lambda *args: False
+            updater.update(self.conf, mk_session(self.db, autocommit=True),
+                           self.TEST_STAGES)
+        finally:
+            for worker in workers:
+                worker.join()
+            updater.QUEUE_POLL_INTERVAL = poll_interval
+            updater._run_extraction_job = run_extraction_job
+        self.assertEqual(0, self.session.query(models.ExtractionJob).count())
+        self.assertReferenceStorage()
+
+    @istest
+    def producesReferenceDbWithWorkQueue(self):
+        self.assertProducesReferenceDbWithWorkQueue()
+
+    @istest
+    def producesReferenceDbWithWorkQueueWorkersOnly(self):
+        self.assertProducesReferenceDbWithWorkQueue(coordinator_works=False)
+
+    @istest
+    def producesReferenceDbWithChunkedCommits(self):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.session.commit()
+        self.conf['commit_packages'] = 2
+        self.do_update()
+        self.assertReferenceStorage()
+
+    @istest
+    def producesReferenceDbWithHookBatches(self):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.conf['hook_batch_size'] = 2
+        self.do_update()
+        self.assertReferenceStorage()
+
+    @istest
+    def producesReferenceDbBlueGreen(self):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.session.commit()
+        bluegreen.prepare(mk_session(self.db))
+        staged = [name for (name,) in self.session.execute(
+            "SELECT tablename FROM pg_tables WHERE schemaname = '%s'"
+            % bluegreen.STAGING_SCHEMA)]
+        self.assertIn('packages', staged)
+        self.assertNotIn('files', staged)  # shared, not copied
+        self.session.commit()
+        staging_db = bluegreen.staging_engine('postgresql:///' + self.dbname)
+        staging_session = mk_session(staging_db)
+        mainlib.init_logging(self.conf, console_verbosity=logging.WARNING)
+        load_hooks(self.conf)
+        updater.update(self.conf, staging_session, self.TEST_STAGES)
+        staging_session.commit()
+        staging_session.close()
+        # live packages are untouched until the switch
+        self.assertEqual(0, self.session.query(models.Package).count())
+        self.session.commit()  # release locks, or the switch would wait
+
+        bluegreen.switch(mk_session(self.db))
+        self.assertReferenceStorage()
+
+    @istest
+    def discardsBlueGreenStaging(self):
+        self.do_update(commit=True)
+        bluegreen.prepare(mk_session(self.db))
+        bluegreen.discard(mk_session(self.db))
+        # shared tables refer to live tables again
+        self.session.execute('DELETE FROM packages')
+        self.assertEqual(0, self.session.query(models.File).count())
+        self.session.rollback()
+
     @istest
     def producesReferenceSourcesTxt(self):
         def parse_sources_txt(fname):
@@ -181,8 +290,7 @@ class Updater(unittest.TestCase, DbTestFixture):
         # check that the update recreate an identical DB
         assert_db_schema_equal(self, 'ref', 'public')
 
-    @istest
-    def garbageCollects(self):
+    def assertGarbageCollects(self, incremental=False, failing=False):
         GC_PACKAGE = ('ocaml-curses', '1.0.3-1')
         PKG_SUITE = 'squeeze'
         PKG_AREA = 'main'
@@ -196,6 +304,10 @@ class Updater(unittest.TestCase, DbTestFixture):
         shutil.copytree(orig_mirror, new_mirror)
         self.conf['mirror_dir'] = new_mirror
         self.conf['sources_dir'] = new_sources
+        if incremental:  # initial run, to get a mirror snapshot
+            self.do_update(commit=True)
+            self.assertTrue(os.path.exists(os.path.join(
+                self.conf['cache_dir'], 'mirror', 'snapshot.pickle')))
 
         pkgdir = os.path.join(new_sources, PKG_AREA, GC_PACKAGE[0][0],
                               GC_PACKAGE[0], GC_PACKAGE[1])
@@ -209,7 +321,7 @@ class Updater(unittest.TestCase, DbTestFixture):
         # update run that should not GC, due to timestamp
         os.utime(pkgdir, None)
         self.conf['expire_days'] = 3
-        self.do_update()
+        self.do_update(commit=incremental)
         self.assertTrue(os.path.exists(pkgdir),
                         'young gone package %s/%s disappeared from FS storage'
                         % GC_PACKAGE)
@@ -217,9 +329,26 @@ class Updater(unittest.TestCase, DbTestFixture):
                         'young gone package %s/%s disappeared from DB storage'
                         % GC_PACKAGE)
 
-        # another update run without grace period, package should go
         self.conf['expire_days'] = 0
-        self.do_update()
+        if failing:  # update run whose removals fail, package should stay
+            def crash(*args):
+                raise RuntimeError('simulated DB failure')
+            rm_packages = db_storage.rm_packages
+            db_storage.rm_packages = crash
+            try:
+                self.do_update(commit=incremental)
+            finally:
+                db_storage.rm_packages = rm_packages
+            self.assertTrue(db_storage.lookup_package(self.session,
+                                                      *GC_PACKAGE),
+                            'gone package %s/%s removed despite failure'
+                            % GC_PACKAGE)
+            self.assertTrue(os.path.exists(pkgdir),
+                            'gone package %s/%s removed from FS storage, '
+                            'but not from DB storage' % GC_PACKAGE)
+
+        # another update run without grace period, package should go
+        self.do_update(commit=incremental)
         self.assertFalse(os.path.exists(pkgdir),
                          'gone package %s/%s persisted in FS storage' %
                          GC_PACKAGE)
@@ -227,6 +356,166 @@ class Updater(unittest.TestCase, DbTestFixture):
                          'gone package %s/%s persisted in DB storage' %
                          GC_PACKAGE)
 
+    @istest
+    def garbageCollects(self):
+        self.assertGarbageCollects()
+
+    @istest
+    def garbageCollectsIncrementally(self):
+        self.assertGarbageCollects(incremental=True)
+
+    @istest
+    def retriesFailedGarbageCollection(self):
+        self.assertGarbageCollects(incremental=True, failing=True)
+
+    @istest
+    def keepsPackageIdsAcrossRollbacks(self):
+        PACKAGE = ('ocaml-curses', '1.0.3-1')
+        db_storage.preload_package_ids(self.session)
+        package_id = db_storage.lookup_package_id(self.session, *PACKAGE)
+        self.assertIsNotNone(package_id)
+        pkg = SourcePackage.from_db_fields(PACKAGE[0], PACKAGE[1], 'main')
+        load_package_ids = db_storage._load_package_ids
+        db_storage._load_package_ids = None  # must not be reloaded
+        try:
+            with self.session.begin_nested():
+                db_storage.rm_packages(self.session, [(pkg, package_id)])
+                self.assertIsNone(db_storage.lookup_package_id(self.session,
+                                                               *PACKAGE))
+                raise RuntimeError('simulated failure')
+        except RuntimeError:
+            self.assertEqual(package_id,
+                             db_storage.lookup_package_id(self.session,
+                                                          *PACKAGE))
+        finally:
+            db_storage._load_package_ids = load_package_ids
+
+    @istest
+    def plansUpdate(self):
+        # given DB is pre-filled, there should be nothing to do
+        update_plan = updater.plan(self.conf, self.session)
+        self.assertEqual(set(), update_plan.extract)
+        self.assertEqual(set(), update_plan.gc)
+
+        db_mv_tables_to_schema(self.session, 'ref')
+        update_plan = updater.plan(self.conf, self.session)
+        mirror = updater.SourceMirror(self.conf['mirror_dir'])
+        self.assertEqual(mirror.packages, update_plan.extract)
+        self.assertTrue(update_plan.extract_size > 0)
+        self.assertIsNone(update_plan.add_throughput)  # no previous runs
+        self.assertEqual(0, self.session.query(models.Package).count())
+
+    @istest
+    def resumesInterruptedUpdate(self):
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.conf['journal'] = True
+        journal_dir = os.path.join(self.conf['cache_dir'],
+                                   updater.JOURNAL_DIR)
+
+        def crash(*args):
+            raise RuntimeError('simulated crash')
+        update_statistics = updater.update_statistics
+        updater.update_statistics = crash
+        try:
+            self.assertRaises(RuntimeError, self.do_update)
+        finally:
+            updater.update_statistics = update_statistics
+        self.session.rollback()
+        self.assertTrue(os.path.isdir(journal_dir))
+
+        self.do_update()  # resume, from the stats stage on
+        self.assertFalse(os.path.exists(journal_dir))
+        self.assertReferenceStorage()
+
+    @istest
+    def skipsUnchangedMirror(self):
+        self.assertFalse(updater.up_to_date(self.conf, self.session,
+                                            self.TEST_STAGES))
+        self.do_update(commit=True)
+        fingerprint = os.path.join(self.conf['cache_dir'],
+                                   updater.UPDATE_FINGERPRINT)
+        self.assertTrue(os.path.exists(fingerprint))
+        self.assertTrue(updater.up_to_date(self.conf, self.session,
+                                           self.TEST_STAGES))
+
+        last_update = os.path.join(self.conf['cache_dir'], 'last-update')
+        os.unlink(last_update)
+
+        def crash(*args):
+            raise RuntimeError('unexpected update stage run')
+        update_statistics = updater.update_statistics
+        updater.update_statistics = crash
+        try:
+            self.do_update()  # nothing changed: no stage should run
+        finally:
+            updater.update_statistics = update_statistics
+        self.assertTrue(os.path.exists(last_update))
+
+    @istest
+    def skipsUnchangedMirrorUntilRetriesAreDue(self):
+        PKG = 'bsdgames-nonfree'
+        db_mv_tables_to_schema(self.session, 'ref')
+        with failing_add_package(PKG):
+            self.do_update(commit=True)
+        fingerprint = os.path.join(self.conf['cache_dir'],
+                                   updater.UPDATE_FINGERPRINT)
+        last_run = updater._load_update_fingerprint(fingerprint)
+        [entry] = updater.quarantine(self.session)
+        self.assertEqual(entry.retry_after, last_run['due'])
+
+        def crash(*args):
+            raise RuntimeError('unexpected update stage run')
+        update_statistics = updater.update_statistics
+        updater.update_statistics = crash
+        try:
+            self.do_update()  # quarantined package not due: nothing to do
+            last_run['due'] = datetime.utcnow()
+            updater._save_update_fingerprint(fingerprint, last_run)
+            self.assertRaises(RuntimeError, self.do_update)  # retry is due
+        finally:
+            updater.update_statistics = update_statistics
+
+    @istest
+    def quarantinesFailingPackages(self):
+        PKG = 'bsdgames-nonfree'
+        db_mv_tables_to_schema(self.session, 'ref')
+        with failing_add_package(PKG):
+            self.do_update()
+        entries = updater.quarantine(self.session)
+        self.assertEqual([PKG], [entry.package for entry in entries])
+        self.assertEqual('db', entries[0].stage)
+        self.assertIn('simulated failure', entries[0].error)
+        self.assertEqual(1, entries[0].attempts)
+        self.assertEqual(0, self.session.query(models.Package)
+                         .join(models.PackageName)
+                         .filter(models.PackageName.name == PKG).count())
+
+        self.do_update()  # quarantined: not retried
+        self.assertEqual(1, updater.quarantine(self.session)[0].attempts)
+
+        self.session.query(models.ExtractionFailure) \
+                    .update({'retry_after': entries[0].last_failure})
+        self.do_update()  # retry is due: package added, ledger cleared
+        self.assertEqual(0, self.session.query(models.ExtractionFailure)
+                         .count())
+        self.assertReferenceStorage()
+
+    @istest
+    def quarantinesFailingQueueJobsOnce(self):
+        PKG = 'bsdgames-nonfree'
+        db_mv_tables_to_schema(self.session, 'ref')
+        self.session.commit()
+        self.conf['work_queue'] = True
+        self.conf['single_transaction'] = False
+        load_hooks(self.conf)
+        with failing_add_package(PKG):
+            updater.update(self.conf, mk_session(self.db, autocommit=True),
+                           self.TEST_STAGES)
+        # retried within the run, but quarantined only once
+        entries = updater.quarantine(self.session)
+        self.assertEqual([PKG], [entry.package for entry in entries])
+        self.assertEqual(1, entries[0].attempts)
+
     @istest
     def excludeFiles(self):
         PKG = 'bsdgames-nonfree'
@@ -317,3 +606,309 @@ class MetadataCache(unittest.TestCase, DbTestFixture):
             'debian_squeeze.sloccount': 315750,
         }
         self.assertDictContainsSubset(expected_stats, self.stats)
+
+
+@attr('infra')
+class ShellHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(suffix='.debsources-test')
+        updater._shell_hooks_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        updater._shell_hooks_cache.clear()
+
+    def mk_hook(self, name, mode=0755):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(path, mode)
+        return path
+
+    @istest
+    def ignoresNonHooks(self):
+        self.mk_hook('.placeholder', 0644)
+        self.mk_hook('not-executable', 0644)
+        self.mk_hook('backup~')
+        os.mkdir(os.path.join(self.tmpdir, 'subdir'))
+        self.assertEqual([], updater._shell_hooks(self.tmpdir))
+
+    @istest
+    def listsHooksInOrder(self):
+        hooks = [self.mk_hook(name) for name in ['10_foo', '20-bar', 'baz']]
+        self.assertEqual(hooks, updater._shell_hooks(self.tmpdir))
+
+    @istest
+    def scansOnce(self):
+        self.assertEqual([], updater._shell_hooks(self.tmpdir))
+        self.mk_hook('late')
+        self.assertEqual([], updater._shell_hooks(self.tmpdir))
+
+
+@attr('infra')
+class ConcurrentPluginNotification(unittest.TestCase):
+
+    def mk_observers(self, *actions):
+        observers = updater.NO_OBSERVERS.copy()
+        observers['add-package.fs'] = [('hook%d' % i, action)
+                                       for (i, action) in enumerate(actions)]
+        return observers
+
+    @istest
+    def runsHooksConcurrently(self):
+        notified = []
+
+        def slow_hook(session, pkg, pkgdir, file_table):
+            time.sleep(0.2)
+            notified.append((session, pkg, pkgdir))
+        observers = self.mk_observers(*([slow_hook] * 4))
+        start = time.time()
+        updater.notify_plugins_concurrently(observers, 'add-package.fs',
+                                            'foo/1.0', '/srv/foo')
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual([(None, 'foo/1.0', '/srv/foo')] * 4, notified)
+
+    @istest
+    def raisesFailuresAfterAllHooks(self):
+        notified = []
+
+        def failing_hook(session, pkg, pkgdir, file_table):
+            raise RuntimeError('hook failure')
+
+        def slow_hook(session, pkg, pkgdir, file_table):
+            time.sleep(0.1)
+            notified.append(pkg)
+        observers = self.mk_observers(failing_hook, slow_hook)
+        self.assertRaises(RuntimeError, updater.notify_plugins_concurrently,
+                          observers, 'add-package.fs', 'foo/1.0', '/srv/foo')
+        self.assertEqual(['foo/1.0'], notified)
+
+
+@attr('infra')
+class ExtractionScheduling(unittest.TestCase):
+
+    class Mirror(object):
+        mirror_root = '/nonexistent'
+        suites = {'sid': [('foo', '2'), ('bar', '1')],
+                  'jessie': [('foo', '1'), ('baz', '1')]}
+
+    def setUp(self):
+        self.conf = mk_conf('/nonexistent')
+        sizes = {('foo', '1'): 300, ('foo', '2'): 200,
+                 ('bar', '1'): 100, ('baz', '1'): 100}
+        self.pkgs = []
+        for ((package, version), size) in sorted(sizes.items()):
+            pkg = SourcePackage({'package': package, 'version': version})
+            pkg['files'] = [{'md5sum': '', 'size': str(size),
+                             'name': '%s_%s.dsc' % (package, version)}]
+            self.pkgs.append(pkg)
+
+    def schedule(self, order, suites=[]):
+        self.conf['extract_order'] = updater.parse_extract_order(order)
+        self.conf['priority_suites'] = suites
+        return map(str, updater._schedule_extraction(self.conf, None,
+                                                     self.Mirror(),
+                                                     self.pkgs))
+
+    @istest
+    def keepsMirrorOrderByDefault(self):
+        self.assertEqual(['bar/1', 'baz/1', 'foo/1', 'foo/2'],
+                         self.schedule(''))
+
+    @istest
+    def ordersBySuitesThenSize(self):
+        self.assertEqual(['bar/1', 'foo/2', 'baz/1', 'foo/1'],
+                         self.schedule('suites size', ['sid']))
+        self.assertEqual(['baz/1', 'foo/1', 'bar/1', 'foo/2'],
+                         self.schedule('suites size', ['jessie', 'sid']))
+
+    @istest
+    def rejectsUnknownCriteria(self):
+        self.assertRaises(ValueError, updater.parse_extract_order, 'age')
+
+
+@attr('infra')
+class StageScheduling(unittest.TestCase):
+
+    class Session(object):
+        def get_bind(self):
+            return None
+
+    def run_stages(self, stages, concurrent, fail=None):
+        session = self.Session()
+        runs = []  # <event, stage, session> triples
+
+        def run_stage(stage, stage_session):
+            runs.append(('start', stage, stage_session is session))
+            # cache is quicker than stats, that it is run together with
+            time.sleep(0.05 if stage == updater.STAGE_CACHE else 0.2)
+            runs.append(('end', stage, stage_session is session))
+            if stage == fail:
+                raise RuntimeError('simulated failure')
+        updater._run_stages(stages, run_stage, session, concurrent)
+        return runs
+
+    @istest
+    def resolvesIndirectDependencies(self):
+        deps = updater._stage_dependencies(set([updater.STAGE_EXTRACT,
+                                                updater.STAGE_CACHE]))
+        self.assertEqual(set([updater.STAGE_EXTRACT]),
+                         deps[updater.STAGE_CACHE])
+
+    @istest
+    def runsStagesInOrder(self):
+        runs = self.run_stages(updater.UPDATE_STAGES, concurrent=False)
+        self.assertEqual([updater.STAGE_EXTRACT, updater.STAGE_SUITES,
+                          updater.STAGE_GC, updater.STAGE_STATS,
+                          updater.STAGE_CACHE, updater.STAGE_CHARTS],
+                         [stage for (event, stage, _main) in runs
+                          if event == 'start'])
+
+    @istest
+    def runsIndependentStagesConcurrently(self):
+        runs = self.run_stages(updater.UPDATE_STAGES, concurrent=True)
+        starts = [(stage, main) for (event, stage, main) in runs
+                  if event == 'start']
+        self.assertEqual([(updater.STAGE_EXTRACT, True),
+                          (updater.STAGE_SUITES, True),
+                          (updater.STAGE_GC, True)], starts[:3])
+        # started together, in any order
+        self.assertItemsEqual([(updater.STAGE_STATS, True),
+                               (updater.STAGE_CACHE, False)], starts[3:5])
+        # cache is done while stats run, charts only start after stats
+        self.assertLess(runs.index(('end', updater.STAGE_CACHE, False)),
+                        runs.index(('end', updater.STAGE_STATS, True)))
+        self.assertLess(runs.index(('end', updater.STAGE_STATS, True)),
+                        runs.index(('start', updater.STAGE_CHARTS, True)))
+
+    @istest
+    def stopsAfterFailures(self):
+        self.assertRaises(RuntimeError, self.run_stages,
+                          updater.UPDATE_STAGES, True, updater.STAGE_CACHE)
+
+
+@attr('infra')
+class ChunkedCommits(unittest.TestCase):
+
+    class Session(object):
+        def __init__(self):
+            self.commits = 0
+            self.expunged = 0
+
+        def commit(self):
+            self.commits += 1
+
+        def expunge_all(self):
+            self.expunged += 1
+
+    def setUp(self):
+        self.conf = mk_conf('/nonexistent')
+        self.conf['single_transaction'] = True
+        self.session = self.Session()
+
+    @istest
+    def commitsEveryNPackages(self):
+        self.conf['commit_packages'] = 3
+        chunks = updater.ChunkedCommits(self.conf, self.session)
+        done = [chunks.packages_done() for _i in range(7)]
+        self.assertEqual([False, False, True] * 2 + [False], done)
+        self.assertEqual(2, self.session.commits)
+        self.assertEqual(2, self.session.expunged)
+
+    @istest
+    def commitsEveryTSeconds(self):
+        self.conf['commit_interval'] = 60
+        chunks = updater.ChunkedCommits(self.conf, self.session)
+        self.assertFalse(chunks.packages_done())
+        chunks.last_commit -= 60
+        self.assertTrue(chunks.packages_done())
+        self.assertFalse(chunks.packages_done())
+
+    @istest
+    def neverCommitsByDefault(self):
+        chunks = updater.ChunkedCommits(self.conf, self.session)
+        self.assertFalse(chunks.packages_done(1000))
+        self.conf['commit_packages'] = 1
+        self.conf['single_transaction'] = False  # already committing
+        chunks = updater.ChunkedCommits(self.conf, self.session)
+        self.assertFalse(chunks.packages_done())
+        self.assertEqual(0, self.session.commits)
+
+
+@attr('infra')
+class UpdateJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(suffix='.debsources-test')
+        self.journal_dir = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @istest
+    def ignoresTruncatedPackages(self):
+        j = journal.UpdateJournal(self.journal_dir)
+        j.packages_committed([('foo', '1.0'), ('bar', '2.0')])
+        with open(j._packages_file, 'a') as f:
+            f.write('baz\t3.0')  # crash while writing, before the newline
+        j = journal.UpdateJournal(self.journal_dir)
+        self.assertTrue(j.resumed)
+        self.assertEqual(set([('foo', '1.0'), ('bar', '2.0')]), j.packages)
+
+        j.packages_committed([('qux', '4.0')])
+        j = journal.UpdateJournal(self.journal_dir)
+        self.assertEqual(set([('foo', '1.0'), ('bar', '2.0'), ('qux', '4.0')]),
+                         j.packages)
+
+
+@attr('infra')
+class BatchedPluginNotification(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = mk_conf('/nonexistent')
+        self.conf['observers'] = updater.NO_OBSERVERS.copy()
+
+    def subscribe_batch_hook(self):
+        self.notified = []
+
+        def batch_hook(session, batch):
+            self.notified.append([pkg for (pkg, _dir, _table) in batch])
+        self.conf['observers']['add-package.batch'] = [('hook', batch_hook)]
+
+    @istest
+    def batchesOnlyWithBatchHooks(self):
+        self.conf['hook_batch_size'] = 3
+        batches = list(updater._hook_batches(self.conf, range(5)))
+        self.assertEqual([[0], [1], [2], [3], [4]], batches)
+        self.subscribe_batch_hook()
+        batches = list(updater._hook_batches(self.conf, range(5)))
+        self.assertEqual([[0, 1, 2], [3, 4]], batches)
+
+    @istest
+    def batchesOnlyIfEnabled(self):
+        self.subscribe_batch_hook()
+        batches = list(updater._hook_batches(self.conf, range(3)))
+        self.assertEqual([[0], [1], [2]], batches)
+
+    @istest
+    def notifiesBatches(self):
+        self.subscribe_batch_hook()
+        batch = [('foo/1.0', '/srv/foo', None), ('bar/2.0', '/srv/bar', {})]
+        updater.notify_batch(self.conf['observers'], 'add-package', None,
+                             batch)
+        self.assertEqual([['foo/1.0', 'bar/2.0']], self.notified)
+
+    @istest
+    def skipsBatchHooksPerPackage(self):
+        notified = []
+
+        def hook(session, pkg, pkgdir, file_table):
+            notified.append(pkg)
+        self.conf['observers']['add-package'] = [('hook', hook)]
+        updater.notify_plugins(self.conf['observers'], 'add-package', None,
+                               'foo/1.0', '/srv/foo', skip=set(['hook']))
+        self.assertEqual([], notified)
+        updater.notify_plugins(self.conf['observers'], 'add-package', None,
+                               'foo/1.0', '/srv/foo')
+        self.assertEqual(['foo/1.0'], notified)
@@ -0,0 +1,118 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from nose.tools import istest
+from nose.plugins.attrib import attr
+
+from debsources import watchdog
+from debsources.plugins import hook_sloccount
+from debsources.excepts import ResourceLimitExceeded
+
+
+def limits(timeout=0, max_size=0, max_files=0, budget=None):
+    return watchdog.package_limits({'package_timeout': timeout,
+                                    'package_max_size': max_size,
+                                    'package_max_files': max_files},
+                                   budget)
+
+
+@attr('infra')
+class WatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(suffix='.debsources-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @istest
+    def runsWithinLimits(self):
+        with limits(timeout=60, max_size=1, max_files=10):
+            self.assertEqual('foo\n', watchdog.check_output(['echo', 'foo']))
+            self.assertEqual(1, watchdog.call(['false']))
+            self.assertRaises(subprocess.CalledProcessError,
+                              watchdog.check_call, ['false'])
+
+    @istest
+    def killsSlowSubprocesses(self):
+        start = time.time()
+        with limits(timeout=1):
+            self.assertRaises(ResourceLimitExceeded, watchdog.check_call,
+                              ['sh', '-c', 'sleep 30 & sleep 30'])
+            self.assertRaises(ResourceLimitExceeded, watchdog.check)
+        self.assertLess(time.time() - start, 10)
+        watchdog.check()  # limits are over
+
+    @istest
+    def sharesTimeoutAcrossBlocks(self):
+        with limits(timeout=60):
+            time.sleep(0.1)
+            budget = watchdog.remaining()
+        self.assertLessEqual(budget, 59.9)
+        with limits(timeout=60, budget=0):
+            self.assertRaises(ResourceLimitExceeded, watchdog.check)
+        with limits(budget=0):  # no timeout configured: no time limit
+            self.assertIsNone(watchdog.remaining())
+
+    @istest
+    def capsFileSize(self):
+        big_file = os.path.join(self.tmpdir, 'big')
+        with limits(max_size=1):
+            self.assertRaises(ResourceLimitExceeded, watchdog.check_call,
+                              ['dd', 'if=/dev/zero', 'of=' + big_file,
+                               'bs=1M', 'count=2'],
+                              stderr=open(os.devnull, 'w'))
+        self.assertLessEqual(os.path.getsize(big_file), 1024 * 1024)
+
+    @istest
+    def capsFileCount(self):
+        with limits(max_files=5):
+            self.assertRaises(ResourceLimitExceeded, watchdog.check_call,
+                              ['touch', '1', '2', '3', '4', '5', '6'],
+                              cwd=self.tmpdir, watch_dir=self.tmpdir)
+
+    @istest
+    def leavesNoPartialHookResults(self):
+        # fake sloccount, killed after having written part of its output
+        bin_dir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bin_dir)
+        sloccount = os.path.join(bin_dir, 'sloccount')
+        with open(sloccount, 'w') as f:
+            f.write('#!/bin/sh\necho "Totals grouped by language"\nsleep 30\n')
+        os.chmod(sloccount, 0755)
+        pkgdir = os.path.join(self.tmpdir, 'foo-1.0')
+        os.mkdir(pkgdir)
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        hook_sloccount.conf = {'backends': set(['hooks.fs'])}
+        try:
+            with limits(timeout=1):
+                self.assertRaises(ResourceLimitExceeded,
+                                  hook_sloccount.add_package_fs,
+                                  None, 'foo/1.0', pkgdir, None)
+        finally:
+            os.environ['PATH'] = path
+            hook_sloccount.conf = None
+        self.assertEqual(['bin', 'foo-1.0'], sorted(os.listdir(self.tmpdir)))
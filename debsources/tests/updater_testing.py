@@ -3,9 +3,13 @@
 # This file is part of Debsources.
 
 import os
+import sqlalchemy
 
+from contextlib import contextmanager
 from os.path import abspath
 
+from debsources import db_storage
+from debsources import mainlib
 from debsources.tests.testdata import *  # NOQA
 
 
@@ -29,6 +33,46 @@ def mk_conf(tmpdir):
         'backends': set(['hooks.fs', 'hooks', 'fs', 'db', 'hooks.db']),
         'root_dir': abspath(os.path.join(TEST_DIR, '../..')),
         'sources_dir': os.path.join(tmpdir, 'sources'),
-        'exclude': [],
+        'exclude': {},
+        'jobs': 1,
+        'gc_batch_size': 1000,
+        'hook_batch_size': 0,
+        'journal': False,
+        'commit_packages': 0,
+        'commit_interval': 0,
+        'work_queue': False,
+        'blue_green': False,
+        'extract_order': [],
+        'priority_suites': ['sid', 'testing'],
+        'package_timeout': 0,
+        'package_max_size': 0,
+        'package_max_files': 0,
     }
     return conf
+
+
+def load_hooks(conf):
+    """load hooks into the updater configuration `conf`"""
+    conf['observers'], conf['file_exts'] = mainlib.load_hooks(conf)
+
+
+def mk_session(bind, autocommit=False):
+    """return a new DB session bound to `bind`, e.g. a DB engine"""
+    Session = sqlalchemy.orm.sessionmaker()
+    return Session(bind=bind, autocommit=autocommit)
+
+
+@contextmanager
+def failing_add_package(package):
+    """make the addition of `package` to the DB fail, within the context"""
+    add_package = db_storage.add_package
+
+    def fail(session, pkg, *args, **kwargs):
+        if pkg['package'] == package:
+            raise RuntimeError('simulated failure')
+        return add_package(session, pkg, *args, **kwargs)
+    db_storage.add_package = fail
+    try:
+        yield
+    finally:
+        db_storage.add_package = add_package
@@ -0,0 +1,181 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""record wall and CPU time of update activities, and report about them
+
+activities are recorded as <kind, name, subject, wall, cpu> tuples, where kind
+is one of "stage", "package", "hook", e.g.:
+
+- <"stage", "extract", None, ...>
+- <"package", "add", "foo/1.0-1", ...>
+- <"hook", "add-package/sloccount", "foo/1.0-1", ...>
+
+CPU time includes the time spent by (terminated) child processes, e.g.
+dpkg-source or external analysis tools. As it is measured process-wide, it is
+not recorded (i.e. it is None) for activities run concurrently with others in
+the same process, e.g. hooks run in parallel threads.
+
+"""
+
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+
+# number of entries in the "slowest" lists of timing reports
+REPORT_TOP = 20
+
+
+def _cpu_time():
+    (user, system, children_user, children_system, _elapsed) = os.times()
+    return user + system + children_user + children_system
+
+
+class Timings(object):
+    """a collection of activity timings"""
+
+    def __init__(self):
+        self.started = datetime.utcnow()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, subject, wall, cpu):
+        with self._lock:
+            self.records.append((kind, name, subject, wall, cpu))
+
+    def merge(self, records):
+        """add `records` obtained from another collection, e.g. one filled by
+        a worker process
+
+        """
+        with self._lock:
+            self.records.extend(records)
+
+    @contextmanager
+    def measure(self, kind, name, subject=None, cpu=True):
+        """record the time spent executing the body of the context manager;
+        unset `cpu` to record only wall time, e.g. when other activities run
+        concurrently in the same process
+
+        """
+        wall, start_cpu = time.time(), _cpu_time() if cpu else None
+        try:
+            yield
+        finally:
+            self.add(kind, name, subject, time.time() - wall,
+                     _cpu_time() - start_cpu if cpu else None)
+
+    def report(self, top=REPORT_TOP):
+        """summarize recorded timings as a (JSON-serializable) dictionary"""
+        def entry(record):
+            (_kind, name, subject, wall, cpu) = record
+            return {'name': name, 'subject': subject, 'wall': wall, 'cpu': cpu}
+
+        def slowest(records):
+            by_wall = sorted(records, key=lambda r: r[3], reverse=True)
+            return map(entry, by_wall[:top])
+
+        by_kind = defaultdict(list)
+        for record in self.records:
+            by_kind[record[0]].append(record)
+
+        totals = defaultdict(lambda: {'count': 0, 'wall': 0., 'cpu': 0.,
+                                      'max_wall': 0.})
+        for (kind, name, _subject, wall, cpu) in by_kind['package'] + \
+                by_kind['hook']:
+            total = totals[(kind, name)]
+            total['count'] += 1
+            total['wall'] += wall
+            if cpu is None or total['cpu'] is None:
+                total['cpu'] = None  # unknown for some records
+            else:
+                total['cpu'] += cpu
+            total['max_wall'] = max(total['max_wall'], wall)
+
+        def summary(kind):
+            return [dict(totals[(k, name)], name=name)
+                    for (k, name) in sorted(totals) if k == kind]
+
+        return {
+            'started': self.started.isoformat(),
+            'stages': map(entry, by_kind['stage']),
+            'packages': {
+                'summary': summary('package'),
+                'slowest': slowest(by_kind['package']),
+            },
+            'hooks': {
+                'summary': summary('hook'),
+                'slowest': slowest(by_kind['hook']),
+            },
+        }
+
+    def save_report(self, fname, top=REPORT_TOP):
+        """save timing report to file `fname`, atomically, as JSON"""
+        with open(fname + '.new', 'w') as out:
+            json.dump(self.report(top), out, indent=2, sort_keys=True)
+        os.rename(fname + '.new', fname)
+
+
+# current collection of timings, see reset()
+_timings = Timings()
+
+
+def reset():
+    """start a new collection of timings, and return it"""
+    global _timings
+    _timings = Timings()
+    return _timings
+
+
+def current():
+    """return the current collection of timings"""
+    return _timings
+
+
+def measure(kind, name, subject=None, cpu=True):
+    """context manager that records, into the current timing collection, the
+    time spent executing its body, see Timings.measure()
+
+    """
+    return _timings.measure(kind, name, subject, cpu)
+
+
+def timed(kind, name):
+    """decorator that records the time spent by each invocation of the
+    decorated function. The string representation of the first function
+    argument is used as subject
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with measure(kind, name, str(args[0]) if args else None):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_report(fname):
+    """load a timing report saved by Timings.save_report()"""
+    with open(fname) as f:
+        return json.load(f)
@@ -15,39 +15,112 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import cPickle as pickle
+import fnmatch
 import glob
+import hashlib
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
+import Queue
+import re
+import socket
 import string
 import subprocess
+import sys
+import threading
+import time
+import traceback
 
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from email.utils import formatdate
-from sqlalchemy import sql, not_
+from sqlalchemy import event, func, sql, not_
+from sqlalchemy.orm import sessionmaker
 
 from debsources import charts
 from debsources import db_storage
 from debsources import fs_storage
 from debsources import statistics
+from debsources import timings
+from debsources import watchdog
 
 from debsources.consts import DEBIAN_RELEASES, SLOCCOUNT_LANGUAGES
 from debsources.debmirror import SourceMirror, SourcePackage
-from debsources.models import SuiteInfo, Suite, Package, \
-    HistorySize, HistorySlocCount
+from debsources.journal import UpdateJournal
+from debsources.pipeline import Pipeline
+from debsources.models import SuiteInfo, Suite, Package, PackageName, \
+    HistorySize, HistorySlocCount, ExtractionJob, ExtractionFailure
 from debsources.subprocess_workaround import subprocess_setup
 
 KNOWN_EVENTS = ['add-package', 'rm-package']
-NO_OBSERVERS = dict([(e, []) for e in KNOWN_EVENTS])
+# FS-only variants of KNOWN_EVENTS. Their hooks are notified with session=None
+# and must only act on the file system storage; as such they can be run before
+# packages hit the DB, e.g. from parallel worker processes
+FS_EVENTS = ['add-package.fs']
+# batched variants of KNOWN_EVENTS, notified once for several packages, see
+# notify_batch()
+BATCH_EVENTS = ['add-package.batch']
+NO_OBSERVERS = dict([(e, []) for e in KNOWN_EVENTS + FS_EVENTS + BATCH_EVENTS])
 
 # maximum number of pending rows before performing a (bulk) insert
 BULK_FLUSH_THRESHOLD = 50000
 
+# size of the queues between parallel extraction stages, as a multiple of the
+# number of jobs
+PIPELINE_QUEUE_FACTOR = 2
+
+# timing report of the last update run, relative to cache_dir
+TIMINGS_REPORT = 'update-timings.json'
+
+# how often (in seconds) idle work queue users check for new or released jobs
+QUEUE_POLL_INTERVAL = 5
+
+# how long (in seconds) work queue workers wait for jobs to show up, before
+# giving up
+QUEUE_IDLE_TIMEOUT = 300
+
+# how many times extraction jobs are tried before giving up on them
+QUEUE_MAX_ATTEMPTS = 3
+
+# how long packages that failed to be added are quarantined, i.e. not
+# retried, after their first failure; the delay doubles at each further
+# failure, up to QUARANTINE_MAX_DELAY. See quarantine_package()
+QUARANTINE_DELAY = timedelta(hours=6)
+QUARANTINE_MAX_DELAY = timedelta(days=28)
+
+# max length of the error messages recorded in the failure ledger
+FAILURE_ERROR_MAX_LEN = 4096
+
+# criteria that can be used to order the extraction of new packages, see
+# _schedule_extraction()
+EXTRACT_ORDER_CRITERIA = ['suites', 'size', 'known']
+
+# fingerprint of mirror and DB at the end of the last update run, relative to
+# cache_dir
+UPDATE_FINGERPRINT = 'update-fingerprint.pickle'
+
+# journal of the ongoing update run, relative to cache_dir
+JOURNAL_DIR = 'journal'
+
+# number of added packages after which, when journaling, DB changes are
+# committed and recorded in the journal
+JOURNAL_BATCH_SIZE = 100
+
 
 class UpdateStatus(object):
     """store update status during update runs"""
 
     def __init__(self):
         self._sources = {}
+        # mirror changes since last update run, as a pair <added, removed> of
+        # sets of <package, version> pairs; None if unknown (full update)
+        self.mirror_delta = None
+        self.failed = set()    # <package, version> pairs that failed to add
+        self.retained = set()  # gone <package, version> pairs, not yet GC'd
+        self.rm_failed = set()  # gone <package, version> pairs, GC failed
+        self.retained_until = None  # when the first retained package expires
 
     @property
     def sources(self):
@@ -64,10 +137,65 @@ class UpdateStatus(object):
         self._sources = new_sources
 
 
+# names of shell hooks that are run, same as run-parts(8) default
+SHELL_HOOK_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+$')
+
+# memoized shell hooks, mapping hook directories to lists of scripts
+_shell_hooks_cache = {}
+
+
+def _shell_hooks(hooks_dir):
+    """return the list of shell hooks found in `hooks_dir`, in the order they
+    should be run
+
+    like run-parts(8), only consider executable regular files, whose names
+    match SHELL_HOOK_NAME_RE, in lexical order. Hook directories are scanned
+    only once, hooks added later on are ignored until the next update run
+
+    """
+    if hooks_dir not in _shell_hooks_cache:
+        hooks = []
+        if os.path.isdir(hooks_dir):
+            for name in sorted(os.listdir(hooks_dir)):
+                path = os.path.join(hooks_dir, name)
+                if SHELL_HOOK_NAME_RE.match(name) and \
+                   os.path.isfile(path) and \
+                   os.access(path, os.X_OK):
+                    hooks.append(path)
+        _shell_hooks_cache[hooks_dir] = hooks
+    return _shell_hooks_cache[hooks_dir]
+
+
+def _tag_failure(activity):
+    """tag the exception being handled as raised by update `activity` (e.g.
+    a hook), unless it has been tagged already by a more specific one
+
+    """
+    exc = sys.exc_info()[1]
+    if exc is not None and not hasattr(exc, 'debsources_activity'):
+        try:
+            exc.debsources_activity = activity
+        except AttributeError:  # e.g. built-in exception types
+            pass
+
+
+def _failure(activity):
+    """describe the exception being handled, raised while doing update
+    `activity` (unless tagged otherwise by `_tag_failure`), as an <activity,
+    error> pair, suitable for `quarantine_package`
+
+    """
+    (exc_type, exc, _tb) = sys.exc_info()
+    activity = getattr(exc, 'debsources_activity', activity)
+    error = traceback.format_exception_only(exc_type, exc)[-1].strip()
+    return (activity, error[:FAILURE_ERROR_MAX_LEN])
+
+
 # TODO fill tables: BinaryPackage, BinaryVersion
 # TODO get rid of shell hooks; they shall die a horrible death
 
-def notify(conf, event, session, pkg, pkgdir, file_table=None):
+def notify(conf, event, session, pkg, pkgdir, file_table=None,
+           fs_hooks=True, batched=False):
     """notify (Python and shell) hooks of occurred events
 
     Currently supported events:
@@ -97,52 +225,151 @@ def notify(conf, event, session, pkg, pkgdir, file_table=None):
       If None, the hook will have to redo the scanning work.
 
     Shell hoks re invoked with the following arguments: pkgdir, package name,
-    package version
+    package version. They are the executables found in the bin/EVENT.d/
+    directory (see _shell_hooks()), run one after the other until the first
+    failure, like run-parts(8) --exit-on-error would do
+
+    If `fs_hooks` is set, Python hooks subscribed to the FS-only variant of
+    `event` (if any, see FS_EVENTS) are run concurrently before the others,
+    which will then find FS-side work already done. Unset it if that has
+    happened before, e.g. in an extraction worker.
+
+    If `batched` is set, Python hooks that are also subscribed to the batched
+    variant of `event` (see BATCH_EVENTS) are skipped, as they will be
+    notified later about a batch of packages, see notify_batch().
 
     """
     logging.debug('notify %s for %s' % (event, pkg))
-    package, version = pkg['package'], pkg['version']
-    cmd = ['run-parts', '--exit-on-error',
-           '--arg', pkgdir,
-           '--arg', package,
-           '--arg', version,
-           os.path.join(conf['bin_dir'], event + '.d')]
+    args = [pkgdir, pkg['package'], pkg['version']]
 
     # fire shell hooks
-    try:
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT,
-                                preexec_fn=subprocess_setup)
-    except subprocess.CalledProcessError, e:
-        logging.error('shell hooks for %s on %s returned exit code %d.'
-                      ' Output: %s'
-                      % (event, pkg, e.returncode, e.output))
-        raise e
-
+    hooks = _shell_hooks(os.path.join(conf['bin_dir'], event + '.d'))
+    for hook in hooks:
+        try:
+            with timings.measure('hook', event + '/shell', str(pkg)):
+                watchdog.check_output([hook] + args,
+                                      stderr=subprocess.STDOUT,
+                                      preexec_fn=subprocess_setup)
+        except subprocess.CalledProcessError, e:
+            logging.error('shell hook %s for %s on %s returned exit code %d.'
+                          ' Output: %s'
+                          % (os.path.basename(hook), event, pkg,
+                             e.returncode, e.output))
+            _tag_failure(event + '/' + os.path.basename(hook))
+            raise e
+
+    if fs_hooks and event + '.fs' in FS_EVENTS:
+        notify_plugins_concurrently(conf['observers'], event + '.fs', pkg,
+                                    pkgdir, file_table=file_table)
+    skip = set()
+    if batched and event + '.batch' in BATCH_EVENTS:
+        skip = set(title for (title, _action)
+                   in conf['observers'][event + '.batch'])
     notify_plugins(conf['observers'], event, session, pkg, pkgdir,
-                   file_table=file_table)
+                   file_table=file_table, skip=skip)
 
 
 def notify_plugins(observers, event, session, pkg, pkgdir,
-                   triggers=None, dry=False, file_table=None):
+                   triggers=None, dry=False, file_table=None, skip=()):
     """notify Python hooks of occurred events
 
     If triggers is not None, only Python hooks whose names are listed in them
     will be triggered. Note: shell hooks will not be triggered in that case.
+    Hooks whose names are listed in skip are not triggered.
+
+    Hooks subscribed to FS_EVENTS are notified with session=None and must only
+    act on the file system storage.
     """
     for (title, action) in observers[event]:
+        if title in skip:
+            continue
         try:
+            watchdog.check()
             if triggers is None:
-                action(session, pkg, pkgdir, file_table)
+                with timings.measure('hook', event + '/' + title, str(pkg)):
+                    action(session, pkg, pkgdir, file_table)
             elif (event, title) in triggers:
                 logging.info('notify (forced) %s/%s for %s'
                              % (event, title, pkg))
                 if not dry:
-                    action(session, pkg, pkgdir, file_table)
+                    with timings.measure('hook', event + '/' + title,
+                                         str(pkg)):
+                        action(session, pkg, pkgdir, file_table)
         except:
             logging.error('plugin hooks for %s on %s failed' % (event, pkg))
+            _tag_failure(event + '/' + title)
             raise
 
 
+def notify_batch(observers, event, session, batch):
+    """notify Python hooks subscribed to the batched variant of `event` (one
+    of BATCH_EVENTS) about a batch of packages
+
+    batch hooks are passed the DB session and `batch`, a list of <pkg,
+    pkgdir, file_table> triples, with the same meaning as the arguments of
+    per-package hooks, see notify(). They can hence amortize DB lookups and
+    inserts over several packages. Plugins subscribing to a batched event
+    must also subscribe to the per-package one, that is notified when
+    batching is not possible (e.g. forced triggers, work queue)
+
+    """
+    for (title, action) in observers[event + '.batch']:
+        try:
+            with timings.measure('hook', event + '.batch/' + title,
+                                 '%d packages' % len(batch)):
+                action(session, batch)
+        except:
+            logging.error('plugin hooks for %s on %d packages failed'
+                          % (event, len(batch)))
+            _tag_failure(event + '.batch/' + title)
+            raise
+
+
+def notify_plugins_concurrently(observers, event, pkg, pkgdir,
+                                file_table=None):
+    """notify Python hooks of an FS-only event (one of FS_EVENTS), running
+    them concurrently, one thread per hook, and return when they are all done
+
+    FS-only hooks are independent from each other (they only act on their own
+    files in the FS storage), and mostly wait on I/O or child processes, so
+    that a package is analyzed in about the time of its slowest hook. Hooks
+    are notified with session=None. If some hooks fail, the first failure is
+    re-raised, after all hooks are done
+
+    CPU time is only measured process-wide: it is hence not recorded for
+    hooks run concurrently, as each one would be charged for the others too
+
+    """
+    failures = []
+    concurrent = len(observers[event]) > 1
+
+    def run(title, action):
+        try:
+            with timings.measure('hook', event + '/' + title, str(pkg),
+                                 cpu=not concurrent):
+                action(None, pkg, pkgdir, file_table)
+        except:
+            logging.exception('plugin hook %s/%s on %s failed'
+                              % (event, title, pkg))
+            _tag_failure(event + '/' + title)
+            failures.append(sys.exc_info())
+
+    if not concurrent:  # no need for threads
+        for observer in observers[event]:
+            run(*observer)
+    else:
+        threads = [threading.Thread(target=run, args=observer)
+                   for observer in observers[event]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if failures:
+        logging.error('plugin hooks for %s on %s failed' % (event, pkg))
+        (exc_type, exc_value, exc_tb) = failures[0]
+        raise exc_type, exc_value, exc_tb
+
+
 def ensure_dir(dir):
     if not os.path.exists(dir):
         os.makedirs(dir)
@@ -156,23 +383,53 @@ def ensure_stats_dir(conf):
     ensure_dir(os.path.join(conf['cache_dir'], 'stats'))
 
 
-def exclude_files(session, pkg, pkgdir, file_table, exclude_specs):
-    """remove files matching `exclude_specs` from storage and exclude them from
+def _glob_match(pattern, relpath):
+    """check whether path `relpath` matches glob `pattern`, both relative to
+    the same directory, following glob.glob() rules: wildcards do not match
+    across directories, nor hidden files unless explicitly requested
+
+    """
+    pat_parts = os.path.normpath(pattern).split('/')
+    path_parts = relpath.split('/')
+    if len(pat_parts) != len(path_parts):
+        return False
+    for (pat, part) in zip(pat_parts, path_parts):
+        if not glob.has_magic(pat):
+            if pat != part:
+                return False
+        elif (part.startswith('.') and not pat.startswith('.')) \
+                or not fnmatch.fnmatchcase(part, pat):
+            return False
+    return True
+
+
+def _exclusion_candidates(pkg, pkgdir, exclude_index, file_table=None):
+    """list files of package `pkg`, extracted at `pkgdir`, that match the
+    exclusion specifications of `exclude_index` (see mainlib.parse_exclude)
+
+    files are listed using `file_table`, if given, or by walking `pkgdir`
+    otherwise. Return paths relative to `pkgdir`
+
+    """
+    # enforce spec's Package field
+    patterns = exclude_index.get(pkg['package'])
+    if not patterns:
+        return []
+    # enforce spec's Files field
+    return [relpath
+            for (relpath, _abspath) in fs_storage.walk_pkg_files(pkgdir,
+                                                                 file_table)
+            if any(_glob_match(pat, relpath) for pat in patterns)]
+
+
+def exclude_files(session, pkg, pkgdir, file_table, exclude_index):
+    """remove files matching `exclude_index` from storage and exclude them from
     further processing
 
     Side effect: excluded files will be removed from `file_table`
 
     """
-    # enforce spec's Package field
-    specs = filter(lambda spec: spec['package'] == pkg['package'],
-                   exclude_specs)
-    candidates = []  # files eligible for exclusion
-    for spec in specs:
-        # enforce spec's Files field
-        for pat in spec['files'].split():
-            # ASSUMPTION: `pkgdir` is the CWD; enforced by _add_package
-            for relpath in glob.iglob(pat):
-                candidates.append(relpath)
+    candidates = _exclusion_candidates(pkg, pkgdir, exclude_index, file_table)
 
     # remove exclusion candidates from FS and DB storage
     if candidates:
@@ -180,42 +437,268 @@ def exclude_files(session, pkg, pkgdir, file_table, exclude_specs):
         for relpath in candidates:
             logging.debug('excluding file %s' % relpath)
             fs_storage.rm_file(pkgdir, relpath)
-            db_storage.rm_file(session, pkg['package'], relpath, file_table)
-            del(file_table[relpath])
+        if file_table is not None:
+            db_storage.rm_files(session, [file_table.pop(relpath)
+                                          for relpath in candidates])
 
 
-def _add_package(pkg, conf, session, sticky=False):
+@timings.timed('package', 'add')
+def _add_package(pkg, conf, session, sticky=False, extracted=False,
+                 batch=None, record_failure=True, budget=None):
     """add package `pkg` to both FS and DB storage, and notify plugins
 
-    handles and logs exceptions
+    if `extracted` is set, `pkg` has already been extracted to the FS storage
+    (and FS hooks run on it) by an extraction worker, see `_extract_package`
+
+    if `batch` is a list, hooks supporting batches are not notified: if the
+    package is added, a <pkg, pkgdir, file_table> triple is appended to
+    `batch` instead, see `_add_packages`
+
+    work is subject to the per-package resource limits set in `conf`, see
+    debsources.watchdog; `budget` is the time left to the package by the
+    extraction workers, if any
+
+    handles and logs exceptions, recording failures in the failure ledger (see
+    `quarantine_package`) unless `record_failure` is unset; return True if the
+    package has been added, False otherwise
     """
     logging.info('add %s...' % pkg)
     workdir = os.getcwd()
+    activity = 'extract'
+    with watchdog.package_limits(conf, budget):
+        try:
+            pkgdir = pkg.extraction_dir(conf['sources_dir'])
+            if pkgdir is None:
+                logging.warning('package %s has no extracion dir, skipping'
+                                % pkg)
+                return False
+            if not conf['dry_run'] and 'fs' in conf['backends']:
+                if not extracted:
+                    fs_storage.extract_package(pkg, pkgdir)
+                os.chdir(pkgdir)
+            with session.begin_nested():
+                # single db session for package addition and hook execution:
+                # if the hooks fail, the package won't be added to the db (it
+                # will be tried again at next run)
+                activity = 'db'
+                file_table = None
+                if not conf['dry_run'] and 'db' in conf['backends']:
+                    file_table = db_storage.add_package(session, pkg, pkgdir,
+                                                        sticky)
+                activity = 'exclude'
+                exclude_files(session, pkg, pkgdir, file_table,
+                              conf['exclude'])
+                activity = 'add-package'
+                if not conf['dry_run'] and 'hooks' in conf['backends']:
+                    notify(conf, 'add-package', session, pkg, pkgdir,
+                           file_table, fs_hooks=not extracted,
+                           batched=batch is not None)
+                if not conf['dry_run'] and 'db' in conf['backends']:
+                    session.query(ExtractionFailure) \
+                           .filter_by(package=pkg['package'],
+                                      version=pkg['version']) \
+                           .delete(synchronize_session=False)
+        except:
+            logging.exception('failed to add %s' % pkg)
+            if record_failure:
+                quarantine_package(conf, session, pkg, _failure(activity))
+            return False
+        finally:
+            os.chdir(workdir)
+    if batch is not None:
+        batch.append((pkg, pkgdir, file_table))
+    return True
+
+
+def _hook_batches(conf, pkgs):
+    """group `pkgs` (an iterable) in lists of packages to be added to the DB
+    together: conf['hook_batch_size'] packages if batching is enabled and some
+    hooks support batches, a single package otherwise
+
+    """
+    size = 1
+    if conf['hook_batch_size'] > 1 and not conf['dry_run'] and \
+       'hooks' in conf['backends'] and \
+       any(conf['observers'][event] for event in BATCH_EVENTS):
+        size = conf['hook_batch_size']
+    batch = []
+    for pkg in pkgs:
+        batch.append(pkg)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _add_packages(pkgs, conf, session, extracted=False, budgets=None):
+    """add packages `pkgs` to both FS and DB storage, see `_add_package`,
+    notifying hooks that support batches once for all added packages
+
+    `budgets`, if given, maps <package, version> pairs of packages extracted
+    by extraction workers to the time left to them, see `_extraction_pipeline`
+
+    if batched hooks fail, all packages are added again, one at a time and
+    without batching. Return a list of <pkg, added> pairs
+
+    """
+    def add(pkg, batch=None):
+        budget = None
+        if budgets is not None:
+            budget = budgets.get((pkg['package'], pkg['version']))
+        return _add_package(pkg, conf, session, extracted=extracted,
+                            batch=batch, budget=budget)
+
+    if len(pkgs) == 1 or conf['dry_run'] or \
+       'hooks' not in conf['backends'] or \
+       not any(conf['observers'][event] for event in BATCH_EVENTS):
+        return [(pkg, add(pkg)) for pkg in pkgs]
     try:
-        pkgdir = pkg.extraction_dir(conf['sources_dir'])
-        if pkgdir is None:
-            logging.warning('package %s has no extracion dir, skipping' % pkg)
-            return
-        if not conf['dry_run'] and 'fs' in conf['backends']:
-            fs_storage.extract_package(pkg, pkgdir)
-            os.chdir(pkgdir)
         with session.begin_nested():
-            # single db session for package addition and hook execution: if the
-            # hooks fail, the package won't be added to the db (it will be
-            # tried again at next run)
-            file_table = None
-            if not conf['dry_run'] and 'db' in conf['backends']:
-                file_table = db_storage.add_package(session, pkg, pkgdir,
-                                                    sticky)
-            exclude_files(session, pkg, pkgdir, file_table, conf['exclude'])
-            if not conf['dry_run'] and 'hooks' in conf['backends']:
-                notify(conf, 'add-package', session, pkg, pkgdir, file_table)
+            batch = []
+            results = [(pkg, add(pkg, batch)) for pkg in pkgs]
+            if batch:
+                notify_batch(conf['observers'], 'add-package', session,
+                             batch)
+        return results
+    except:
+        logging.exception('failed to add a batch of %d packages, retry one '
+                          'at a time' % len(pkgs))
+        return [(pkg, add(pkg)) for pkg in pkgs]
+
+
+# configuration used by worker processes, see _init_worker
+_worker_conf = None
+
+
+def _init_worker(conf):
+    global _worker_conf
+    _worker_conf = conf
+
+
+def _extract_package(pkg, budget=None):
+    """extraction worker: extract `pkg` to the FS storage and remove excluded
+    files from it. Meant to be run in a worker process initialized by
+    `_init_worker`; DB storage is never touched
+
+    `budget` is the time left to the package, see watchdog.remaining; None
+    for a new package
+
+    return a tuple <pkg, failure, budget, timings>, where failure is None on
+    success and an <activity, error> pair otherwise (see `_failure`), budget
+    is the time left to the package, and timings are the timing records of the
+    work done. Exceptions are handled and logged
+
+    """
+    conf = _worker_conf
+    logging.debug('extract %s (worker)...' % pkg)
+    worker_timings = timings.reset()
+    activity = 'extract'
+    try:
+        with timings.measure('package', 'extract', str(pkg)), \
+                watchdog.package_limits(conf, budget):
+            pkgdir = pkg.extraction_dir(conf['sources_dir'])
+            if pkgdir is None:
+                logging.warning('package %s has no extracion dir, skipping'
+                                % pkg)
+                return (pkg, (activity, 'no extraction dir'), None,
+                        worker_timings.records)
+            fs_storage.extract_package(pkg, pkgdir)
+            activity = 'exclude'
+            for relpath in _exclusion_candidates(pkg, pkgdir,
+                                                 conf['exclude']):
+                logging.debug('excluding file %s' % relpath)
+                fs_storage.rm_file(pkgdir, relpath)
+            budget = watchdog.remaining()
     except:
         logging.exception('failed to add %s' % pkg)
+        return (pkg, _failure(activity), None, worker_timings.records)
+    return (pkg, None, budget, worker_timings.records)
+
+
+def _analyze_package(pkg, budget=None):
+    """analysis worker: notify FS hooks about an extracted package `pkg`.
+    Meant to be run in a worker process initialized by `_init_worker`; DB
+    storage is never touched
+
+    return a tuple <pkg, failure, budget, timings>, see `_extract_package`.
+    Exceptions are handled and logged
+
+    """
+    conf = _worker_conf
+    logging.debug('analyze %s (worker)...' % pkg)
+    worker_timings = timings.reset()
+    try:
+        if 'hooks' in conf['backends']:
+            with timings.measure('package', 'analyze', str(pkg)), \
+                    watchdog.package_limits(conf, budget):
+                pkgdir = pkg.extraction_dir(conf['sources_dir'])
+                os.chdir(pkgdir)
+                notify_plugins_concurrently(conf['observers'],
+                                            'add-package.fs', pkg, pkgdir)
+                budget = watchdog.remaining()
+    except:
+        logging.exception('failed to add %s' % pkg)
+        return (pkg, _failure('add-package.fs'), None,
+                worker_timings.records)
+    return (pkg, None, budget, worker_timings.records)
+
+
+def _extraction_pipeline(conf, pending):
+    """run packages in `pending` through a pipeline of worker processes that
+    extract them (disk-bound) and run FS hooks on them (CPU-bound). Each stage
+    uses `conf['jobs']` workers; stages are connected by bounded queues.
+
+    yield <pkg, failure, budget> triples, in completion order, where failure
+    is None for packages that are ready to be added to DB storage, see
+    `_extract_package`. Time spent waiting in the pipeline queues is not
+    charged to packages: budget is the time they have left, from the
+    package_timeout set in `conf`, see debsources.watchdog
+
+    """
+    extract_pool = multiprocessing.Pool(conf['jobs'], _init_worker, (conf,))
+    analyze_pool = multiprocessing.Pool(conf['jobs'], _init_worker, (conf,))
+
+    def run_worker(pool, func, pkg, budget=None):
+        (pkg, failure, budget, worker_timings) = pool.apply(func,
+                                                            (pkg, budget))
+        timings.current().merge(worker_timings)
+        return (pkg, failure, budget)
+
+    def extract(pkg):
+        return run_worker(extract_pool, _extract_package, pkg)
+
+    def analyze((pkg, failure, budget)):
+        if failure is not None:
+            return (pkg, failure, budget)
+        return run_worker(analyze_pool, _analyze_package, pkg, budget)
+
+    def failed(stage, item):
+        # worker pool failures, e.g. a dead worker process: the package is
+        # handed over as failed, so that it gets quarantined and retried
+        pkg = item if stage == 'extract' else item[0]
+        return (pkg, _failure(stage), None)
+
+    stages = [('extract', extract, conf['jobs']),
+              ('analyze', analyze, conf['jobs'])]
+    pipeline = Pipeline(stages, conf['jobs'] * PIPELINE_QUEUE_FACTOR,
+                        sink='load', on_error=failed)
+    try:
+        for result in pipeline.run(pending):
+            yield result
+        for pool in [extract_pool, analyze_pool]:
+            pool.close()
+    except:
+        for pool in [extract_pool, analyze_pool]:
+            pool.terminate()
+        raise
     finally:
-        os.chdir(workdir)
+        for pool in [extract_pool, analyze_pool]:
+            pool.join()
+        pipeline.log_stats()
 
 
+@timings.timed('package', 'rm')
 def _rm_package(pkg, conf, session, db_package=None):
     """remove package `pkg` from both FS and DB storage, and notify plugins
 
@@ -260,21 +743,318 @@ def _add_suite(conf, session, suite, sticky=False):
         session.add(db_suite)
 
 
-def extract_new(status, conf, session, mirror):
+@contextmanager
+def _package_transaction(conf, session):
+    """wrap per-package DB changes in their own transaction, unless a single
+    transaction is used for the whole update run
+
+    """
+    if not conf['single_transaction']:
+        with session.begin():
+            yield
+    else:
+        yield
+
+
+def _journal_commit(conf, session):
+    """commit DB changes before recording them in the journal
+
+    in single transaction mode this commits the (ongoing) transaction;
+    otherwise changes have been committed already, one package at a time
+
+    """
+    if conf['single_transaction'] and 'db' in conf['backends']:
+        session.commit()
+
+
+class ChunkedCommits(object):
+    """commit the DB changes of a single transaction update run in chunks,
+    every conf['commit_packages'] processed packages or every
+    conf['commit_interval'] seconds, whichever comes first (0 means never)
+
+    after each commit the session is expunged, so that its identity map (and
+    hence memory usage) does not grow with the number of added packages.
+    Commits happen only between packages: as with per-package transactions,
+    packages found in the DB are complete, and the others will be redone
+    from scratch by the next update run
+
+    """
+
+    def __init__(self, conf, session):
+        self.session = session
+        self.max_packages = conf['commit_packages']
+        self.interval = conf['commit_interval']
+        self.enabled = conf['single_transaction'] \
+            and 'db' in conf['backends'] and not conf['dry_run'] \
+            and bool(self.max_packages or self.interval)
+        self.pending = 0  # processed packages, since last commit
+        self.last_commit = time.time()
+
+    def packages_done(self, count=1):
+        """note that `count` more packages have been processed, and commit if
+        due. Return True if DB changes have been committed
+
+        """
+        if not self.enabled:
+            return False
+        self.pending += count
+        if (self.max_packages and self.pending >= self.max_packages) or \
+           (self.interval and time.time() - self.last_commit >= self.interval):
+            logging.debug('commit changes for %d packages' % self.pending)
+            self.session.commit()
+            self.session.expunge_all()
+            self.pending = 0
+            self.last_commit = time.time()
+            return True
+        return False
+
+
+def _enqueue_extraction_jobs(session, pkgs):
+    """add extraction jobs for packages `pkgs` to the work queue, unless they
+    are queued already (e.g. by an interrupted update run)
+
+    """
+    with session.begin():
+        queued = set(session.query(ExtractionJob.package,
+                                   ExtractionJob.version))
+        jobs = [ExtractionJob(pkg) for pkg in pkgs
+                if (pkg['package'], pkg['version']) not in queued]
+        logging.info('enqueue %d extraction jobs...' % len(jobs))
+        for chunk in _bulk_chunks(jobs):
+            session.add_all(chunk)
+            session.flush()
+
+
+def _run_extraction_job(conf, session, worker):
+    """claim a pending extraction job from the work queue and run it
+
+    the job stays locked, and hence invisible to other workers, until the
+    transaction that adds the package to the DB is over: if `worker` dies, the
+    job becomes available again. Jobs are retried up to QUEUE_MAX_ATTEMPTS
+    times, e.g. if concurrent workers try to add the same package name; only
+    the last failure is recorded in the failure ledger, so that the package
+    is quarantined once per update run (see `quarantine_package`)
+
+    return False if no job could be claimed, True otherwise
+
+    """
+    with session.begin():
+        job = session.query(ExtractionJob) \
+                     .filter_by(state='pending') \
+                     .order_by(ExtractionJob.id) \
+                     .with_for_update(skip_locked=True) \
+                     .first()
+        if job is None:
+            return False
+        pkg = SourcePackage(job.paragraph)
+        # the mirror might be mounted elsewhere on the worker host
+        pkg['x-debsources-mirror-root'] = conf['mirror_dir']
+        last_attempt = job.attempts + 1 >= QUEUE_MAX_ATTEMPTS
+        added = _add_package(pkg, conf, session, record_failure=last_attempt)
+        job.attempts += 1
+        job.worker = worker
+        job.updated_at = datetime.utcnow()
+        if added:
+            job.state = 'done'
+        elif job.attempts >= QUEUE_MAX_ATTEMPTS:
+            job.state = 'failed'
+    return True
+
+
+def process_extraction_queue(conf, session, idle_timeout=0):
+    """run extraction jobs from the work queue, until none is pending
+
+    jobs claimed by other workers are pending too, until they are done: wait
+    for them, as they are released if those workers die. If no job is pending,
+    wait up to `idle_timeout` seconds for new jobs to show up.
+
+    `session` must be in autocommit mode, as each job is run in its own
+    transaction. Return the number of run jobs
+
+    """
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    logging.info('process extraction jobs as worker %s...' % worker)
+    run = 0
+    idle_since = time.time()
+    while True:
+        if _run_extraction_job(conf, session, worker):
+            run += 1
+            idle_since = time.time()
+            continue
+        pending = session.query(ExtractionJob) \
+                         .filter_by(state='pending') \
+                         .count()
+        if not pending and time.time() - idle_since >= idle_timeout:
+            break
+        time.sleep(QUEUE_POLL_INTERVAL)
+    logging.info('worker %s run %d extraction jobs' % (worker, run))
+    return run
+
+
+def _extraction_queue(conf, session, pending):
+    """extract packages in `pending` using the work queue, together with any
+    other worker sharing it
+
+    yield <pkg, success> pairs, once all packages have been processed
+
+    """
+    _enqueue_extraction_jobs(session, pending)
+    process_extraction_queue(conf, session)
+    # packages added by other workers are missing from the package id map
+    # (if any), which later stages rely upon
+    db_storage.preload_package_ids(session)
+    with session.begin():
+        states = dict(((package, version), state) for (package, version, state)
+                      in session.query(ExtractionJob.package,
+                                       ExtractionJob.version,
+                                       ExtractionJob.state))
+        session.query(ExtractionJob) \
+               .filter(ExtractionJob.state != 'pending') \
+               .delete(synchronize_session=False)
+    for pkg in pending:
+        yield (pkg, states.get((pkg['package'], pkg['version'])) == 'done')
+
+
+def quarantine_package(conf, session, pkg, failure, now=None):
+    """record in the failure ledger that package `pkg` failed to be added, as
+    described by the <activity, error> pair `failure`, and quarantine it
+
+    quarantined packages are not retried before QUARANTINE_DELAY has passed
+    since their first failure, then twice as long after each further one, up
+    to QUARANTINE_MAX_DELAY. The ledger entry of a package is dropped when
+    the package is eventually added (see `_add_package`), or when it leaves
+    the mirror (see `extract_new`)
+
+    """
+    if conf['dry_run'] or 'db' not in conf['backends']:
+        return
+    if now is None:
+        now = datetime.utcnow()
+    try:
+        with session.begin_nested():
+            entry = session.query(ExtractionFailure) \
+                           .filter_by(package=pkg['package'],
+                                      version=pkg['version']) \
+                           .first()
+            if entry is None:
+                entry = ExtractionFailure(pkg['package'], pkg['version'], now)
+                session.add(entry)
+            (entry.stage, entry.error) = failure
+            entry.attempts += 1
+            entry.last_failure = now
+            entry.retry_after = now + min(
+                QUARANTINE_DELAY * 2 ** min(entry.attempts - 1, 16),
+                QUARANTINE_MAX_DELAY)
+    except:
+        logging.exception('cannot record failure of %s' % pkg)
+
+
+def quarantine(session, now=None):
+    """return the entries of the failure ledger of packages that are
+    currently quarantined, i.e. that will not be retried before their
+    `retry_after` time, sorted by package and version
+
+    """
+    if now is None:
+        now = datetime.utcnow()
+    return session.query(ExtractionFailure) \
+                  .filter(ExtractionFailure.retry_after > now) \
+                  .order_by(ExtractionFailure.package,
+                            ExtractionFailure.version) \
+                  .all()
+
+
+def pp_quarantine(entries):
+    """pretty print failure ledger `entries`, one per line"""
+    return '\n'.join('%s/%s\t%s\tattempts: %d\tretry after: %s\t%s'
+                     % (entry.package, entry.version, entry.stage,
+                        entry.attempts,
+                        entry.retry_after.strftime('%Y-%m-%d %H:%M'),
+                        entry.error.splitlines()[0] if entry.error else '')
+                     for entry in entries)
+
+
+def _prune_failure_ledger(session, mirror):
+    """drop from the failure ledger packages that are no longer in `mirror`"""
+    gone = [entry_id for (entry_id, package, version)
+            in session.query(ExtractionFailure.id,
+                             ExtractionFailure.package,
+                             ExtractionFailure.version)
+            if (package, version) not in mirror.packages]
+    for chunk in _bulk_chunks(gone):
+        session.query(ExtractionFailure) \
+               .filter(ExtractionFailure.id.in_(chunk)) \
+               .delete(synchronize_session=False)
+
+
+def parse_extract_order(s):
+    """parse a space separated list of extraction order criteria, see
+    EXTRACT_ORDER_CRITERIA
+
+    """
+    criteria = s.split()
+    for criterion in criteria:
+        if criterion not in EXTRACT_ORDER_CRITERIA:
+            raise ValueError('unknown extraction order criterion %s'
+                             % criterion)
+    return criteria
+
+
+def _schedule_extraction(conf, session, mirror, pkgs):
+    """sort packages `pkgs`, to be extracted, by decreasing priority
+
+    priority is given by the criteria listed in conf['extract_order'], in
+    order, each one breaking ties left by the previous ones:
+
+    - suites: packages in conf['priority_suites'] (aliases like "testing" are
+      resolved using the mirror) first, in the order suites are listed
+    - size: smaller packages first, as per the Files field of their Sources
+      entries
+    - known: packages with another version already in Debsources first
+
+    remaining ties are broken by mirror order
+
+    """
+    keys = []
+    for criterion in conf['extract_order']:
+        if criterion == 'suites':
+            ranks = {}
+            suites = [os.path.basename(os.path.realpath(
+                os.path.join(mirror.mirror_root, 'dists', suite)))
+                for suite in conf['priority_suites']]
+            for (rank, suite) in reversed(list(enumerate(suites))):
+                for pkg_id in mirror.suites.get(suite, []):
+                    ranks[pkg_id] = rank
+            keys.append(lambda pkg, ranks=ranks, default=len(suites):
+                        ranks.get((pkg['package'], pkg['version']), default))
+        elif criterion == 'size':
+            keys.append(lambda pkg: pkg.source_size())
+        elif criterion == 'known':
+            known = set(name for (name,) in session.query(PackageName.name))
+            keys.append(lambda pkg, known=known: pkg['package'] not in known)
+    if not keys:
+        return pkgs
+    return sorted(pkgs, key=lambda pkg: tuple(key(pkg) for key in keys))
+
+
+def extract_new(status, conf, session, mirror, journal=None):
     """update stage: list mirror and extract new packages
 
+    if given, `journal` is used to skip packages committed by an interrupted
+    update run, and to record new ones as they get committed
+
     """
     ensure_cache_dir(conf)
-
-    def add_package(pkg):
-        if not db_storage.lookup_package(session, pkg['package'],
-                                         pkg['version']):
-            # use DB as completion marker: if the package has been inserted, it
-            # means everything went fine last time we tried. If not, we redo
-            # everything, just to be safe
-            _add_package(pkg, conf, session)
-        pkgdir = pkg.extraction_dir(conf['sources_dir'])
+    # with the work queue, packages are added by queue workers, possibly on
+    # other hosts; otherwise, if parallel, extracted by local worker processes
+    queued = conf['work_queue'] and not conf['dry_run'] \
+        and 'db' in conf['backends']
+    parallel = conf['jobs'] > 1 and not conf['dry_run'] \
+        and 'fs' in conf['backends']
+
+    def add_sources_entry(pkg):
         if conf['force_triggers']:
+            pkgdir = pkg.extraction_dir(conf['sources_dir'])
             try:
                 notify_plugins(conf['observers'], 'add-package',
                                session, pkg, pkgdir,
@@ -289,38 +1069,275 @@ def extract_new(status, conf, session, mirror):
                                      conf['sources_dir'])
         status.sources[pkg_id] = pkg.archive_area(), dsc_rel, pkgdir_rel, []
 
+    uncommitted = []  # added packages, not yet recorded in the journal
+    chunks = ChunkedCommits(conf, session)
+
+    def journal_added(pkg):
+        if journal is None:
+            return
+        uncommitted.append((pkg['package'], pkg['version']))
+        if len(uncommitted) >= JOURNAL_BATCH_SIZE:
+            _journal_commit(conf, session)
+            journal.packages_committed(uncommitted)
+            del uncommitted[:]
+
+    def packages_done(count=1):
+        if chunks.packages_done(count) and journal is not None:
+            journal.packages_committed(uncommitted)
+            del uncommitted[:]
+
+    def is_new(pkg):
+        if journal is not None and \
+           (pkg['package'], pkg['version']) in journal.packages:
+            return False  # committed by an interrupted run
+        if status.mirror_delta is not None:
+            (new_pkgs, _gone_pkgs) = status.mirror_delta
+            if (pkg['package'], pkg['version']) not in new_pkgs:
+                return False  # known since last run, no need to ask the DB
+        # use DB as completion marker: if the package has been inserted, it
+        # means everything went fine last time we tried. If not, we redo
+        # everything, just to be safe
+        return db_storage.lookup_package_id(session, pkg['package'],
+                                            pkg['version']) is None
+
+    def add_failed(pkg):
+        status.failed.add((pkg['package'], pkg['version']))
+
+    quarantined = set()
+    if 'db' in conf['backends']:
+        with _package_transaction(conf, session):
+            quarantined = set((entry.package, entry.version)
+                              for entry in quarantine(session))
+
     logging.info('add new packages...')
+    pending = []  # packages to be extracted
+    skipped = 0  # quarantined packages
+    added = 0
+    start = time.time()
     for pkg in mirror.ls():
-        if not conf['single_transaction']:
-            with session.begin():
-                add_package(pkg)
-        else:
-            add_package(pkg)
+        with _package_transaction(conf, session):
+            if not is_new(pkg):
+                add_sources_entry(pkg)
+            elif (pkg['package'], pkg['version']) in quarantined:
+                logging.debug('skip quarantined package %s' % pkg)
+                skipped += 1
+                add_failed(pkg)  # not done, retry at next run
+                add_sources_entry(pkg)
+            else:
+                pending.append(pkg)
+    if skipped:
+        logging.info('skipped %d quarantined packages, see '
+                     'debsources-update --quarantine' % skipped)
+    pending = _schedule_extraction(conf, session, mirror, pending)
+
+    if pending and queued:
+        logging.info('extract %d packages using the work queue...'
+                     % len(pending))
+        for (pkg, added_by_worker) in _extraction_queue(conf, session,
+                                                        pending):
+            with _package_transaction(conf, session):
+                if added_by_worker:
+                    added += 1
+                    journal_added(pkg)
+                else:
+                    add_failed(pkg)
+                add_sources_entry(pkg)
+            packages_done()
+    elif pending and parallel:
+        logging.info('extract %d packages using %d jobs...'
+                     % (len(pending), conf['jobs']))
+        # FS work happens in worker processes, DB changes are serialized here
+        for results in _hook_batches(conf,
+                                     _extraction_pipeline(conf, pending)):
+            with _package_transaction(conf, session):
+                extracted = []
+                budgets = {}
+                for (pkg, failure, budget) in results:
+                    if failure is None:
+                        extracted.append(pkg)
+                        budgets[(pkg['package'], pkg['version'])] = budget
+                        continue
+                    quarantine_package(conf, session, pkg, failure)
+                    add_failed(pkg)
+                    add_sources_entry(pkg)
+                for (pkg, success) in _add_packages(extracted, conf, session,
+                                                    extracted=True,
+                                                    budgets=budgets):
+                    if success:
+                        added += 1
+                        journal_added(pkg)
+                    else:
+                        add_failed(pkg)
+                    add_sources_entry(pkg)
+            packages_done(len(results))
+    else:
+        for batch in _hook_batches(conf, pending):
+            with _package_transaction(conf, session):
+                for (pkg, success) in _add_packages(batch, conf, session):
+                    if success:
+                        added += 1
+                        journal_added(pkg)
+                    else:
+                        add_failed(pkg)
+                    add_sources_entry(pkg)
+            packages_done(len(batch))
+
+    if not conf['dry_run'] and 'db' in conf['backends']:
+        with _package_transaction(conf, session):
+            _prune_failure_ledger(session, mirror)
+
+    elapsed = time.time() - start
+    if added:
+        logging.info('added %d packages in %.1f seconds (%.2f packages/s)'
+                     % (added, elapsed, added / elapsed))
+
+
+def _bulk_chunks(items):
+    """split `items` in lists of at most BULK_FLUSH_THRESHOLD elements"""
+    items = list(items)
+    for i in range(0, len(items), BULK_FLUSH_THRESHOLD):
+        yield items[i:i + BULK_FLUSH_THRESHOLD]
+
+
+def _fs_rm_package(pkg, pkgdir):
+    """remove package `pkg` from FS storage, meant to be run in a thread pool
+
+    handles and logs exceptions
+    """
+    try:
+        fs_storage.remove_package(pkg, pkgdir)
+    except:
+        logging.exception('failed to remove %s from FS storage' % pkg)
+
+
+def _rm_packages(pkgs, conf, session, fs_pool):
+    """remove packages from both FS and DB storage, and notify plugins
+
+    `pkgs` is a list of <SourcePackage, package id> pairs. Packages are removed
+    from the DB in bulk; once that succeeded, their FS removal is delegated to
+    `fs_pool` (a thread pool), so that it can proceed concurrently with the DB
+    work of the next packages
+
+    handles and logs exceptions; return the set of <package, version> pairs
+    that could not be removed
+    """
+    failed = set()
+    removed = []
+    for (pkg, package_id) in pkgs:
+        logging.info("remove %s..." % pkg)
+        pkgdir = pkg.extraction_dir(conf['sources_dir'])
+        try:
+            if not conf['dry_run'] and 'hooks' in conf['backends']:
+                with timings.measure('package', 'rm', str(pkg)), \
+                        session.begin_nested():
+                    notify(conf, 'rm-package', session, pkg, pkgdir)
+        except:
+            logging.exception('failed to remove %s' % pkg)
+            failed.add((pkg['package'], pkg['version']))
+            continue
+        removed.append((pkg, package_id))
+
+    try:
+        if not conf['dry_run'] and 'db' in conf['backends']:
+            with session.begin_nested():
+                db_storage.rm_packages(session, removed)
+    except:
+        # keep FS storage in sync with DB one, where packages are still there
+        logging.exception('failed to remove packages %s'
+                          % string.join(map(str, removed), ', '))
+        failed.update((pkg['package'], pkg['version'])
+                      for (pkg, _package_id) in removed)
+        return failed
+
+    if not conf['dry_run'] and 'fs' in conf['backends']:
+        for (pkg, _package_id) in removed:
+            fs_pool.apply_async(_fs_rm_package,
+                                (pkg, pkg.extraction_dir(conf['sources_dir'])))
+    return failed
+
+
+def _is_expired(conf, pkgdir):
+    """check whether a package extracted at `pkgdir` is old enough to be
+    garbage collected
+
+    """
+    if not os.path.exists(pkgdir):
+        return True
+    age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(pkgdir))
+    return age.days >= conf['expire_days']
 
 
 def garbage_collect(status, conf, session, mirror):
-    """update stage: list db and remove disappeared and expired packages
+    """update stage: remove disappeared and expired packages
+
+    packages to be removed are found as the difference between DB and mirror
+    packages; if the mirror delta is known, only packages that have been
+    removed from the mirror since last run are considered
 
     """
     logging.info('garbage collection...')
-    for version in session.query(Package).filter(not_(Package.sticky)):
-        pkg = SourcePackage.from_db_model(version)
-        pkg_id = (pkg['package'], pkg['version'])
-        pkgdir = pkg.extraction_dir(conf['sources_dir'])
-        if pkg_id not in mirror.packages:
-            # package is in in Debsources db, but gone from mirror: we
-            # might have to garbage collect it (depending on expiry)
-            expire_days = conf['expire_days']
-            age = None
-            if os.path.exists(pkgdir):
-                age = datetime.now() - \
-                    datetime.fromtimestamp(os.path.getmtime(pkgdir))
-            if not age or age.days >= expire_days:
-                _rm_package(pkg, conf, session, db_package=version)
-            else:
-                logging.debug('not removing %s as it is too young' % pkg)
+    # non-sticky DB packages: <package, version> -> <package id, area>
+    q = session.query(PackageName.name, Package.version,
+                      Package.id, Package.area) \
+               .filter(Package.name_id == PackageName.id) \
+               .filter(not_(Package.sticky))
+    if status.mirror_delta is not None:
+        (_new_pkgs, gone_pkgs) = status.mirror_delta
+        gone_ids = filter(lambda package_id: package_id is not None,
+                          [db_storage.lookup_package_id(session, *pkg_id)
+                           for pkg_id in gone_pkgs])
+        db_packages = {}
+        for chunk in _bulk_chunks(gone_ids):
+            for (name, version, package_id, area) in \
+                    q.filter(Package.id.in_(chunk)):
+                db_packages[(name, version)] = (package_id, area)
+    else:
+        db_packages = dict(((name, version), (package_id, area))
+                           for (name, version, package_id, area) in q)
+
+    # packages that are in Debsources db, but gone from mirror: we might have
+    # to garbage collect them (depending on expiry)
+    expired = []
+    for pkg_id in sorted(db_packages):
+        if pkg_id in mirror.packages:
+            continue
+        (package_id, area) = db_packages[pkg_id]
+        pkg = SourcePackage.from_db_fields(pkg_id[0], pkg_id[1], area)
+        if _is_expired(conf, pkg.extraction_dir(conf['sources_dir'])):
+            expired.append((pkg, package_id))
+            del db_packages[pkg_id]
+        else:
+            logging.debug('not removing %s as it is too young' % pkg)
+            status.retained.add(pkg_id)
+            expiry = datetime.utcfromtimestamp(os.path.getmtime(
+                pkg.extraction_dir(conf['sources_dir']))) \
+                + timedelta(days=conf['expire_days'])
+            status.retained_until = min(status.retained_until or expiry,
+                                        expiry)
+
+    if expired:
+        logging.info('remove %d packages in batches of %d...'
+                     % (len(expired), conf['gc_batch_size']))
+        # FS removals are I/O bound, threads are enough to parallelize them
+        fs_pool = multiprocessing.pool.ThreadPool(conf['jobs'])
+        chunks = ChunkedCommits(conf, session)
+        try:
+            for i in range(0, len(expired), conf['gc_batch_size']):
+                batch = expired[i:i + conf['gc_batch_size']]
+                status.rm_failed.update(
+                    _rm_packages(batch, conf, session, fs_pool))
+                chunks.packages_done(len(batch))
+            fs_pool.close()
+        except:
+            fs_pool.terminate()
+            raise
+        finally:
+            fs_pool.join()
 
-        if conf['force_triggers']:
+    if conf['force_triggers']:
+        for (pkg_id, (_package_id, area)) in sorted(db_packages.iteritems()):
+            pkg = SourcePackage.from_db_fields(pkg_id[0], pkg_id[1], area)
+            pkgdir = pkg.extraction_dir(conf['sources_dir'])
             try:
                 notify_plugins(conf['observers'], 'rm-package',
                                session, pkg, pkgdir,
@@ -331,28 +1348,32 @@ def garbage_collect(status, conf, session, mirror):
 
 
 def update_suites(status, conf, session, mirror):
-    """update stage: sweep and recreate suite mappings
+    """update stage: sync suite mappings with the mirror
+
+    compare mirror suite mappings with DB ones, and only insert/delete the
+    differences between the two
 
     """
     logging.info('update suites mappings...')
 
-    insert_q = sql.insert(Suite.__table__)
-    insert_params = []
+    # current DB mappings of mirror suites: <package_id, suite> -> mapping id
+    db_mappings = {}
+    if 'db' in conf['backends'] and mirror.suites:
+        q = session.query(Suite.id, Suite.package_id, Suite.suite) \
+                   .filter(Suite.suite.in_(mirror.suites.keys()))
+        for (mapping_id, package_id, suite) in q:
+            db_mappings[(package_id, suite)] = mapping_id
+
+    mirror_mappings = set()  # <package_id, suite> pairs
     for (suite, pkgs) in mirror.suites.iteritems():
-        if not conf['dry_run'] and 'db' in conf['backends']:
-            session.query(Suite).filter_by(suite=suite).delete()
         for pkg_id in pkgs:
             (pkg, version) = pkg_id
-            db_package = db_storage.lookup_package(session, pkg, version)
-            if not db_package:
+            package_id = db_storage.lookup_package_id(session, pkg, version)
+            if package_id is None:
                 logging.warn('package %s/%s not found in suite %s, skipping'
                              % (pkg, version, suite))
             else:
-                logging.debug('add suite mapping: %s/%s -> %s'
-                              % (pkg, version, suite))
-                params = {'package_id': db_package.id,
-                          'suite': suite}
-                insert_params.append(params)
+                mirror_mappings.add((package_id, suite))
                 if pkg_id in status.sources:
                     # fill-in incomplete suite information in status
                     status.sources[pkg_id][-1].append(suite)
@@ -360,21 +1381,30 @@ def update_suites(status, conf, session, mirror):
                     # defensive measure to make update_suites() more reusable
                     logging.warn('cannot find %s/%s during suite update'
                                  % (pkg, version))
-        if not conf['dry_run'] and 'db' in conf['backends'] \
-           and len(insert_params) >= BULK_FLUSH_THRESHOLD:
-            session.execute(insert_q, insert_params)
-            session.flush()
-            insert_params = []
 
-        if not conf['dry_run'] and 'db' in conf['backends']:
-            session.query(SuiteInfo).filter_by(name=suite).delete()
-            _add_suite(conf, session, suite)
+    new_mappings = mirror_mappings.difference(db_mappings)
+    gone_mappings = [mapping_id
+                     for (mapping, mapping_id) in db_mappings.iteritems()
+                     if mapping not in mirror_mappings]
+    logging.info('suites mappings: %d new, %d gone'
+                 % (len(new_mappings), len(gone_mappings)))
 
-    if not conf['dry_run'] and 'db' in conf['backends'] \
-       and insert_params:
-        session.execute(insert_q, insert_params)
+    if not conf['dry_run'] and 'db' in conf['backends']:
+        suites_table = Suite.__table__
+        for chunk in _bulk_chunks(gone_mappings):
+            session.execute(suites_table.delete()
+                            .where(suites_table.c.id.in_(chunk)))
+        insert_q = sql.insert(suites_table)
+        for chunk in _bulk_chunks(new_mappings):
+            session.execute(insert_q,
+                            [dict(zip(['package_id', 'suite'], mapping))
+                             for mapping in chunk])
         session.flush()
 
+        for suite in mirror.suites:
+            session.query(SuiteInfo).filter_by(name=suite).delete()
+            _add_suite(conf, session, suite)
+
     # update sources.txt, now that we know the suite mappings
     src_list_path = os.path.join(conf['cache_dir'], 'sources.txt')
     with open(src_list_path + '.new', 'w') as src_list:
@@ -395,6 +1425,46 @@ def __target_suites(session, suites=None):
     return suites
 
 
+# statistics computed by update_statistics, both overall and per suite; see
+# the homonymous (and *_by_suite) functions of the statistics module
+STATS_QUERIES = ['disk_usage', 'source_packages', 'source_files', 'ctags',
+                 'sloccount_summary']
+
+
+def _run_stats_queries(conf, session, queries):
+    """run statistics `queries`, a dictionary mapping names to functions that
+    take a DB session as their sole argument. Return a dictionary mapping the
+    same names to query results
+
+    queries are run in parallel, each one on a separate DB connection, when
+    there is more than one job. That is possible only when not using a single
+    transaction, as otherwise other connections would not see the changes
+    made by the current update run
+
+    """
+    if conf['single_transaction'] or conf['jobs'] <= 1:
+        return dict((name, query(session))
+                    for (name, query) in queries.iteritems())
+
+    Session = sessionmaker(bind=session.get_bind())
+
+    def run_query(name):
+        query_session = Session()
+        try:
+            return (name, queries[name](query_session))
+        finally:
+            query_session.close()
+
+    logging.debug('run %d statistics queries using %d connections...'
+                  % (len(queries), conf['jobs']))
+    pool = multiprocessing.pool.ThreadPool(min(conf['jobs'], len(queries)))
+    try:
+        return dict(pool.map(run_query, queries.keys()))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def update_statistics(status, conf, session, suites=None):
     """update stage: update statistics
 
@@ -435,15 +1505,25 @@ def update_statistics(status, conf, session, suites=None):
             total_slocs += v
         d[prefix] = total_slocs
 
-    # compute overall stats
+    # compute overall stats, and per-suite stats for all target suites at
+    # once. Overall stats count each package once, no matter how many suites
+    # it belongs to, hence they cannot be derived from per-suite ones
+    def by_suite(stat):
+        query = getattr(statistics, stat + '_by_suite')
+        return lambda session: query(session, suites=suites)
+
+    results = _run_stats_queries(conf, session, dict(
+        [(stat, getattr(statistics, stat)) for stat in STATS_QUERIES] +
+        [(stat + '_by_suite', by_suite(stat)) for stat in STATS_QUERIES]))
+
     suite = 'ALL'
     siz = HistorySize(suite, timestamp=now)
     loc = HistorySlocCount(suite, timestamp=now)
     for stat in ['disk_usage', 'source_packages', 'source_files', 'ctags']:
-        v = getattr(statistics, stat)(session)
+        v = results[stat]
         stats['total.' + stat] = v
         setattr(siz, stat, v)
-    store_sloccount_stats(statistics.sloccount_summary(session),
+    store_sloccount_stats(results['sloccount_summary'],
                           stats, 'total.sloccount', loc)
     if not conf['dry_run'] and 'db' in conf['backends']:
         session.add(siz)
@@ -456,10 +1536,11 @@ def update_statistics(status, conf, session, suites=None):
 
         suite_key = 'debian_' + suite + '.'
         for stat in ['disk_usage', 'source_packages', 'source_files', 'ctags']:
-            v = getattr(statistics, stat)(session, suite)
+            v = results[stat + '_by_suite'].get(suite, 0)
             stats[suite_key + stat] = v
             setattr(siz, stat, v)
-        store_sloccount_stats(statistics.sloccount_summary(session, suite),
+        store_sloccount_stats(results['sloccount_summary_by_suite']
+                              .get(suite, {}),
                               stats, suite_key + 'sloccount', loc)
         if not conf['dry_run'] and 'db' in conf['backends']:
             session.add(siz)
@@ -488,19 +1569,69 @@ def update_metadata(status, conf, session):
         os.rename(prefix_path + '.new', prefix_path)
 
     # update timestamp
-    if not conf['dry_run'] and 'fs' in conf['backends']:
-        timestamp_file = os.path.join(conf['cache_dir'], 'last-update')
-        with open(timestamp_file + '.new', 'w') as out:
-            out.write('%s\n' % formatdate())
-        os.rename(timestamp_file + '.new', timestamp_file)
+    _touch_last_update(conf)
+
+
+def _chart_fingerprint(chart_type, data):
+    """fingerprint the input `data` of a chart of type `chart_type`"""
+    def canonical(obj):  # dictionaries have no stable representation
+        if isinstance(obj, dict):
+            return sorted((k, canonical(v)) for (k, v) in obj.iteritems())
+        return obj
+    return hashlib.sha1(repr((chart_type, canonical(data)))).hexdigest()
+
+
+def _load_chart_fingerprints(fname):
+    """load chart fingerprints, as a dictionary mapping chart file names to
+    the fingerprint of the data they have been rendered from
+
+    """
+    fingerprints = {}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            for line in f:
+                (chart, fingerprint) = line.split()
+                fingerprints[chart] = fingerprint
+    return fingerprints
+
+
+def _save_chart_fingerprints(fingerprints, fname):
+    with open(fname + '.new', 'w') as out:
+        for chart, fingerprint in sorted(fingerprints.iteritems()):
+            out.write('%s\t%s\n' % (chart, fingerprint))
+    os.rename(fname + '.new', fname)
+
+
+def _render_chart(job):
+    """render a chart described by `job`, a triple <chart_type, data, fname>,
+    where `chart_type` is the name of the function of the charts module used
+    to render `data` to `fname`
+
+    return a pair <fname, success>. Exceptions are handled and logged
+
+    """
+    (chart_type, data, fname) = job
+    try:
+        getattr(charts, chart_type)(data, fname)
+    except:
+        logging.exception('failed to render chart %s' % fname)
+        return (fname, False)
+    return (fname, True)
 
 
 def update_charts(status, conf, session, suites=None):
-    """update stage: rebuild charts"""
+    """update stage: rebuild charts
+
+    only charts whose input data have changed since last rendering are
+    rebuilt; rendering happens in parallel when there is more than one job
 
+    """
     logging.info('update charts...')
     ensure_stats_dir(conf)
     suites = __target_suites(session, suites)
+    stats_dir = os.path.join(conf['cache_dir'], 'stats')
+    fingerprints_file = os.path.join(stats_dir, 'charts.fingerprints')
+    fingerprints = _load_chart_fingerprints(fingerprints_file)
 
     CHARTS = [  # <period, granularity> paris
         ('1 month', 'hourly'),
@@ -509,18 +1640,29 @@ def update_charts(status, conf, session, suites=None):
         ('20 years', 'monthly'),
     ]
 
+    jobs = []  # charts to be rendered, see _render_chart
+    new_fingerprints = {}
+
+    def add_chart(chart_type, data, fname):
+        fingerprint = _chart_fingerprint(chart_type, data)
+        chart = os.path.basename(fname)
+        if fingerprints.get(chart) == fingerprint and os.path.exists(fname):
+            logging.debug('chart %s is up to date' % fname)
+            return
+        jobs.append((chart_type, data, fname))
+        new_fingerprints[chart] = fingerprint
+
     # size charts, various metrics
     for metric in ['source_packages', 'disk_usage', 'source_files', 'ctags']:
         for (period, granularity) in CHARTS:
             for suite in suites + ['ALL']:
                 series = getattr(statistics, 'history_size_' + granularity)(
                     session, metric, interval=period, suite=suite)
-                chart_file = os.path.join(conf['cache_dir'], 'stats',
+                chart_file = os.path.join(stats_dir,
                                           '%s-%s-%s.png' %
                                           (suite, metric,
                                            period.replace(' ', '-')))
-                if not conf['dry_run']:
-                    charts.size_plot(series, chart_file)
+                add_chart('size_plot', series, chart_file)
 
     # sloccount: historical histograms
     for (period, granularity) in CHARTS:
@@ -528,22 +1670,45 @@ def update_charts(status, conf, session, suites=None):
             # historical histogram
             mseries = getattr(statistics, 'history_sloc_' + granularity)(
                 session, interval=period, suite=suite)
-            chart_file = os.path.join(conf['cache_dir'], 'stats',
+            chart_file = os.path.join(stats_dir,
                                       '%s-sloc-%s.png' %
                                       (suite, period.replace(' ', '-')))
-            if not conf['dry_run']:
-                charts.sloc_plot(mseries, chart_file)
+            add_chart('sloc_plot', mseries, chart_file)
 
     # sloccount: current pie charts
+    suite_slocs = statistics.sloccount_summary_by_suite(session)
     for suite in suites + ['ALL']:
-        sloc_suite = suite
-        if sloc_suite == 'ALL':
-            sloc_suite = None
-        slocs = statistics.sloccount_summary(session, suite=sloc_suite)
-        chart_file = os.path.join(conf['cache_dir'], 'stats',
+        if suite == 'ALL':
+            slocs = statistics.sloccount_summary(session)
+        else:
+            slocs = suite_slocs.get(suite, {})
+        chart_file = os.path.join(stats_dir,
                                   '%s-sloc_pie-current.png' % suite)
-        if not conf['dry_run']:
-            charts.sloc_pie(slocs, chart_file)
+        add_chart('sloc_pie', slocs, chart_file)
+
+    logging.info('render %d charts...' % len(jobs))
+    if conf['dry_run'] or not jobs:
+        return
+    if conf['jobs'] > 1:
+        pool = multiprocessing.Pool(conf['jobs'])
+        try:
+            results = pool.map(_render_chart, jobs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = map(_render_chart, jobs)
+
+    for (fname, rendered) in results:
+        chart = os.path.basename(fname)
+        if rendered:
+            fingerprints[chart] = new_fingerprints[chart]
+        else:  # force re-rendering at next run
+            fingerprints.pop(chart, None)
+    _save_chart_fingerprints(fingerprints, fingerprints_file)
 
 
 # update stages
@@ -564,6 +1729,18 @@ __STAGES = {
 __STAGE2STR = {v: k for k, v in __STAGES.items()}
 UPDATE_STAGES = set(__STAGES.values())
 
+# dependencies among update stages: stages are run only after the (requested)
+# stages they depend on are done; stages independent from each other can be
+# run concurrently, see _run_stages()
+STAGE_DEPENDENCIES = {
+    STAGE_EXTRACT: set(),
+    STAGE_SUITES: set([STAGE_EXTRACT]),
+    STAGE_GC: set([STAGE_SUITES]),
+    STAGE_STATS: set([STAGE_GC]),
+    STAGE_CACHE: set([STAGE_GC]),  # publish prefixes before stats are done
+    STAGE_CHARTS: set([STAGE_STATS]),  # charts plot stats history
+}
+
 
 def parse_stage(s):
     try:
@@ -581,25 +1758,446 @@ def pp_stage(stage):
         raise ValueError('unknown update stage %s' % stage)
 
 
+def _stage_dependencies(stages):
+    """return the dependencies of each stage in `stages` on the other ones, as
+    a dictionary mapping stages to sets of stages. Dependencies on stages
+    that are not in `stages` are replaced by their own dependencies
+
+    """
+    def deps(stage):
+        direct = STAGE_DEPENDENCIES[stage]
+        return set.union(direct, *map(deps, direct))
+    return dict((stage, deps(stage) & stages) for stage in stages)
+
+
+def _run_stages(stages, run_stage, session, concurrent=False):
+    """run update `stages`, respecting their dependencies (see
+    STAGE_DEPENDENCIES), by calling `run_stage(stage, session)`
+
+    if `concurrent` is set, independent stages are run concurrently, each one
+    in its own thread and using `session`, unless another running stage is
+    using it already: then the stage gets a DB session of its own. That is
+    possible only when not using a single transaction, as otherwise other
+    sessions would not see the changes made by the current update run. If
+    some stages fail, no further stage is started, and the first failure is
+    re-raised once the running stages are done
+
+    """
+    deps = _stage_dependencies(stages)
+    pending = set(stages)
+    done = set()
+
+    def ready():
+        return sorted(stage for stage in pending if deps[stage] <= done)
+
+    if not concurrent:
+        while pending:
+            stage = ready()[0]
+            run_stage(stage, session)
+            pending.remove(stage)
+            done.add(stage)
+        return
+
+    Session = sessionmaker(bind=session.get_bind(), autocommit=True)
+    finished = Queue.Queue()
+    running = {}  # running stages -> their sessions
+    failures = []
+
+    def run(stage, stage_session):
+        try:
+            run_stage(stage, stage_session)
+        except:
+            logging.exception('update stage %s failed' % pp_stage(stage))
+            failures.append(sys.exc_info())
+        finally:
+            finished.put(stage)
+
+    while True:
+        startable = ready() if not failures else []
+        if len(startable) == 1 and not running:
+            # nothing to run concurrently with, run it in this thread
+            stage = startable[0]
+            run_stage(stage, session)
+            pending.remove(stage)
+            done.add(stage)
+            continue
+        for stage in startable:
+            if session in running.values():
+                stage_session = Session()
+            else:
+                stage_session = session
+            logging.debug('start stage %s concurrently' % pp_stage(stage))
+            pending.remove(stage)
+            running[stage] = stage_session
+            threading.Thread(target=run, args=(stage, stage_session)).start()
+        if not running:
+            break
+        try:
+            stage = finished.get(timeout=1)  # timeout: allow interrupts
+        except Queue.Empty:
+            continue
+        stage_session = running.pop(stage)
+        if stage_session is not session:
+            stage_session.close()
+        done.add(stage)
+    if failures:
+        (exc_type, exc_value, exc_tb) = failures[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def _snapshot_tag(session):
+    """tag mirror snapshots with the number of non-sticky packages in the DB,
+    so that DB changes happened behind our back (e.g. DB recreation, archive
+    changes, ...) invalidate them
+
+    """
+    return session.query(Package).filter(not_(Package.sticky)).count()
+
+
+def _after_commit(session, callback):
+    """invoke `callback` once DB changes done so far by `session` have been
+    committed: now in autocommit mode, upon commit otherwise
+
+    """
+    if session.autocommit:
+        callback()
+    else:
+        event.listen(session, 'after_commit', lambda *_args: callback(),
+                     once=True)
+
+
+def _save_mirror_snapshot(status, conf, session, mirror):
+    """save a snapshot of the mirror packages known to the DB, so that the
+    next update run can act on the mirror delta only
+
+    in single transaction mode, the snapshot is saved only if and when the
+    transaction is committed
+
+    """
+    packages = mirror.packages - status.failed
+    # packages whose removal has been postponed or has failed will be
+    # considered again by the next run
+    pending = status.retained | status.rm_failed
+    tag = _snapshot_tag(session)
+    _after_commit(session, lambda: mirror.save_snapshot(
+        packages, pending=pending, tag=tag))
+
+
+def _db_generation(session):
+    """return a value that changes whenever packages are added to or removed
+    from the DB, or moved across suites
+
+    """
+    (count, max_id) = session.query(func.count(Package.id),
+                                    func.max(Package.id)).one()
+    suites = session.query(func.count(Suite.id)).scalar()
+    return (count, max_id, suites)
+
+
+def _next_due(status, session):
+    """return when pending work left by an update run becomes due, even if
+    neither the mirror nor the DB change in the meantime: the earliest time
+    at which a quarantined package is to be retried or a retained package
+    expires. Return None if there is no pending work
+
+    """
+    now = datetime.utcnow()
+    if status.rm_failed:
+        return now  # to be retried right away
+    due = []
+    if status.failed:
+        retry_after = dict(((package, version), retry)
+                           for (package, version, retry)
+                           in session.query(ExtractionFailure.package,
+                                            ExtractionFailure.version,
+                                            ExtractionFailure.retry_after))
+        for pkg_id in status.failed:
+            # failures not recorded in the ledger are retried right away
+            due.append(retry_after.get(pkg_id, now))
+    if status.retained_until is not None:
+        due.append(status.retained_until)
+    return min(due) if due else None
+
+
+def _load_update_fingerprint(fname):
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    except Exception, e:
+        logging.warn('ignoring corrupted update fingerprint %s: %s'
+                     % (fname, e))
+        return None
+
+
+def _save_update_fingerprint(fname, fingerprint):
+    with open(fname + '.new', 'wb') as f:
+        pickle.dump(fingerprint, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(fname + '.new', fname)
+
+
+def _touch_last_update(conf):
+    if not conf['dry_run'] and 'fs' in conf['backends']:
+        timestamp_file = os.path.join(conf['cache_dir'], 'last-update')
+        with open(timestamp_file + '.new', 'w') as out:
+            out.write('%s\n' % formatdate())
+        os.rename(timestamp_file + '.new', timestamp_file)
+
+
+def _update_fingerprint(conf, session, mirror):
+    """return the fingerprint of the current mirror and DB state, to be
+    compared with the one saved by the last update run; None if the fast path
+    of update() does not apply
+
+    """
+    if 'db' not in conf['backends'] or conf['dry_run'] \
+       or conf['force_triggers'] \
+       or os.path.exists(os.path.join(conf['cache_dir'], JOURNAL_DIR)):
+        return None
+    return {'indexes': mirror.indexes_signature(),
+            'db': _db_generation(session)}
+
+
+def _skip_update(conf, fingerprint, stages):
+    """fast path of update(): if neither the mirror nor the DB have changed
+    since the last (complete) run, as per `fingerprint`, and no work left by
+    it is due yet, mark the DB as updated and return True
+
+    """
+    if fingerprint is None:
+        return False
+    last_run = _load_update_fingerprint(
+        os.path.join(conf['cache_dir'], UPDATE_FINGERPRINT))
+    if last_run is None or last_run['fingerprint'] != fingerprint \
+       or not stages <= last_run['stages'] \
+       or (last_run.get('due') is not None
+           and datetime.utcnow() >= last_run['due']):
+        return False
+    logging.info('mirror and DB unchanged since last update run, '
+                 'nothing to do')
+    if STAGE_CACHE in stages:
+        _touch_last_update(conf)
+    return True
+
+
+def up_to_date(conf, session, stages=UPDATE_STAGES):
+    """check whether an update run with `stages` would have nothing to do,
+    see update(); if so, mark the DB as updated, as that run would do
+
+    meant to avoid costly preparations of no-op update runs, e.g. the staging
+    tables of blue/green updates
+
+    """
+    ensure_cache_dir(conf)
+    mirror = SourceMirror(conf['mirror_dir'], cache_dir=conf['cache_dir'])
+    return _skip_update(conf, _update_fingerprint(conf, session, mirror),
+                        stages)
+
+
 def update(conf, session, stages=UPDATE_STAGES):
     """do a full update run
     """
     logging.info('start')
+    run_timings = timings.reset()
     logging.info('list mirror packages...')
-    mirror = SourceMirror(conf['mirror_dir'])
+    ensure_cache_dir(conf)
+    mirror = SourceMirror(conf['mirror_dir'], cache_dir=conf['cache_dir'])
     status = UpdateStatus()
 
+    # fast path: nothing to do if neither the mirror nor the DB have changed
+    # since the last (complete) run, and no work left by it is due yet
+    fingerprint_file = os.path.join(conf['cache_dir'], UPDATE_FINGERPRINT)
+    fingerprint = _update_fingerprint(conf, session, mirror)
+    if _skip_update(conf, fingerprint, stages):
+        logging.info('finish')
+        return
+
+    if 'db' in conf['backends']:
+        # spare per-package DB lookups for the rest of the run
+        db_storage.preload_package_ids(session)
+    # mirror deltas are only useful for the extract and gc stages, and are not
+    # enough when triggers must be forced on all packages
+    incremental = set([STAGE_EXTRACT, STAGE_GC]) <= stages \
+        and 'db' in conf['backends'] and not conf['dry_run']
+    if incremental and not conf['force_triggers']:
+        status.mirror_delta = mirror.delta(tag=_snapshot_tag(session))
+        if status.mirror_delta is not None:
+            (new_pkgs, gone_pkgs) = status.mirror_delta
+            logging.info('mirror delta: %d new packages, %d gone packages'
+                         % (len(new_pkgs), len(gone_pkgs)))
+
+    journal = None
+    if conf['journal'] and not conf['dry_run']:
+        journal = UpdateJournal(os.path.join(conf['cache_dir'], JOURNAL_DIR))
+        if journal.resumed:
+            logging.info('resume interrupted update run: %d stages and '
+                         '%d packages already done'
+                         % (len(journal.stages), len(journal.packages)))
+            if journal.status is not None:
+                journal.status.mirror_delta = status.mirror_delta
+                status = journal.status
+
+    journal_lock = threading.Lock()
+
+    def run_stage(stage, stage_session):
+        if journal is not None and pp_stage(stage) in journal.stages:
+            logging.info('skip stage %s, already done' % pp_stage(stage))
+            return
+        (func, args, kwargs) = {
+            STAGE_EXTRACT: (extract_new, [mirror], {'journal': journal}),
+            STAGE_SUITES: (update_suites, [mirror], {}),
+            STAGE_GC: (garbage_collect, [mirror], {}),
+            STAGE_STATS: (update_statistics, [], {}),
+            STAGE_CACHE: (update_metadata, [], {}),
+            STAGE_CHARTS: (update_charts, [], {}),
+        }[stage]
+        with timings.measure('stage', pp_stage(stage)):
+            func(status, conf, stage_session, *args, **kwargs)
+        if journal is not None:
+            with journal_lock:
+                _journal_commit(conf, stage_session)
+                journal.stage_done(pp_stage(stage), status)
+
+    # with a single transaction all stages must share the same DB session
+    _run_stages(stages, run_stage, session,
+                concurrent=not conf['single_transaction'])
+
+    if incremental:
+        _save_mirror_snapshot(status, conf, session, mirror)
+    if journal is not None:
+        journal.finish()
+    if fingerprint is not None:
+        # failures are to be retried, retained packages will expire
+        due = _next_due(status, session)
+        if due is not None and due <= datetime.utcnow():
+            logging.debug('not saving update fingerprint: pending work')
+            if os.path.exists(fingerprint_file):
+                os.unlink(fingerprint_file)
+        else:
+            fingerprint['db'] = _db_generation(session)
+            last_run = {'fingerprint': fingerprint, 'stages': stages,
+                        'due': due}
+            _after_commit(session, lambda: _save_update_fingerprint(
+                fingerprint_file, last_run))
+    report_file = os.path.join(conf['cache_dir'], TIMINGS_REPORT)
+    run_timings.save_report(report_file)
+    logging.info('timing report saved to %s' % report_file)
+    logging.info('finish')
+
+
+def _pp_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'TiB'
+    return '%.1f %s' % (size, unit)
+
+
+def _pp_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%dh%02dm%02ds' % (hours, minutes, seconds)
+
+
+class UpdatePlan(object):
+    """what an update run would do, and how long it would take, see plan()"""
+
+    def __init__(self):
+        self.extract = None        # new <package, version> pairs, if planned
+        self.extract_size = 0      # size of new packages, in bytes
+        self.quarantined = set()   # new, but quarantined, packages
+        self.gc = None             # expired <package, version> pairs, if any
+        self.retained = set()      # gone, but not yet expired, packages
+        self.add_throughput = None  # packages/s, from previous runs
+        self.rm_throughput = None   # packages/s, from previous runs
+
+    def _eta(self, pkgs, throughput):
+        if throughput is None:
+            return 'unknown'
+        return _pp_duration(len(pkgs) / throughput)
+
+    def __str__(self):
+        lines = []
+        if self.extract is not None:
+            lines.append('extract: %d packages, %s to unpack (%d more new, '
+                         'but quarantined), ETA %s'
+                         % (len(self.extract), _pp_size(self.extract_size),
+                            len(self.quarantined),
+                            self._eta(self.extract, self.add_throughput)))
+        if self.gc is not None:
+            lines.append('gc: %d packages to remove (%d more gone, but not '
+                         'yet expired), ETA %s'
+                         % (len(self.gc), len(self.retained),
+                            self._eta(self.gc, self.rm_throughput)))
+        return '\n'.join(lines)
+
+
+def _throughput(report, stage, package_activity):
+    """compute from a timing `report` the throughput of `stage` in
+    `package_activity`s (e.g. "add", "rm") per second
+
+    return None if the report knows nothing about it
+
+    """
+    stage_wall = sum(entry['wall'] for entry in report['stages']
+                     if entry['name'] == stage)
+    count = sum(entry['count'] for entry in report['packages']['summary']
+                if entry['name'] == package_activity)
+    if not stage_wall or not count:
+        return None
+    return count / stage_wall
+
+
+def plan(conf, session, stages=UPDATE_STAGES):
+    """plan an update run, without doing it: return an `UpdatePlan` listing
+    the packages that the extract and gc stages would act upon, with
+    durations estimated using the throughput of the last update run (see
+    TIMINGS_REPORT)
+
+    neither the DB nor the FS storage are touched; only the mirror index cache
+    might be refreshed, as it would be by update()
+
+    """
+    update_plan = UpdatePlan()
+    mirror = SourceMirror(conf['mirror_dir'], cache_dir=conf['cache_dir'])
+    q = session.query(PackageName.name, Package.version,
+                      Package.sticky, Package.area) \
+               .filter(Package.name_id == PackageName.id)
+    db_packages = dict(((name, version), (sticky, area))
+                       for (name, version, sticky, area) in q)
+
     if STAGE_EXTRACT in stages:
-        extract_new(status, conf, session, mirror)      # stage 1
-    if STAGE_SUITES in stages:
-        update_suites(status, conf, session, mirror)    # stage 2
+        update_plan.extract = set()
+        quarantined = set((entry.package, entry.version)
+                          for entry in quarantine(session))
+        for pkg in mirror.ls():
+            pkg_id = (pkg['package'], pkg['version'])
+            if pkg_id in db_packages or pkg_id in update_plan.extract:
+                continue
+            if pkg_id in quarantined:
+                update_plan.quarantined.add(pkg_id)
+            else:
+                update_plan.extract.add(pkg_id)
+                update_plan.extract_size += pkg.source_size()
+
     if STAGE_GC in stages:
-        garbage_collect(status, conf, session, mirror)  # stage 3
-    if STAGE_STATS in stages:
-        update_statistics(status, conf, session)        # stage 4
-    if STAGE_CACHE in stages:
-        update_metadata(status, conf, session)          # stage 5
-    if STAGE_CHARTS in stages:
-        update_charts(status, conf, session)            # stage 6
+        update_plan.gc = set()
+        for (pkg_id, (sticky, area)) in db_packages.iteritems():
+            if sticky or pkg_id in mirror.packages:
+                continue
+            pkg = SourcePackage.from_db_fields(pkg_id[0], pkg_id[1], area)
+            if _is_expired(conf, pkg.extraction_dir(conf['sources_dir'])):
+                update_plan.gc.add(pkg_id)
+            else:
+                update_plan.retained.add(pkg_id)
 
-    logging.info('finish')
+    report_file = os.path.join(conf['cache_dir'], TIMINGS_REPORT)
+    if os.path.exists(report_file):
+        report = timings.load_report(report_file)
+        update_plan.add_throughput = _throughput(report, 'extract', 'add')
+        update_plan.rm_throughput = _throughput(report, 'gc', 'rm')
+
+    return update_plan
@@ -0,0 +1,243 @@
+# Copyright (C) 2015  Stefano Zacchiroli <zack@upsilon.cc>
+#
+# This file is part of Debsources.
+#
+# Debsources is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""enforce per-package resource limits on the subprocesses (e.g. dpkg-source,
+ctags, sloccount) run while adding packages to Debsources
+
+limits are set for the duration of a block with `package_limits`, from the
+following configuration settings (0 means no limit):
+
+- package_timeout: wall time (in seconds) the block may last; when work on a
+  package is split in several blocks (e.g. extraction and analysis, done by
+  different worker processes) the time left at the end of each block is
+  passed on to the next one, see `remaining`
+- package_max_size: size (in MiB) of the extracted package, and of each file
+  written by watched subprocesses
+- package_max_files: number of files of the extracted package
+
+watched subprocesses are run with `call`, `check_call` and `check_output`,
+which work like their `subprocess` namesakes. Subprocesses that break a limit
+are killed, together with their children, and ResourceLimitExceeded is raised
+
+"""
+
+import errno
+import os
+import resource
+import signal
+import subprocess
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from debsources.excepts import ResourceLimitExceeded
+
+
+# initial and maximum interval (in seconds) between limit checks on running
+# subprocesses; checks start frequent, so that quick subprocesses are not
+# slowed down, and get rarer as subprocesses last
+MIN_CHECK_INTERVAL = 0.001
+MAX_CHECK_INTERVAL = 1
+
+# minimum interval (in seconds) between size and file count checks of watched
+# directories, which need a full walk of them. Checks are also spaced so that
+# walking takes at most 1/TREE_CHECK_FACTOR of the time of the subprocess
+MIN_TREE_CHECK_INTERVAL = 1
+TREE_CHECK_FACTOR = 10
+
+
+class Limits(object):
+    """resource limits of a package, see `package_limits`"""
+
+    def __init__(self, timeout=0, max_size=0, max_files=0):
+        self.deadline = time.time() + timeout if timeout else None
+        self.max_size = max_size * 1024 * 1024 if max_size else None
+        self.max_files = max_files or None
+
+    def __nonzero__(self):
+        return self.deadline is not None or self.max_size is not None \
+            or self.max_files is not None
+
+    def violation(self, watch_dir=None):
+        """return a description of the limit broken so far, if any; the
+        content of `watch_dir`, if given, is checked too
+
+        """
+        if self.deadline is not None and time.time() > self.deadline:
+            return 'timeout'
+        if watch_dir is None or \
+           (self.max_size is None and self.max_files is None):
+            return None
+        (size, files) = (0, 0)
+        for root, _dirs, fnames in os.walk(watch_dir):
+            for fname in fnames:
+                files += 1
+                try:
+                    size += os.lstat(os.path.join(root, fname)).st_size
+                except OSError:  # e.g. removed in the meantime
+                    pass
+            if self.max_files is not None and files > self.max_files:
+                return 'more than %d files' % self.max_files
+            if self.max_size is not None and size > self.max_size:
+                return 'more than %d bytes' % self.max_size
+        return None
+
+
+# limits of the package being worked upon by the current process
+_limits = Limits()
+
+
+@contextmanager
+def package_limits(conf, budget=None):
+    """enforce the resource limits set in `conf` on watched subprocesses run
+    within the block
+
+    if given, `budget` is the wall time (in seconds) left to the package by
+    previous blocks of work on it, as returned by `remaining`; it replaces
+    conf['package_timeout'], if the latter is set
+
+    the limits apply to the current process as a whole: threads working
+    concurrently on the same package (e.g. hooks) share them
+
+    """
+    global _limits
+    saved = _limits
+    _limits = Limits(timeout=conf['package_timeout'],
+                     max_size=conf['package_max_size'],
+                     max_files=conf['package_max_files'])
+    if budget is not None and _limits.deadline is not None:
+        _limits.deadline = time.time() + budget
+    try:
+        yield _limits
+    finally:
+        _limits = saved
+
+
+def check():
+    """raise ResourceLimitExceeded if the time limit of the current package has
+    passed; meant to be called by long running Python code
+
+    """
+    if _limits.deadline is not None and time.time() > _limits.deadline:
+        raise ResourceLimitExceeded('timeout')
+
+
+def remaining():
+    """return the wall time (in seconds) left to the current package, to be
+    passed as `budget` to the `package_limits` of the next block of work on
+    it; None if there is no time limit
+
+    """
+    if _limits.deadline is None:
+        return None
+    return max(_limits.deadline - time.time(), 0)
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+    proc.wait()
+
+
+def _run(cmd, watch_dir=None, **kwargs):
+    """run `cmd`, with `subprocess.Popen` arguments `kwargs`, until completion
+    and return its exit code
+
+    """
+    limits = _limits
+    if not limits:
+        return subprocess.call(cmd, **kwargs)
+
+    preexec_fn = kwargs.pop('preexec_fn', None)
+
+    def setup():
+        os.setpgid(0, 0)  # own process group, to be killed as a whole
+        if limits.max_size is not None:
+            resource.setrlimit(resource.RLIMIT_FSIZE,
+                               (limits.max_size, limits.max_size))
+            # ignored by Python, and hence by its children
+            signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+        if preexec_fn is not None:
+            preexec_fn()
+
+    proc = subprocess.Popen(cmd, preexec_fn=setup, **kwargs)
+    interval = MIN_CHECK_INTERVAL
+    next_tree_check = time.time() + MIN_TREE_CHECK_INTERVAL
+    try:
+        while proc.poll() is None:
+            if watch_dir is not None and time.time() >= next_tree_check:
+                started = time.time()
+                violation = limits.violation(watch_dir)
+                next_tree_check = time.time() + max(
+                    MIN_TREE_CHECK_INTERVAL,
+                    (time.time() - started) * TREE_CHECK_FACTOR)
+            else:
+                violation = limits.violation()
+            if violation is not None:
+                _kill(proc)
+                raise ResourceLimitExceeded('%s: %s' % (cmd[0], violation))
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_CHECK_INTERVAL)
+    finally:
+        if proc.returncode is None:  # e.g. KeyboardInterrupt
+            _kill(proc)
+    if proc.returncode == -signal.SIGXFSZ:
+        raise ResourceLimitExceeded('%s: file larger than %d bytes'
+                                    % (cmd[0], limits.max_size))
+    violation = limits.violation(watch_dir)
+    if violation is not None:
+        raise ResourceLimitExceeded('%s: %s' % (cmd[0], violation))
+    return proc.returncode
+
+
+def call(cmd, watch_dir=None, **kwargs):
+    """like `subprocess.call`, but enforcing the limits of the current package
+
+    if given, the content of directory `watch_dir` is checked against size and
+    file count limits
+
+    """
+    return _run(cmd, watch_dir, **kwargs)
+
+
+def check_call(cmd, watch_dir=None, **kwargs):
+    """like `subprocess.check_call`, but enforcing the limits of the current
+    package, see `call`
+
+    """
+    retcode = _run(cmd, watch_dir, **kwargs)
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+    return 0
+
+
+def check_output(cmd, watch_dir=None, **kwargs):
+    """like `subprocess.check_output`, but enforcing the limits of the current
+    package, see `call`
+
+    """
+    with tempfile.TemporaryFile() as out:
+        retcode = _run(cmd, watch_dir, stdout=out, **kwargs)
+        out.seek(0)
+        output = out.read()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd, output=output)
+    return output